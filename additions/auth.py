@@ -1,39 +1,152 @@
-import secrets
+import os
+import hmac
+import time
 import base64
-from fastapi import Request
-from starlette.middleware.base import BaseHTTPMiddleware
+import hashlib
+import secrets
 from starlette.responses import Response
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+SESSION_COOKIE = "vcauth"
+DEFAULT_SESSION_MAX_AGE = 7 * 24 * 3600
+
+# Accepted Authorization header values remembered to skip decoding them again
+ACCEPTED_CACHE_SIZE = 16
+
+# Random secret signing session cookies: taken from this environment variable, or
+# generated once into SESSION_SECRET_FILE and shared by every worker through it
+SESSION_SECRET_ENV = "REVCDOS_SESSION_SECRET"
+SESSION_SECRET_FILE = ".session_secret"
+
+
+def load_session_secret(path: str = SESSION_SECRET_FILE) -> bytes:
+    """The session secret from the environment, or from path, created on first use."""
+    if secret := os.environ.get(SESSION_SECRET_ENV):
+        return secret.encode("utf-8")
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    # Written aside then linked into place, so concurrent workers agree on one secret
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(secrets.token_bytes(32))
+    try:
+        os.link(tmp_path, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp_path)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class BasicAuthMiddleware:
+    """
+    HTTP Basic authentication as a plain ASGI middleware.
+
+    Requests are let through or rejected from their headers alone; the response
+    body is never wrapped, so large streamed responses go straight to the server.
+    Authorization values that were accepted are remembered (and compared in
+    constant time) so they are not decoded again. With `session_cookie`, an
+    accepted request also gets a signed cookie that authenticates later asset
+    requests without any Basic parsing.
+    """
 
-class BasicAuthMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app, username, password):
-        super().__init__(app)
+    def __init__(
+        self,
+        app: ASGIApp,
+        username: str,
+        password: str,
+        session_cookie: bool = False,
+        session_max_age: int = DEFAULT_SESSION_MAX_AGE,
+    ):
+        self.app = app
         self.username = username
         self.password = password
+        self.session_cookie = session_cookie
+        self.session_max_age = session_max_age
+        self._accepted: list[bytes] = []
+        # Keyed by a random secret shared by every worker, so a cookie reveals nothing
+        # about the password; bound to the credentials, so a password change invalidates it
+        self._session_key = hmac.new(
+            load_session_secret(), f"session:{username}:{password}".encode("utf-8"), hashlib.sha256
+        ).digest() if session_cookie else b""
 
-    async def dispatch(self, request: Request, call_next):
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
         # Skip auth for OPTIONS requests (CORS)
-        if request.method == "OPTIONS":
-            return await call_next(request)
+        if scope["type"] != "http" or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
 
-        auth_header = request.headers.get("Authorization")
-        if not auth_header:
-            return self._unauthorized()
-        
+        authorization = cookie = None
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                authorization = value
+            elif name == b"cookie":
+                cookie = value
+
+        if self.session_cookie and cookie is not None and self._valid_session(cookie):
+            await self.app(scope, receive, send)
+            return
+        if authorization is None or not self._check(authorization):
+            await self._unauthorized()(scope, receive, send)
+            return
+        if not self.session_cookie:
+            await self.app(scope, receive, send)
+            return
+
+        set_cookie = (
+            f"{SESSION_COOKIE}={self._new_session()}; Max-Age={self.session_max_age}; Path=/; HttpOnly; SameSite=Strict"
+        ).encode("latin-1")
+
+        async def send_with_cookie(message):
+            if message["type"] == "http.response.start":
+                message = dict(message, headers=[*message.get("headers", []), (b"set-cookie", set_cookie)])
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
+
+    def _check(self, authorization: bytes) -> bool:
+        # compare_digest on every entry keeps the lookup constant-time
+        if any([hmac.compare_digest(authorization, accepted) for accepted in self._accepted]):
+            return True
         try:
-            scheme, credentials = auth_header.split()
+            scheme, credentials = authorization.decode("latin-1").split()
             if scheme.lower() != "basic":
-                return self._unauthorized()
-            
+                return False
+
             decoded = base64.b64decode(credentials).decode("utf-8")
             username, password = decoded.split(":", 1)
-            
-            if not (secrets.compare_digest(username, self.username) and 
-                    secrets.compare_digest(password, self.password)):
-                return self._unauthorized()
         except Exception:
-            return self._unauthorized()
+            return False
+
+        if not (secrets.compare_digest(username, self.username) and
+                secrets.compare_digest(password, self.password)):
+            return False
+        if len(self._accepted) >= ACCEPTED_CACHE_SIZE:
+            self._accepted.pop(0)
+        self._accepted.append(authorization)
+        return True
+
+    def _sign(self, expires: str) -> str:
+        return hmac.new(self._session_key, expires.encode("ascii"), hashlib.sha256).hexdigest()
+
+    def _new_session(self) -> str:
+        expires = str(int(time.time()) + self.session_max_age)
+        return f"{expires}.{self._sign(expires)}"
 
-        return await call_next(request)
+    def _valid_session(self, cookie: bytes) -> bool:
+        for item in cookie.decode("latin-1").split(";"):
+            name, _, value = item.strip().partition("=")
+            if name != SESSION_COOKIE:
+                continue
+            expires, _, signature = value.partition(".")
+            if expires.isdigit() and hmac.compare_digest(signature, self._sign(expires)):
+                return int(expires) > time.time()
+        return False
 
     def _unauthorized(self):
         return Response(
@@ -1,11 +1,25 @@
 import os
-import httpx
-import tempfile
-import shutil
+import re
+import json
+import time
+import asyncio
+import bisect
+import hashlib
+import mimetypes
+from collections import OrderedDict, deque
+from email.utils import formatdate, parsedate_to_datetime
+from stat import S_ISREG
 import brotli
 from fastapi import Request
-from fastapi.responses import StreamingResponse, FileResponse
+from fastapi.responses import StreamingResponse, FileResponse, Response
 from starlette.background import BackgroundTask
+from starlette.datastructures import Headers, MutableHeaders
+from additions import metrics, upstream, workers
+from additions.variants import variant_store
+from additions.integrity import manifest, quarantine, quarantined_recently
+from additions.cache_index import CacheIndex, index_for
+from additions.locks import FileLock
+from additions.sendfile import ZERO_COPY_SEND
 
 def _get_file_headers(local_path: str) -> dict:
     headers = {
@@ -16,6 +30,7 @@ def _get_file_headers(local_path: str) -> dict:
     if local_path.endswith(".br"):
         headers["Content-Encoding"] = "br"
         headers["Content-Type"] = "application/octet-stream"
+        headers["Vary"] = "Accept-Encoding"
     
     return headers
 
@@ -27,57 +42,1030 @@ def _get_media_type(local_path: str) -> str:
         return "application/octet-stream"
     return None  # Let FileResponse auto-detect
 
-def get_local_file(local_path: str, request: Request = None) -> FileResponse | StreamingResponse | None:
+def _file_etag(stat: os.stat_result) -> str:
+    """Same validator FileResponse computes, so both tiers agree."""
+    return '"' + hashlib.md5(f"{stat.st_mtime}-{stat.st_size}".encode(), usedforsecurity=False).hexdigest() + '"'
+
+
+class _HotEntry:
+    __slots__ = ("body", "headers", "media_type", "mtime", "size", "checked")
+
+    def __init__(self, body: bytes, headers: dict, media_type: str, stat: os.stat_result):
+        self.body = body
+        self.headers = headers
+        self.media_type = media_type
+        self.mtime = stat.st_mtime
+        self.size = stat.st_size
+        self.checked = time.monotonic()
+
+
+class HotCache:
+    """
+    Bounded in-memory LRU of small, frequently requested local files.
+
+    Entries keep their body together with precomputed headers, so a hit is answered
+    without touching the filesystem. Each entry is re-checked against the file's mtime
+    at most once per `check_interval` seconds. Disabled while `max_bytes` is 0.
+    """
+
+    def __init__(self, max_bytes: int = 0, max_object_size: int = 0, check_interval: float = 1.0):
+        self.max_bytes = max_bytes
+        self.max_object_size = max_object_size
+        self.check_interval = check_interval
+        self.entries: OrderedDict[str, _HotEntry] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def configure(self, max_bytes: int, max_object_size: int, check_interval: float = 1.0) -> None:
+        self.max_bytes = max_bytes
+        self.max_object_size = max_object_size
+        self.check_interval = check_interval
+        self._shrink()
+
+    def get(self, local_path: str) -> Response | None:
+        entry = self.entries.get(local_path)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        now = time.monotonic()
+        if now - entry.checked > self.check_interval:
+            try:
+                stat = os.stat(local_path)
+            except OSError:
+                stat = None
+            if stat is None or stat.st_mtime != entry.mtime or stat.st_size != entry.size:
+                self.invalidate(local_path)
+                self.misses += 1
+                return None
+            entry.checked = now
+
+        self.entries.move_to_end(local_path)
+        self.hits += 1
+        return Response(entry.body, media_type=entry.media_type, headers=entry.headers)
+
+    def put(self, local_path: str, stat: os.stat_result, headers: dict, media_type: str | None) -> Response | None:
+        """Load a file into the tier if it fits; returns its response, or None if not cached."""
+        if not self.enabled or stat.st_size > self.max_object_size or stat.st_size > self.max_bytes:
+            return None
+        with open(local_path, "rb") as f:
+            body = f.read()
+        if len(body) != stat.st_size:
+            return None
+
+        headers = dict(headers)
+        headers["ETag"] = _file_etag(stat)
+        headers["Last-Modified"] = formatdate(stat.st_mtime, usegmt=True)
+        media_type = media_type or mimetypes.guess_type(local_path)[0] or "text/plain"
+
+        self.invalidate(local_path)
+        self.entries[local_path] = _HotEntry(body, headers, media_type, stat)
+        self.size += len(body)
+        self._shrink()
+        return Response(body, media_type=media_type, headers=headers)
+
+    def invalidate(self, local_path: str) -> None:
+        entry = self.entries.pop(local_path, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def _shrink(self) -> None:
+        while self.entries and self.size > self.max_bytes:
+            _, entry = self.entries.popitem(last=False)
+            self.size -= entry.size
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "max_object_size": self.max_object_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+hot_cache = HotCache()
+
+def get_local_file(local_path: str, request: Request = None, validators: dict = None) -> Response | None:
     """
     Get a local file as response. If it's a .br file and client doesn't accept brotli,
     decompress it on the fly.
+
+    Small files are served from the in-memory hot tier when it is enabled, and
+    conditional requests matching the file's validators get a 304.
     
     Args:
         local_path: Path to the local file
         request: Optional request object to check Accept-Encoding header
+        validators: Optional upstream ETag/Last-Modified headers to send instead of
+            the ones derived from the file
         
     Returns:
-        FileResponse, StreamingResponse (for decompressed .br), or None if file not found
+        FileResponse, StreamingResponse (for decompressed .br), an in-memory Response,
+        a 304 Response, or None if file not found
     """
-    if not os.path.isfile(local_path):
+    response = _get_local_file(local_path, request, validators)
+    if response is not None and request is not None and _is_not_modified(request.headers, response.headers):
+        return _not_modified(response.headers)
+    if isinstance(response, FileResponse):
+        return _ZeroCopyFileResponse(response)
+    return response
+
+def _get_local_file(local_path: str, request: Request = None, validators: dict = None) -> Response | None:
+    # Check if we need to decompress .br file for client
+    is_br_file = local_path.endswith(".br")
+    need_decompress = is_br_file and request and not _client_accepts_brotli(request)
+
+    # Whole-body requests only: ranges and decompression go through the file path
+    use_hot_cache = hot_cache.enabled and not need_decompress and not (request and "range" in request.headers)
+    if use_hot_cache and (response := hot_cache.get(local_path)):
+        if validators:
+            response.headers.update(validators)
+        return response
+
+    try:
+        stat = os.stat(local_path)
+    except OSError:
+        return None
+    if not S_ISREG(stat.st_mode):
         return None
     
     headers = _get_file_headers(local_path)
     media_type = _get_media_type(local_path)
-    
-    # Check if we need to decompress .br file for client
-    is_br_file = local_path.endswith(".br")
-    need_decompress = is_br_file and request and not _client_accepts_brotli(request)
+
+    if use_hot_cache and (response := hot_cache.put(local_path, stat, headers, media_type)):
+        if validators:
+            response.headers.update(validators)
+        return response
     
     if need_decompress:
-        # Stream decompressed content
         headers.pop("Content-Encoding", None)
         headers["Content-Type"] = "application/octet-stream"
+
+        # Serve a prebuilt decompressed/gzip/zstd variant when there is one. It is a
+        # different representation, so it keeps the validators of its own file.
+        if variant := variant_store.lookup(local_path, request.headers.get("accept-encoding", ""), stat):
+            variant_path, encoding = variant
+            if encoding != "identity":
+                headers["Content-Encoding"] = encoding
+            return FileResponse(variant_path, media_type=media_type, headers=headers, stat_result=os.stat(variant_path))
+
+        # Stream decompressed content
         
-        def iterate_decompressed():
-            with open(local_path, "rb") as f:
+        async def iterate_decompressed():
+            with open(local_path, "rb", buffering=0) as f:
                 decompressor = brotli.Decompressor()
-                while chunk := f.read(65536):  # 64KB chunks
-                    yield decompressor.process(chunk)
+                pos = 0
+                # Reads and decompression both run in the bounded worker pool
+                while chunk := await workers.decompress(os.pread, f.fileno(), READ_SIZE, pos):
+                    pos += len(chunk)
+                    yield await workers.decompress(decompressor.process, chunk)
         
         return StreamingResponse(
             iterate_decompressed(),
             media_type="application/octet-stream",
             headers=headers
         )
-    
+
+    if validators:
+        headers.update(validators)
     if media_type:
-        return FileResponse(local_path, media_type=media_type, headers=headers)
-    return FileResponse(local_path, headers=headers)
+        return FileResponse(local_path, media_type=media_type, headers=headers, stat_result=stat)
+    return FileResponse(local_path, headers=headers, stat_result=stat)
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """Weak comparison of an If-None-Match list against an ETag."""
+    if if_none_match.strip() == "*":
+        return True
+    etag = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+def _is_not_modified(request_headers, response_headers) -> bool:
+    """Whether a conditional GET can be answered with 304 (If-None-Match wins over If-Modified-Since)."""
+    if if_none_match := request_headers.get("if-none-match"):
+        etag = response_headers.get("etag")
+        return etag is not None and _etag_matches(if_none_match, etag)
+    if_modified_since = request_headers.get("if-modified-since")
+    last_modified = response_headers.get("last-modified")
+    if if_modified_since and last_modified:
+        try:
+            return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+# Headers a 304 must repeat from the 200 it stands for
+_NOT_MODIFIED_HEADERS = (
+    "etag", "last-modified", "cache-control", "vary", "expires", "content-location",
+    "cross-origin-opener-policy", "cross-origin-embedder-policy",
+)
+
+def _not_modified(response_headers) -> Response:
+    headers = {k: v for k, v in response_headers.items() if k.lower() in _NOT_MODIFIED_HEADERS}
+    return Response(status_code=304, headers=headers)
 
 def _client_accepts_brotli(request: Request) -> bool:
     """Check if client accepts brotli encoding."""
     accept_encoding = request.headers.get("accept-encoding", "")
     return "br" in accept_encoding.lower()
 
+# Granularity of the on-disk index of a partially downloaded asset
+CHUNK_SIZE = 1024 * 1024
+READ_SIZE = 65536
+
+# Seconds between two looks at a download run by another worker process
+FOLLOW_INTERVAL = 0.1
+
+DEFAULT_SEGMENTS = 4
+DEFAULT_SEGMENT_SIZE = 8 * CHUNK_SIZE
+
+# Segmented downloads, see configure_segments()
+_segment_threshold = 0
+_segments = DEFAULT_SEGMENTS
+_segment_size = DEFAULT_SEGMENT_SIZE
+
+
+def configure_segments(threshold: int, segments: int = DEFAULT_SEGMENTS, segment_size: int = DEFAULT_SEGMENT_SIZE) -> None:
+    """
+    Download large assets as parallel Range requests, each on its own connection.
+
+    Args:
+        threshold: Smallest asset size (bytes) downloaded in segments; 0 to disable
+        segments: Range requests running at once for one asset
+        segment_size: Bytes per Range request, rounded up to whole index chunks
+    """
+    global _segment_threshold, _segments, _segment_size
+    _segment_threshold = threshold
+    _segments = max(1, segments)
+    _segment_size = max(1, -(-segment_size // CHUNK_SIZE)) * CHUNK_SIZE
+
+# Representation headers that do not depend on which bytes of the asset are sent
+_RANGE_DEPENDENT_HEADERS = {"content-length", "content-range", "accept-ranges"}
+
+_CONTENT_RANGE_RE = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+
+def _parse_range(range_header: str | None, total: int):
+    """
+    Parse a single `bytes=` range against the asset size.
+
+    Returns:
+        (start, end) inclusive, None to ignore the header (absent, multi-range or
+        malformed) or False when the range cannot be satisfied.
+    """
+    if not range_header:
+        return None
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else total - 1
+        else:
+            suffix = int(last)
+            if suffix == 0:
+                return False
+            start = max(total - suffix, 0)
+            end = total - 1
+    except ValueError:
+        return None
+    if start >= total:
+        return False
+    if start > end:
+        return None
+    return start, min(end, total - 1)
+
+
+class _UpstreamChanged(RuntimeError):
+    """Upstream answered a follow-up request of a fill with another version of the asset."""
+
+
+class _Segment:
+    """One upstream response being written into a partial cache file."""
+
+    def __init__(self, start: int, end: int | None):
+        self.start = start
+        self.end = end  # inclusive, None while the asset size is unknown
+        self.pos = start
+        self.done = False
+        self.error = None
+
+
+class _Fill:
+    """
+    A partially downloaded asset, shared by every requester of the same local_path.
+
+    Bytes are written at their offset into a sparse `.part` file. The chunks already
+    present are recorded in a `.part.json` index, so a partial download survives
+    restarts and Range requests only fetch the spans that are still missing. Concurrent
+    readers tail the in-flight upstream responses instead of issuing their own.
+    Once every byte is present the `.part` file is promoted to local_path.
+
+    Worker processes sharing the cache directory coordinate through a file lock:
+    only its holder downloads into the `.part` file, the others follow the chunks it
+    records in the index and take over if it stops.
+    """
+
+    def __init__(self, local_path: str):
+        self.local_path = local_path
+        self.part_path = local_path + ".part"
+        self.index_path = local_path + ".part.json"
+        self.url = None
+        # Mirror that served the first response: follow-up Range requests go to it
+        self.mirror = None
+        self.request_headers = {}
+        self.total = None
+        self.headers = None
+        self.filled = []  # sorted, disjoint [start, end) byte spans present in part_path
+        self.segments = []
+        # Offset from which every missing span is wanted (whole downloads), None when
+        # only the spans readers ask for are
+        self.sweep = None
+        self.tasks = set()
+        self.pending = False
+        self.complete = False
+        self.finishing = False
+        # Its bytes are being thrown away (see _drop)
+        self.obsolete = False
+        # Started by a revalidation, while the previous version stays cached
+        self.revalidation = False
+        self.ready = asyncio.Event()
+        self.cond = asyncio.Condition()
+        # SHA-256 of bytes 0..hashed, fed from the write path while it is sequential
+        self.verify = manifest.expected(local_path) is not None
+        self.hasher = hashlib.sha256()
+        self.hashed = 0
+        self.lock = FileLock(local_path)
+        if self.lock.acquire():
+            self._sync()
+            self.lock.release()
+        else:
+            self._sync()
+
+    def _sync(self, follow: bool = False) -> None:
+        """
+        Merge the on-disk index into this fill: resume an interrupted download, or pick
+        up the chunks another worker wrote. Only the lock holder discards stale files.
+
+        Args:
+            follow: Whether another worker may have promoted the download meanwhile
+        """
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+            total = index["total"]
+            chunks = bytes.fromhex(index["chunks"])
+            if os.path.getsize(self.part_path) != total or index["chunk_size"] != CHUNK_SIZE:
+                raise ValueError("stale partial download")
+        except FileNotFoundError:
+            if follow and not os.path.exists(self.part_path) and os.path.isfile(self.local_path):
+                self._promoted_elsewhere()
+            return
+        except (ValueError, KeyError, OSError):
+            if self.lock.held:
+                self._discard_files()
+            return
+
+        if self.headers is not None and (total != self.total or index["headers"].get("etag") != self.headers.get("etag")):
+            # Another worker restarted the download from a different upstream version
+            self.filled = []
+            self.hasher = hashlib.sha256()
+            self.hashed = 0
+        self.total = total
+        self.headers = index["headers"]
+        for n in range((total + CHUNK_SIZE - 1) // CHUNK_SIZE):
+            if chunks[n // 8] & (1 << (n % 8)):
+                self._add(n * CHUNK_SIZE, min((n + 1) * CHUNK_SIZE, total))
+        self.ready.set()
+
+    def _promoted_elsewhere(self) -> None:
+        """Another worker completed the download: continue from the cached file."""
+        size = os.path.getsize(self.local_path)
+        self.total = size
+        self.filled = [[0, size]] if size else []
+        self.complete = True
+        if _fills.get(self.local_path) is self:
+            _fills.pop(self.local_path)
+        if index := index_for(self.local_path):
+            index.adopt(self.local_path)
+        self.ready.set()
+
+    def _own(self) -> bool:
+        """
+        Become the worker that downloads this asset, if no other process is.
+
+        Returns:
+            False if another worker holds the lock, or completed the download.
+        """
+        if self.lock.held:
+            return True
+        if not self.lock.acquire():
+            return False
+        # Continue from whatever the previous holder wrote
+        self._sync(follow=True)
+        if self.complete:
+            self.lock.release()
+            return False
+        return True
+
+    async def claim(self) -> bool:
+        """
+        Wait until this process may start the download.
+
+        Returns:
+            False if another worker started (or completed) it meanwhile; the fill is
+            then ready to be followed.
+        """
+        while not self._own():
+            if self.ready.is_set():
+                return False
+            await asyncio.sleep(FOLLOW_INTERVAL)
+            self._sync(follow=True)
+        return True
+
+    async def _follow(self, pos: int | None = None) -> None:
+        """Wait until another worker wrote pos (or completed the asset), or stopped downloading it."""
+        while not self.complete and (pos is None or self._covered_end(pos) is None):
+            await asyncio.sleep(FOLLOW_INTERVAL)
+            if self._own():
+                return
+            self._sync(follow=True)
+
+    def _discard_files(self) -> None:
+        for path in (self.part_path, self.index_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _persist(self) -> None:
+        """Record which whole chunks are present, atomically."""
+        if self.complete or self.obsolete or self.total is None:
+            return
+        n_chunks = (self.total + CHUNK_SIZE - 1) // CHUNK_SIZE
+        chunks = bytearray((n_chunks + 7) // 8)
+        for start, end in self.filled:
+            first = (start + CHUNK_SIZE - 1) // CHUNK_SIZE
+            last = n_chunks if end == self.total else end // CHUNK_SIZE
+            for n in range(first, last):
+                chunks[n // 8] |= 1 << (n % 8)
+        index = {"total": self.total, "chunk_size": CHUNK_SIZE, "chunks": chunks.hex(), "headers": self.headers}
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _add(self, start: int, end: int) -> None:
+        """Mark [start, end) as present, merging with neighbouring spans."""
+        i = bisect.bisect_left(self.filled, [start, start])
+        if i > 0 and self.filled[i - 1][1] >= start:
+            i -= 1
+        j = i
+        while j < len(self.filled) and self.filled[j][0] <= end:
+            start = min(start, self.filled[j][0])
+            end = max(end, self.filled[j][1])
+            j += 1
+        self.filled[i:j] = [[start, end]]
+
+    def _covered_end(self, pos: int) -> int | None:
+        """End of the present span containing pos, or None if pos is missing."""
+        i = bisect.bisect_right(self.filled, [pos, float("inf")]) - 1
+        if i >= 0 and self.filled[i][0] <= pos < self.filled[i][1]:
+            return self.filled[i][1]
+        return None
+
+    def _segment_at(self, pos: int) -> _Segment | None:
+        for seg in self.segments:
+            if seg.start <= pos and (seg.end is None or pos <= seg.end):
+                return seg
+        return None
+
+    def _gap_end(self, pos: int, stop: int) -> int:
+        """Inclusive end of the missing span starting at pos, rounded up to a chunk."""
+        end = min(-(-stop // CHUNK_SIZE) * CHUNK_SIZE, self.total)
+        i = bisect.bisect_right(self.filled, [pos, float("inf")])
+        if i < len(self.filled):
+            end = min(end, self.filled[i][0])
+        for seg in self.segments:
+            if seg.start > pos:
+                end = min(end, seg.start)
+        return end - 1
+
+    def _segmented(self) -> bool:
+        return bool(_segment_threshold) and self.total is not None and self.total >= _segment_threshold
+
+    def _span_end(self, pos: int, stop: int) -> int:
+        """Inclusive end of a new download from pos towards stop: one segment when segmented."""
+        if self._segmented():
+            stop = min(stop, pos + _segment_size)
+        return self._gap_end(pos, stop)
+
+    def _next_gap(self, pos: int) -> int | None:
+        """First offset from pos that is neither present nor being downloaded."""
+        spans = sorted([*self.filled, *([seg.start, seg.end + 1] for seg in self.segments if seg.end is not None)])
+        for start, end in spans:
+            if start > pos:
+                break
+            pos = max(pos, end)
+        return pos if pos < self.total else None
+
+    def _schedule(self) -> None:
+        """Keep up to `segments` downloads running over the missing spans after sweep."""
+        if self.sweep is None or not self._segmented() or not self.lock.held or self.finishing or self.obsolete:
+            return
+        while len(self.segments) < _segments:
+            pos = self._next_gap(self.sweep)
+            if pos is None:
+                return
+            self._run(_Segment(pos, self._span_end(pos, self.total)))
+
+    def remember(self, url: str, request_headers: dict) -> None:
+        """Keep the latest requester's URL and headers for fetching missing spans."""
+        self.url = url
+        self.request_headers = {
+            k: v for k, v in request_headers.items()
+            if k.lower() not in ("range", *_CONDITIONAL_HEADERS)
+        }
+
+    def start(self, r) -> bool:
+        """
+        Adopt the first upstream response for this asset.
+
+        Returns:
+            False if the response cannot seed the cache; the caller then proxies it as-is.
+        """
+        start, end = 0, None
+        if r.status_code == 206:
+            match = _CONTENT_RANGE_RE.fullmatch(r.headers.get("content-range", ""))
+            if not match:
+                return False
+            start, end, self.total = (int(g) for g in match.groups())
+        elif r.status_code == 200:
+            length = r.headers.get("content-length")
+            self.total = int(length) if length is not None else None
+            end = self.total - 1 if self.total is not None else None
+            # The whole asset is wanted: fetch the rest in parallel segments when large
+            self.sweep = 0
+        else:
+            return False
+
+        self.headers = {k: v for k, v in _response_headers(r).items() if k.lower() not in _RANGE_DEPENDENT_HEADERS}
+        self.mirror = upstream.mirror_of(r)
+        os.makedirs(os.path.dirname(self.local_path), exist_ok=True)
+        self._discard_files()
+        with open(self.part_path, "wb") as f:
+            if self.total is not None:
+                f.truncate(self.total)
+        if end is not None and self._segmented():
+            # The response carries on past it, _download() stops reading there
+            end = self._span_end(start, end + 1)
+        self._run(_Segment(start, end), r)
+        self._schedule()
+        self.ready.set()
+        return True
+
+    def abandon(self) -> None:
+        """Give up on this asset for now; waiters proxy on their own."""
+        _fills.pop(self.local_path, None)
+        self.lock.release()
+        self.ready.set()
+
+    def _run(self, seg: _Segment, r=None) -> None:
+        self.segments.append(seg)
+        task = asyncio.create_task(self._download(seg, r))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _notify(self) -> None:
+        async with self.cond:
+            self.cond.notify_all()
+
+    async def _download(self, seg: _Segment, r=None) -> None:
+        """Write one upstream response into the part file at its offset."""
+        fd = None
+        writes = deque()
+        try:
+            if r is None:
+                headers = dict(self.request_headers, Range=f"bytes={seg.start}-{seg.end}")
+                # Parallel segments only help if they do not share one TCP connection
+                r = await upstream.send("GET", self.url, headers, multiplex=not self._segmented(), mirror=self.mirror)
+                match = _CONTENT_RANGE_RE.fullmatch(r.headers.get("content-range", ""))
+                if r.status_code == 200:
+                    # Upstream ignored the Range header: take the whole body from the start
+                    seg.pos = 0
+                elif r.status_code != 206 or not match or int(match.group(1)) != seg.start:
+                    raise RuntimeError(f"unexpected upstream answer {r.status_code} for {self.url}")
+                etag = self.headers.get("etag") or self.headers.get("ETag")
+                if etag and r.headers.get("etag") != etag:
+                    raise _UpstreamChanged(f"{self.url} changed upstream during a partial download")
+
+            fd = os.open(self.part_path, os.O_WRONLY)
+            async for chunk in r.aiter_raw():
+                if seg.end is not None and seg.pos + len(chunk) > seg.end + 1:
+                    # The first response of a segmented download covers more than its segment
+                    chunk = chunk[:seg.end + 1 - seg.pos]
+                # Disk writes (and hashing) happen on the writer thread; spans only become
+                # readable once their write has completed
+                writes.append((seg.pos, len(chunk), await workers.submit_write(self._write, fd, chunk, seg.pos)))
+                seg.pos += len(chunk)
+                if writes[0][2].done():
+                    await self._written(writes)
+                if seg.end is not None and seg.pos > seg.end:
+                    break
+
+            while writes:
+                await writes[0][2]
+                await self._written(writes)
+            if self.total is None:
+                self.total = seg.pos
+            elif seg.end is not None and seg.pos <= seg.end:
+                raise RuntimeError(f"upstream body of {self.url} ended early")
+        except Exception as e:
+            seg.error = e
+            # Let the next attempt fail over to another mirror; a different version
+            # there restarts the download
+            self.mirror = None
+        finally:
+            if writes:
+                # Never close fd under a queued write
+                await asyncio.wait([future for _, _, future in writes])
+            if fd is not None:
+                os.close(fd)
+            seg.done = True
+            self.segments.remove(seg)
+            if r is not None:
+                await upstream.release(r)
+            if isinstance(seg.error, _UpstreamChanged):
+                self._drop(f"cache: {self.local_path} changed upstream, restarting its download")
+            elif seg.error is not None and self.revalidation:
+                # Nobody resumes it: the next stale hit revalidates from scratch
+                self._drop(f"cache: could not revalidate {self.local_path}: {seg.error}")
+            if self.obsolete:
+                pass
+            elif self._is_complete():
+                await self._finish()
+            elif self.total is None:
+                # Nothing to resume from without knowing the size: start over next time
+                self._discard_files()
+                _fills.pop(self.local_path, None)
+            else:
+                self._persist()
+                if seg.error is None:
+                    self._schedule()
+            if not self.segments and not self.finishing:
+                # Idle: let another worker fetch the spans its readers need
+                self.lock.release()
+            await self._notify()
+
+    def _drop(self, reason: str) -> None:
+        """
+        Throw away this partial download, e.g. of an outdated version, so that no
+        request serves it and the next one downloads the asset from scratch.
+        """
+        if self.obsolete:
+            return
+        print(reason)
+        self.obsolete = True
+        self._discard_files()
+        if _fills.get(self.local_path) is self:
+            _fills.pop(self.local_path)
+        current = asyncio.current_task()
+        for task in self.tasks:
+            if task is not current:
+                task.cancel()
+
+    def _write(self, fd: int, chunk: bytes, pos: int) -> None:
+        """Runs on the writer thread, which applies writes in submission order."""
+        os.pwrite(fd, chunk, pos)
+        if self.verify and pos <= self.hashed < pos + len(chunk):
+            self.hasher.update(chunk[self.hashed - pos:])
+            self.hashed = pos + len(chunk)
+
+    async def _written(self, writes: deque) -> None:
+        """Publish the completed writes at the head of writes to readers."""
+        while writes and writes[0][2].done():
+            pos, size, future = writes.popleft()
+            future.result()
+            self._add(pos, pos + size)
+            if pos // CHUNK_SIZE != (pos + size) // CHUNK_SIZE:
+                self._persist()
+        await self._notify()
+
+    def _is_complete(self) -> bool:
+        return self.total is not None and (self.total == 0 or self.filled == [[0, self.total]])
+
+    async def _finish(self) -> None:
+        """Verify the complete download against the manifest, then promote or quarantine it."""
+        if self.finishing:
+            return
+        self.finishing = True
+        try:
+            await self._verify_and_promote()
+        finally:
+            self.lock.release()
+
+    async def _verify_and_promote(self) -> None:
+        if self.verify:
+            # Queued behind this fill's writes on the writer thread
+            await (await workers.submit_write(self._catch_up_hash))
+            if not await manifest.verify(self.local_path, self.hasher.hexdigest()):
+                target = quarantine(self.part_path, self.local_path)
+                print(f"integrity: {self.local_path} does not match sha256sums.txt, moved to {target}")
+                if os.path.exists(self.index_path):
+                    os.remove(self.index_path)
+                _fills.pop(self.local_path, None)
+                return
+        self._promote()
+
+    def _catch_up_hash(self) -> None:
+        """Hash the spans that were not written in order (resumed or ranged downloads)."""
+        with open(self.part_path, "rb", buffering=0) as f:
+            while self.hashed < self.total:
+                data = os.pread(f.fileno(), min(CHUNK_SIZE, self.total - self.hashed), self.hashed)
+                if not data:
+                    break
+                self.hasher.update(data)
+                self.hashed += len(data)
+
+    def _promote(self) -> None:
+        if self.complete:
+            return
+        os.replace(self.part_path, self.local_path)
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+        self.complete = True
+        if _fills.get(self.local_path) is self:
+            _fills.pop(self.local_path)
+        if index := index_for(self.local_path):
+            index.add(self.local_path, self.total, self.headers.get("etag"), self.headers.get("last-modified"))
+        if self.local_path.endswith(".br"):
+            variant_store.schedule(self.local_path)
+
+    def present_bytes(self) -> int:
+        return sum(end - start for start, end in self.filled)
+
+    def _first_missing(self) -> int | None:
+        pos = self.filled[0][1] if self.filled and self.filled[0][0] == 0 else 0
+        return pos if pos < self.total else None
+
+    async def fetch_missing(self) -> None:
+        """Download every missing span (no reader needed) and wait for the fill to complete."""
+        while not self.complete:
+            pos = self._first_missing() if self.total is not None else None
+            if pos is None:
+                # Nothing left to request: wait for running downloads and verification
+                if self.tasks:
+                    await asyncio.gather(*list(self.tasks))
+                elif not self.lock.held:
+                    await self._follow()
+                elif self._is_complete():
+                    # Left complete but unverified by a worker that stopped
+                    await self._finish()
+                else:
+                    raise RuntimeError(f"download of {self.local_path} did not complete")
+                continue
+            seg = self._segment_at(pos)
+            if seg is None:
+                if self.obsolete:
+                    raise RuntimeError(f"download of {self.local_path} was dropped")
+                if not self._own():
+                    await self._follow(pos)
+                    continue
+                seg = _Segment(pos, self._span_end(pos, self.total))
+                self._run(seg)
+                self.sweep = 0
+                self._schedule()
+            async with self.cond:
+                await self.cond.wait_for(lambda: self._covered_end(pos) is not None or seg.done)
+            if seg.error is not None and self._covered_end(pos) is None:
+                raise RuntimeError(f"upstream download of {self.local_path} failed") from seg.error
+
+    async def read(self, start: int, end: int | None, need_decompress: bool):
+        """
+        Yield bytes start..end (inclusive, None for the whole asset), fetching missing
+        spans upstream and waiting for in-flight ones.
+        """
+        decompressor = brotli.Decompressor() if need_decompress else None
+        pos = start
+        try:
+            f = open(self.local_path if self.complete else self.part_path, "rb", buffering=0)
+        except FileNotFoundError:
+            # Promoted by another worker since it was last synced
+            f = open(self.local_path, "rb", buffering=0)
+        with f:
+            while True:
+                stop = end + 1 if end is not None else self.total
+                if stop is not None and pos >= stop:
+                    return
+                covered = self._covered_end(pos)
+                if covered is not None:
+                    # pread, not a buffered read: read-ahead could return not-yet-written bytes
+                    chunk = os.pread(f.fileno(), min(covered if stop is None else min(covered, stop), pos + READ_SIZE) - pos, pos)
+                    pos += len(chunk)
+                    yield await workers.decompress(decompressor.process, chunk) if decompressor else chunk
+                    continue
+
+                seg = self._segment_at(pos)
+                if seg is None:
+                    if stop is None or self.obsolete:
+                        raise RuntimeError(f"upstream download of {self.local_path} failed")
+                    if not self._own():
+                        await self._follow(pos)
+                        continue
+                    seg = _Segment(pos, self._span_end(pos, stop))
+                    self._run(seg)
+                    if stop == self.total:
+                        # Read to the end: fetch what follows in parallel segments too
+                        self.sweep = pos if self.sweep is None else min(self.sweep, pos)
+                        self._schedule()
+                async with self.cond:
+                    await self.cond.wait_for(lambda: self._covered_end(pos) is not None or seg.done)
+                if seg.error is not None and self._covered_end(pos) is None:
+                    raise RuntimeError(f"upstream download of {self.local_path} failed") from seg.error
+
+
+class _ZeroCopyFileResponse(Response):
+    """
+    Sends a file response with the ASGI zero-copy send extension when the server
+    offers it (`--sendfile`, see additions/sendfile.py), so the kernel copies the
+    file to the socket, for whole and single-range GETs. Otherwise the wrapped
+    FileResponse is sent as usual.
+    """
+
+    def __init__(self, response: FileResponse):
+        self.response = response
+        self.background = None
+
+    @property
+    def status_code(self) -> int:
+        return self.response.status_code
+
+    @property
+    def headers(self):
+        return self.response.headers
+
+    async def __call__(self, scope, receive, send) -> None:
+        request_headers = Headers(scope=scope)
+        if (
+            ZERO_COPY_SEND in scope.get("extensions", {})
+            and scope["method"] == "GET"
+            and "if-range" not in request_headers
+        ):
+            await self._send_zero_copy(send, request_headers.get("range"))
+        else:
+            await self.response(scope, receive, send)
+        if self.background is not None:
+            await self.background()
+
+    async def _send_zero_copy(self, send, range_header: str | None) -> None:
+        total = self.response.stat_result.st_size
+        headers = MutableHeaders(raw=list(self.response.raw_headers))
+        start, end, status = 0, total - 1, 200
+        byte_range = _parse_range(range_header, total) if total else None
+        if byte_range is False:
+            headers["content-range"] = f"bytes */{total}"
+            headers["content-length"] = "0"
+            await send({"type": "http.response.start", "status": 416, "headers": headers.raw})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        if byte_range is not None:
+            start, end = byte_range
+            status = 206
+            headers["content-range"] = f"bytes {start}-{end}/{total}"
+        headers["content-length"] = str(end - start + 1)
+
+        with open(self.response.path, "rb") as f:
+            await send({"type": "http.response.start", "status": status, "headers": headers.raw})
+            if total:
+                await send({"type": ZERO_COPY_SEND, "file": f, "offset": start, "count": end - start + 1})
+            else:
+                await send({"type": "http.response.body", "body": b""})
+
+
+class _PinnedResponse(Response):
+    """Wraps a cached-file response so the file cannot be evicted while it is being sent."""
+
+    def __init__(self, response: Response, index: CacheIndex, local_path: str):
+        self.response = response
+        self.index = index
+        self.local_path = local_path
+        self.background = None
+
+    @property
+    def status_code(self) -> int:
+        return self.response.status_code
+
+    @property
+    def headers(self):
+        return self.response.headers
+
+    async def __call__(self, scope, receive, send) -> None:
+        self.index.pin(self.local_path)
+        try:
+            await self.response(scope, receive, send)
+        finally:
+            self.index.unpin(self.local_path)
+        if self.background is not None:
+            await self.background()
+
+
+def _pinned(response: Response, local_path: str) -> Response:
+    """Pin a cached file while response sends it, if its directory is indexed."""
+    if (index := index_for(local_path)) is None:
+        return response
+    return _PinnedResponse(response, index, local_path)
+
+
+# Partially downloaded assets, keyed by local_path
+_fills: dict[str, _Fill] = {}
+
+# Cache entries being revalidated with upstream, keyed by local_path
+_revalidations: dict[str, asyncio.Task] = {}
+
+_CONDITIONAL_HEADERS = ("if-range", "if-none-match", "if-modified-since", "if-match", "if-unmodified-since")
+
+def _entry_validators(entry) -> dict | None:
+    """Upstream ETag/Last-Modified of a cache entry, sent in place of file-derived ones."""
+    if entry is None:
+        return None
+    validators = {}
+    if entry.etag:
+        validators["ETag"] = entry.etag
+    if entry.last_modified:
+        validators["Last-Modified"] = entry.last_modified
+    return validators
+
+def _schedule_revalidation(index: CacheIndex, url: str, local_path: str) -> None:
+    if local_path in _revalidations or local_path in _fills:
+        return
+    task = asyncio.create_task(_revalidate(index, url, local_path))
+    _revalidations[local_path] = task
+    task.add_done_callback(lambda _: _revalidations.pop(local_path, None))
+
+async def _revalidate(index: CacheIndex, url: str, local_path: str) -> None:
+    """
+    Conditional GET of a stale entry. A 304 only refreshes its validation time; a 200
+    is downloaded as a new fill that replaces the cached file once complete, while
+    the old copy keeps being served.
+    """
+    entry = index.get(local_path)
+    if entry is None:
+        return
+    headers = {}
+    if entry.etag:
+        headers["If-None-Match"] = entry.etag
+    # Without upstream validators, our copy is at least as recent as its mtime
+    headers["If-Modified-Since"] = entry.last_modified or formatdate(os.path.getmtime(local_path), usegmt=True)
+
+    try:
+        r = await upstream.send("GET", url, headers)
+    except Exception as e:
+        print(f"cache: could not revalidate {local_path}: {e}")
+        return
+
+    if r.status_code == 200 and local_path not in _fills:
+        fill = _fills[local_path] = _Fill(local_path)
+        fill.remember(url, {})
+        fill.pending = True
+        fill.revalidation = True
+        # Not _own(): the cached file must not be taken for a completed download
+        if fill.lock.acquire() and fill.start(r):
+            return
+        fill.abandon()
+    elif r.status_code == 304:
+        index.validated(local_path)
+    await upstream.release(r)
+
+def _response_headers(r) -> dict:
+    excluded_headers = {"transfer-encoding", "connection", "keep-alive", "upgrade", "content-security-policy"}
+    response_headers = {k: v for k, v in r.headers.items() if k.lower() not in excluded_headers}
+    response_headers["Cross-Origin-Opener-Policy"] = "same-origin"
+    response_headers["Cross-Origin-Embedder-Policy"] = "require-corp"
+    return response_headers
+
+def _strip_encoding_headers(response_headers: dict) -> dict:
+    """Drop headers that no longer hold once the body is decompressed."""
+    return {k: v for k, v in response_headers.items() if k.lower() not in ("content-encoding", "content-length")}
+
 async def proxy_and_cache(request: Request, url: str, local_path: str = None, disable_cache: bool = False):
     """
     Proxy request to upstream URL and optionally cache the response.
+
+    With caching, concurrent requests for the same local_path share upstream downloads,
+    and Range requests are answered from the bytes already cached, fetching only the
+    missing spans.
     
     Args:
         request: FastAPI request object
@@ -85,85 +1073,182 @@ async def proxy_and_cache(request: Request, url: str, local_path: str = None, di
         local_path: Local file path for caching (required if disable_cache is False)
         disable_cache: If True, just proxy without caching or reading from local file
     """
+    route = metrics.route_of(request.scope["path"])
     if not disable_cache and local_path:
-        if response := get_local_file(local_path, request):
-            return response
+        # The index answers "is it cached?" without touching the filesystem on misses;
+        # files another worker cached meanwhile are adopted on the fill path
+        index = index_for(local_path)
+        if index is None or index.contains(local_path):
+            validators = _entry_validators(index.get(local_path)) if index is not None else None
+            if response := get_local_file(local_path, request, validators):
+                if index is not None:
+                    index.touch(local_path)
+                    if index.is_stale(local_path):
+                        # Serve the stale copy now, refresh it in the background
+                        _schedule_revalidation(index, url, local_path)
+                    response = _PinnedResponse(response, index, local_path)
+                metrics.cache_requests.inc(route, "hit")
+                return response
+            if index is not None:
+                index.remove(local_path)
     
     # Check if this is a .br file and client doesn't support brotli
     is_br_file = url.endswith(".br")
     client_accepts_br = _client_accepts_brotli(request)
     need_decompress = is_br_file and not client_accepts_br
     
-    client = httpx.AsyncClient(timeout=None)
     headers = {k: v for k, v in request.headers.items() if k.lower() not in ["host", "content-length", "accept-encoding"]}
-    
-    req = client.build_request(request.method, url, headers=headers)
-    r = await client.send(req, stream=True)
-    
-    excluded_headers = {"transfer-encoding", "connection", "keep-alive", "upgrade", "content-security-policy"}
-    response_headers = {k: v for k, v in r.headers.items() if k.lower() not in excluded_headers}
-    response_headers["Cross-Origin-Opener-Policy"] = "same-origin"
-    response_headers["Cross-Origin-Embedder-Policy"] = "require-corp"
-    
-    # If decompressing, remove content-encoding from response
     if need_decompress:
-        response_headers.pop("content-encoding", None)
-        response_headers.pop("Content-Encoding", None)
-        # Also remove content-length since it will change after decompression
-        response_headers.pop("content-length", None)
-        response_headers.pop("Content-Length", None)
-    
-    if r.status_code != 200 or disable_cache or not local_path:
-        async def stream_with_decompress():
-            decompressor = brotli.Decompressor() if need_decompress else None
-            try:
-                async for chunk in r.aiter_raw():
-                    if decompressor:
-                        yield decompressor.process(chunk)
-                    else:
-                        yield chunk
-            finally:
-                await r.aclose()
-                await client.aclose()
-        
-        return StreamingResponse(
-            stream_with_decompress(),
-            status_code=r.status_code,
-            headers=response_headers
-        )
+        # A byte range of the compressed asset cannot be decompressed on its own
+        headers.pop("range", None)
 
-    os.makedirs(os.path.dirname(local_path), exist_ok=True)
-    
-    temp_file = tempfile.NamedTemporaryFile(delete=False, dir=os.path.dirname(local_path))
-    temp_file_path = temp_file.name
-    
-    async def iterate_and_save():
-        success = False
+    fill = None
+    # An asset that failed verification lately is proxied rather than downloaded into
+    # the cache (and quarantined) once more
+    if not disable_cache and local_path and request.method == "GET" and (
+        local_path in _fills or not (manifest.enabled and quarantined_recently(local_path))
+    ):
+        fill = _fills.get(local_path)
+        if fill is None:
+            fill = _fills[local_path] = _Fill(local_path)
+        fill.remember(url, headers)
+        if fill.ready.is_set():
+            metrics.cache_requests.inc(route, "hit" if fill.complete else "miss")
+            return _fill_response(fill, request, need_decompress)
+        if fill.pending:
+            await fill.ready.wait()
+            if fill.complete and (response := get_local_file(local_path, request)):
+                metrics.cache_requests.inc(route, "hit")
+                return _pinned(response, local_path)
+            if fill.headers is not None:
+                metrics.cache_requests.inc(route, "miss")
+                return _fill_response(fill, request, need_decompress)
+            fill = None
+        else:
+            fill.pending = True
+            if not await fill.claim():
+                # Another worker process downloaded it or is downloading it
+                if fill.complete and (response := get_local_file(local_path, request)):
+                    metrics.cache_requests.inc(route, "hit")
+                    return _pinned(response, local_path)
+                metrics.cache_requests.inc(route, "miss")
+                return _fill_response(fill, request, need_decompress)
+            # The cache needs the full body: the client's validators are checked locally
+            headers = {k: v for k, v in headers.items() if k not in _CONDITIONAL_HEADERS}
+            # Widen a first-contact range to whole chunks so they land in the index
+            if match := re.fullmatch(r"bytes=(\d+)-(\d+)", headers.get("range", "")):
+                start = int(match.group(1)) // CHUNK_SIZE * CHUNK_SIZE
+                end = (int(match.group(2)) // CHUNK_SIZE + 1) * CHUNK_SIZE - 1
+                headers = dict(headers, range=f"bytes={start}-{end}")
+
+    try:
+        r = await upstream.send(request.method, url, headers)
+    except BaseException:
+        if fill is not None:
+            fill.abandon()
+        raise
+
+    if fill is not None:
+        metrics.cache_requests.inc(route, "miss")
+        if fill.start(r):
+            return _fill_response(fill, request, need_decompress)
+        fill.abandon()
+    else:
+        metrics.cache_requests.inc(route, "bypass")
+
+    response_headers = _response_headers(r)
+    # If decompressing, remove content-encoding and content-length from response
+    if need_decompress:
+        response_headers = _strip_encoding_headers(response_headers)
+
+    async def stream_with_decompress():
         decompressor = brotli.Decompressor() if need_decompress else None
         try:
             async for chunk in r.aiter_raw():
-                # Always save raw (compressed) data to cache
-                temp_file.write(chunk)
-                # Yield decompressed data if needed
                 if decompressor:
-                    yield decompressor.process(chunk)
+                    yield await workers.decompress(decompressor.process, chunk)
                 else:
                     yield chunk
-            temp_file.close()
-            
-            # If we reached here, the stream was fully consumed
-            shutil.move(temp_file_path, local_path)
-            success = True
         finally:
-            if not success:
-                temp_file.close()
-                if os.path.exists(temp_file_path):
-                    os.remove(temp_file_path)
-            await r.aclose()
-            await client.aclose()
-
+            await upstream.release(r)
+    
     return StreamingResponse(
-        iterate_and_save(),
+        stream_with_decompress(),
         status_code=r.status_code,
         headers=response_headers
     )
+
+async def prefetch(url: str, local_path: str, on_resume=None) -> None:
+    """
+    Download url into the cache at local_path without a client, as a cache miss would:
+    resuming a partial download, sharing in-flight ones and verifying the result.
+
+    Args:
+        on_resume: Called with the bytes already present, before anything is fetched
+    """
+    fill = _fills.get(local_path)
+    if fill is None:
+        fill = _fills[local_path] = _Fill(local_path)
+    if on_resume is not None:
+        on_resume(fill.present_bytes())
+    fill.remember(url, {})
+    if not fill.ready.is_set():
+        if fill.pending:
+            await fill.ready.wait()
+            if fill.headers is None and not fill.complete:
+                raise RuntimeError(f"could not download {url}")
+        else:
+            fill.pending = True
+            if await fill.claim():
+                try:
+                    r = await upstream.send("GET", url, {})
+                except BaseException:
+                    fill.abandon()
+                    raise
+                if not fill.start(r):
+                    fill.abandon()
+                    await upstream.release(r)
+                    raise RuntimeError(f"could not download {url}: HTTP {r.status_code}")
+    await fill.fetch_missing()
+
+def fill_progress(local_path: str) -> tuple[int, int | None] | None:
+    """(bytes present, total size) of an in-progress download, or None if there is none."""
+    fill = _fills.get(local_path)
+    if fill is None or fill.headers is None:
+        return None
+    return fill.present_bytes(), fill.total
+
+def _fill_response(fill: _Fill, request: Request, need_decompress: bool) -> Response:
+    """Answer a GET, whole or ranged, from a shared (possibly partial) download."""
+    response_headers = dict(fill.headers)
+    if fill.local_path.endswith(".br"):
+        response_headers["Vary"] = "Accept-Encoding"
+    if need_decompress:
+        # Upstream validators describe the brotli body, not the decompressed one
+        response_headers = {k: v for k, v in response_headers.items() if k.lower() not in ("etag", "last-modified")}
+    elif _is_not_modified(request.headers, response_headers):
+        return _not_modified(response_headers)
+    if need_decompress:
+        return StreamingResponse(
+            fill.read(0, None, need_decompress),
+            status_code=200,
+            headers=_strip_encoding_headers(response_headers)
+        )
+
+    if fill.total is None:
+        # Size not known yet: no ranges until the first download completes
+        return StreamingResponse(fill.read(0, None, False), status_code=200, headers=response_headers)
+
+    response_headers["Accept-Ranges"] = "bytes"
+    byte_range = _parse_range(request.headers.get("range"), fill.total)
+    if byte_range is False:
+        response_headers["Content-Range"] = f"bytes */{fill.total}"
+        return Response(status_code=416, headers=response_headers)
+    if byte_range is None:
+        response_headers["Content-Length"] = str(fill.total)
+        return StreamingResponse(fill.read(0, None, False), status_code=200, headers=response_headers)
+
+    start, end = byte_range
+    response_headers["Content-Range"] = f"bytes {start}-{end}/{fill.total}"
+    response_headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(fill.read(start, end, False), status_code=206, headers=response_headers)
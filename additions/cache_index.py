@@ -0,0 +1,411 @@
+import os
+import time
+import sqlite3
+from stat import S_ISREG
+from additions.variants import VARIANTS_DIR, ENCODING_SUFFIXES
+
+INDEX_FILE = ".index.sqlite3"
+
+# Seconds between two write-behind flushes of access statistics to SQLite
+FLUSH_INTERVAL = 5.0
+
+EVICTION_POLICIES = ("lru", "lfu")
+
+# Seconds a worker waits for another one holding the SQLite write lock
+BUSY_TIMEOUT = 30.0
+
+
+# Columns added after the first release of the index, with their SQL definitions
+_MIGRATIONS = {
+    "etag": "TEXT",
+    "last_modified": "TEXT",
+    "validated_at": "REAL NOT NULL DEFAULT 0",
+    "variants": "INTEGER NOT NULL DEFAULT 0",
+}
+
+_COLUMNS = "path, size, last_access, hits, etag, last_modified, validated_at, variants"
+_UPSERT = f"INSERT OR REPLACE INTO entries ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class _Entry:
+    __slots__ = ("size", "last_access", "hits", "etag", "last_modified", "validated_at", "variants")
+
+    def __init__(
+        self,
+        size: int,
+        last_access: float,
+        hits: int = 0,
+        etag: str | None = None,
+        last_modified: str | None = None,
+        validated_at: float = 0.0,
+        variants: int = 0,
+    ):
+        self.size = size
+        self.last_access = last_access
+        self.hits = hits
+        # Upstream validators, used for our own responses and to revalidate with the CDN
+        self.etag = etag
+        self.last_modified = last_modified
+        self.validated_at = validated_at or last_access
+        # Bytes of the decompressed/gzip/zstd copies under .variants/, evicted with the entry
+        self.variants = variants
+
+    @property
+    def disk_size(self) -> int:
+        return self.size + self.variants
+
+    def row(self, path: str) -> tuple:
+        return (path, self.size, self.last_access, self.hits, self.etag, self.last_modified, self.validated_at, self.variants)
+
+
+class CacheIndex:
+    """
+    Size-bounded index of one cache directory (`vcsky/` or `vcbr/`).
+
+    Size, last access time and hit count of every cached file are kept in memory,
+    so "is this cached?" needs no filesystem call, and persisted to a SQLite file in
+    the directory with write-behind batching. The index is reconciled with the
+    directory at startup, by one of the worker processes sharing it; the others
+    load it. The variants built from an entry count against its size.
+
+    The budget is enforced on the shared SQLite table, so it covers the files every
+    worker cached: when the directory grows past `max_bytes`, entries are evicted by
+    LRU or LFU. Files currently being streamed by any worker are pinned in the
+    table and never evicted.
+    """
+
+    def __init__(self, root: str, max_bytes: int = 0, policy: str = "lru", revalidate_after: float = 0):
+        if policy not in EVICTION_POLICIES:
+            raise ValueError(f"unknown eviction policy {policy!r}")
+        self.root = root
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.revalidate_after = revalidate_after
+        self.entries: dict[str, _Entry] = {}
+        self.size = 0
+        self.pins: dict[str, int] = {}
+        self.evictions = 0
+        self._dirty = set()
+        self._flushed = time.monotonic()
+        os.makedirs(root, exist_ok=True)
+        # Worker processes share the file: wait for each other's writes instead of failing
+        self.db = sqlite3.connect(os.path.join(root, INDEX_FILE), timeout=BUSY_TIMEOUT)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # Pins are written on every first stream of a file: no fsync per commit
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self._migrate()
+
+    def _migrate(self) -> None:
+        """Create or upgrade the schema, once even when several workers start together."""
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "path TEXT PRIMARY KEY, size INTEGER NOT NULL, last_access REAL NOT NULL, hits INTEGER NOT NULL)"
+            )
+            # Files being streamed, by process: see pin()
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS pins (path TEXT NOT NULL, pid INTEGER NOT NULL, PRIMARY KEY (path, pid))"
+            )
+            columns = {row[1] for row in self.db.execute("PRAGMA table_info(entries)")}
+            for column, definition in _MIGRATIONS.items():
+                if column in columns:
+                    continue
+                try:
+                    self.db.execute(f"ALTER TABLE entries ADD COLUMN {column} {definition}")
+                except sqlite3.OperationalError as e:
+                    # Added by another worker meanwhile
+                    if "duplicate column" not in str(e):
+                        raise
+        except BaseException:
+            self.db.rollback()
+            raise
+        self.db.commit()
+
+    def load(self) -> None:
+        """Load the persisted index as it is, e.g. as reconciled by another worker."""
+        self.entries = {row[0]: _Entry(*row[1:]) for row in self.db.execute(f"SELECT {_COLUMNS} FROM entries")}
+        self.size = sum(entry.disk_size for entry in self.entries.values())
+        self._dirty.clear()
+
+    def rebuild(self) -> None:
+        """Load the persisted index and reconcile it with the files actually on disk."""
+        rows = {row[0]: _Entry(*row[1:]) for row in self.db.execute(f"SELECT {_COLUMNS} FROM entries")}
+        self.entries = {}
+        self.size = 0
+        for dirpath, dirs, names in os.walk(self.root):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for name in names:
+                if name.startswith(".") or name.endswith((".part", ".part.json", ".tmp", ".lock")):
+                    continue
+                path = os.path.join(dirpath, name)
+                stat = os.stat(path)
+                entry = rows.get(path)
+                if entry is None or entry.size != stat.st_size:
+                    entry = _Entry(stat.st_size, stat.st_mtime)
+                self.entries[path] = entry
+        for path, entry in self.entries.items():
+            entry.variants = self._variants_size(path)
+            self.size += entry.disk_size
+        self._remove_orphan_variants()
+
+        with self.db:
+            self.db.execute("DELETE FROM entries")
+            self.db.executemany(_UPSERT, [e.row(path) for path, e in self.entries.items()])
+            # Left by processes that exited while streaming
+            pids = {pid for (pid,) in self.db.execute("SELECT DISTINCT pid FROM pins")}
+            self.db.executemany("DELETE FROM pins WHERE pid = ?", [(pid,) for pid in pids if not _alive(pid)])
+        self._dirty.clear()
+        self.evict()
+
+    def _variants_size(self, path: str) -> int:
+        size = 0
+        for variant in _variant_paths(path):
+            try:
+                size += os.stat(variant).st_size
+            except OSError:
+                pass
+        return size
+
+    def _remove_orphan_variants(self) -> None:
+        """Delete variants whose source is no longer cached, so they cannot escape the budget."""
+        owned = {variant for path in self.entries for variant in _variant_paths(path)}
+        for dirpath, dirs, names in os.walk(self.root):
+            if os.path.basename(dirpath) != VARIANTS_DIR:
+                continue
+            for name in names:
+                path = os.path.join(dirpath, name)
+                if path not in owned and not name.endswith(".tmp"):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+
+    def contains(self, path: str) -> bool:
+        return path in self.entries
+
+    def get(self, path: str) -> _Entry | None:
+        return self.entries.get(path)
+
+    def is_stale(self, path: str) -> bool:
+        """Whether the entry is due for a revalidation with upstream."""
+        entry = self.entries.get(path)
+        return (
+            entry is not None and self.revalidate_after > 0
+            and time.time() - entry.validated_at > self.revalidate_after
+        )
+
+    def validated(self, path: str) -> None:
+        """Record that upstream confirmed the entry is unchanged."""
+        entry = self.entries.get(path)
+        if entry is not None:
+            entry.validated_at = time.time()
+            self._dirty.add(path)
+
+    def touch(self, path: str) -> None:
+        """Record a cache hit."""
+        entry = self.entries.get(path)
+        if entry is None:
+            return
+        entry.last_access = time.time()
+        entry.hits += 1
+        self._dirty.add(path)
+        if time.monotonic() - self._flushed > FLUSH_INTERVAL:
+            self.flush()
+
+    def add(self, path: str, size: int, etag: str | None = None, last_modified: str | None = None) -> None:
+        """Record a file that was just written into the cache, evicting others if needed."""
+        previous = self.entries.get(path)
+        entry = self.entries[path] = _Entry(size, time.time(), etag=etag, last_modified=last_modified)
+        if previous is not None:
+            self.size -= previous.disk_size
+            # Its variants stay on disk until they are rebuilt from the new file
+            entry.variants = previous.variants
+        self.size += entry.disk_size
+        # Written now: other worker processes read it back in adopt(), and evict() budgets it
+        with self.db:
+            self.db.execute(_UPSERT, entry.row(path))
+        self._dirty.discard(path)
+        self.evict(keep=path)
+
+    def add_variants(self, path: str) -> None:
+        """Count the variants just built from a cached file, evicting others if needed."""
+        entry = self.entries.get(path)
+        if entry is None:
+            return
+        variants = self._variants_size(path)
+        self.size += variants - entry.variants
+        entry.variants = variants
+        self._dirty.add(path)
+        self.evict(keep=path)
+
+    def adopt(self, path: str) -> bool:
+        """
+        Pick up a file another worker process cached after this index was loaded.
+
+        Returns:
+            Whether path is now in the index.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if not S_ISREG(stat.st_mode):
+            return False
+        row = self.db.execute("SELECT etag, last_modified FROM entries WHERE path = ? AND size = ?", (path, stat.st_size)).fetchone()
+        etag, last_modified = row if row is not None else (None, None)
+        self.add(path, stat.st_size, etag, last_modified)
+        self.add_variants(path)
+        return True
+
+    def remove(self, path: str) -> None:
+        """Forget a file that disappeared from the cache."""
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.size -= entry.disk_size
+            self._dirty.add(path)
+
+    def pin(self, path: str) -> None:
+        """Protect path from eviction, by any worker, until unpin()."""
+        count = self.pins[path] = self.pins.get(path, 0) + 1
+        if count == 1:
+            with self.db:
+                self.db.execute("INSERT OR IGNORE INTO pins (path, pid) VALUES (?, ?)", (path, os.getpid()))
+
+    def unpin(self, path: str) -> None:
+        count = self.pins.get(path, 0) - 1
+        if count > 0:
+            self.pins[path] = count
+            return
+        self.pins.pop(path, None)
+        with self.db:
+            self.db.execute("DELETE FROM pins WHERE path = ? AND pid = ?", (path, os.getpid()))
+
+    def evict(self, keep: str = None) -> None:
+        """
+        Delete least recently (LRU) or least frequently (LFU) used files until the
+        directory, as recorded by every worker, is under budget.
+        """
+        if not self.max_bytes:
+            return
+        self.flush()
+        order = "hits, last_access" if self.policy == "lfu" else "last_access"
+        # One evicting worker at a time; pins taken meanwhile wait for it
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            (total,) = self.db.execute("SELECT COALESCE(SUM(size + variants), 0) FROM entries").fetchone()
+            if total > self.max_bytes:
+                pinned = {path for path, pid in self.db.execute("SELECT path, pid FROM pins") if _alive(pid)}
+                candidates = self.db.execute(f"SELECT path, size + variants FROM entries ORDER BY {order}").fetchall()
+                for path, size in candidates:
+                    if total <= self.max_bytes:
+                        break
+                    if path == keep or path in pinned:
+                        continue
+                    self._delete(path)
+                    self.db.execute("DELETE FROM entries WHERE path = ?", (path,))
+                    total -= size
+                    if (entry := self.entries.pop(path, None)) is not None:
+                        self.size -= entry.disk_size
+                    self._dirty.discard(path)
+                    self.evictions += 1
+        except BaseException:
+            self.db.rollback()
+            raise
+        self.db.commit()
+
+    def _delete(self, path: str) -> None:
+        for victim in [path, *_variant_paths(path)]:
+            try:
+                os.remove(victim)
+            except FileNotFoundError:
+                pass
+
+    def flush(self) -> None:
+        """Write pending changes to SQLite in a single transaction."""
+        self._flushed = time.monotonic()
+        if not self._dirty:
+            return
+        with self.db:
+            for path in self._dirty:
+                entry = self.entries.get(path)
+                if entry is None:
+                    self.db.execute("DELETE FROM entries WHERE path = ?", (path,))
+                else:
+                    # Only rows still there: another worker may have evicted the file
+                    self.db.execute(
+                        "UPDATE entries SET last_access = ?, hits = ?, validated_at = ?, variants = ? WHERE path = ?",
+                        (entry.last_access, entry.hits, entry.validated_at, entry.variants, path),
+                    )
+        self._dirty.clear()
+
+    def close(self) -> None:
+        self.flush()
+        self.db.close()
+
+    def stats(self) -> dict:
+        (total,) = self.db.execute("SELECT COALESCE(SUM(size + variants), 0) FROM entries").fetchone()
+        return {
+            "entries": len(self.entries),
+            # Counted against max_bytes: the files of every worker
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "policy": self.policy,
+            "pinned": len(self.pins),
+            "evictions": self.evictions,
+        }
+
+
+def _variant_paths(path: str) -> list[str]:
+    """Where the variants of a cached file are built (see VariantStore.variant_path)."""
+    head, name = os.path.split(path)
+    if not name.endswith(".br"):
+        return []
+    return [os.path.join(head, VARIANTS_DIR, name.removesuffix(".br") + suffix) for suffix in ENCODING_SUFFIXES.values()]
+
+
+# Indexes of the cache directories in use, keyed by directory
+_indexes: dict[str, CacheIndex] = {}
+
+
+def open_index(
+    root: str, max_bytes: int = 0, policy: str = "lru", revalidate_after: float = 0, rebuild: bool = True
+) -> CacheIndex:
+    """
+    Open the index of a cache directory.
+
+    Args:
+        rebuild: Reconcile it with the directory and enforce the budget; False to load
+            it as another worker process left it
+    """
+    index = _indexes[root] = CacheIndex(root, max_bytes, policy, revalidate_after)
+    if rebuild:
+        index.rebuild()
+    else:
+        index.load()
+    return index
+
+
+def index_for(local_path: str) -> CacheIndex | None:
+    """Index of the cache directory local_path belongs to, if that directory is indexed."""
+    return _indexes.get(local_path.split(os.sep, 1)[0])
+
+
+def close_indexes() -> None:
+    for index in _indexes.values():
+        index.close()
+    _indexes.clear()
+
+
+def stats() -> dict:
+    return {root: index.stats() for root, index in _indexes.items()}
@@ -0,0 +1,134 @@
+import os
+import time
+import asyncio
+from additions import upstream
+
+QUARANTINE_DIR = ".quarantine"
+
+# Minimum delay between two refreshes of the manifest triggered by a mismatch
+REFRESH_INTERVAL = 300
+
+# Seconds during which an asset that failed verification is proxied instead of
+# being downloaded into the cache again
+QUARANTINE_BACKOFF = 600
+
+
+def _parse_manifest(text: str) -> tuple[dict, list]:
+    """
+    Parse `sha256sum` output (`<hex>  <name>` per line).
+
+    Returns:
+        ({name: hex}, [listed names in order])
+    """
+    sums = {}
+    names = []
+    for line in text.splitlines():
+        parts = line.strip().split(None, 1)
+        if len(parts) != 2 or len(parts[0]) != 64:
+            continue
+        digest, name = parts[0].lower(), parts[1].lstrip("*").removeprefix("./")
+        sums[name] = digest
+        names.append(name)
+    return sums, names
+
+
+class Manifest:
+    """
+    Server-side copy of the upstream `sha256sums.txt`, used to verify cache fills.
+
+    The manifest is kept on disk next to the cache and fetched from upstream when
+    missing, or again (rate-limited) when a downloaded file does not match it.
+    Assets it does not list are not verified.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.url = None
+        self.local_path = None
+        self.sums = {}
+        self.names = []
+        self._refreshed = 0.0
+        self._lock = asyncio.Lock()
+
+    def configure(self, enabled: bool, url: str = None, local_path: str = None) -> None:
+        self.enabled = enabled
+        self.url = url
+        self.local_path = local_path
+
+    async def load(self) -> None:
+        """Read the local copy, fetching it from upstream if there is none."""
+        if not self.enabled:
+            return
+        if self.local_path and os.path.isfile(self.local_path):
+            with open(self.local_path, "r", encoding="utf-8", errors="replace") as f:
+                self.sums, self.names = _parse_manifest(f.read())
+            return
+        await self.refresh()
+
+    async def refresh(self) -> bool:
+        """Fetch the manifest again. Returns False if it was refreshed too recently or failed."""
+        async with self._lock:
+            if time.monotonic() - self._refreshed < REFRESH_INTERVAL and self.sums:
+                return False
+            self._refreshed = time.monotonic()
+            try:
+                r = await upstream.get_client().get(self.url)
+            except Exception as e:
+                print(f"integrity: could not fetch {self.url}: {e}")
+                return False
+            if r.status_code != 200:
+                print(f"integrity: could not fetch {self.url}: HTTP {r.status_code}")
+                return False
+
+            self.sums, self.names = _parse_manifest(r.text)
+            if self.local_path:
+                os.makedirs(os.path.dirname(self.local_path), exist_ok=True)
+                tmp_path = f"{self.local_path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(r.content)
+                os.replace(tmp_path, self.local_path)
+            return True
+
+    def expected(self, local_path: str) -> str | None:
+        """Expected hex digest for a cache path like `vcsky/<name>`, if the manifest lists that exact name."""
+        if not self.enabled:
+            return None
+        return self.sums.get(local_path.replace(os.sep, "/").split("/", 1)[-1])
+
+    async def verify(self, local_path: str, digest: str) -> bool:
+        """Check a computed digest, refreshing the manifest once in case upstream changed."""
+        expected = self.expected(local_path)
+        if expected is None or expected == digest:
+            return True
+        if await self.refresh():
+            expected = self.expected(local_path)
+            return expected is None or expected == digest
+        return False
+
+
+def _quarantine_path(local_path: str) -> str:
+    head, name = os.path.split(local_path)
+    return os.path.join(head, QUARANTINE_DIR, name)
+
+
+def quarantine(path: str, local_path: str) -> str:
+    """
+    Move a download that failed verification aside instead of promoting it. Only
+    the latest copy of each asset is kept; its mtime records when it failed.
+    """
+    target = _quarantine_path(local_path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.replace(path, target)
+    os.utime(target)
+    return target
+
+
+def quarantined_recently(local_path: str) -> bool:
+    """Whether local_path failed verification less than QUARANTINE_BACKOFF seconds ago."""
+    try:
+        return time.time() - os.stat(_quarantine_path(local_path)).st_mtime < QUARANTINE_BACKOFF
+    except OSError:
+        return False
+
+
+manifest = Manifest()
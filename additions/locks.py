@@ -0,0 +1,51 @@
+import os
+
+try:
+    import fcntl
+except ImportError:  # no flock (Windows): locks always succeed, run a single worker
+    fcntl = None
+
+LOCK_SUFFIX = ".lock"
+
+
+class FileLock:
+    """
+    Non-blocking exclusive lock shared by every worker process using the same cache
+    directory, backed by flock(2) on a `.lock` file next to the locked path.
+
+    The lock is tied to the open file, so it is released when the holder closes it
+    or its process dies; lock files are left in place, removing them would race with
+    other processes opening them.
+    """
+
+    def __init__(self, path: str):
+        self.path = path + LOCK_SUFFIX
+        self.fd = None
+
+    @property
+    def held(self) -> bool:
+        return self.fd is not None
+
+    def acquire(self) -> bool:
+        """Take the lock if no other holder has it. Returns whether it is held."""
+        if self.fd is not None:
+            return True
+        if fcntl is None:
+            self.fd = -1
+            return True
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self.fd = fd
+        return True
+
+    def release(self) -> None:
+        if self.fd is None:
+            return
+        if self.fd >= 0:
+            os.close(self.fd)
+        self.fd = None
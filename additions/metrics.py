@@ -0,0 +1,296 @@
+import os
+import json
+import bisect
+import asyncio
+from time import perf_counter
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds: upstream latencies run from milliseconds to whole-file downloads
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Seconds: single decompression or disk-write jobs on the worker threads
+JOB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+# Directory shared by the --workers processes, where each one publishes its metrics
+METRICS_DIR_ENV = "REVCDOS_METRICS_DIR"
+# Seconds between two publications of a worker's metrics
+SHARE_INTERVAL = 5.0
+
+
+def route_of(path: str) -> str:
+    """Route label of a request path: /vcsky, /vcbr, /saves/*, / (page and dist/ files) or internal."""
+    if path.startswith("/api/"):
+        path = path[4:]
+    if path.startswith("/vcsky/"):
+        return "/vcsky"
+    if path.startswith("/vcbr/"):
+        return "/vcbr"
+    if path.startswith(("/saves/", "/token/")):
+        return "/saves/*"
+    if path.startswith(("/_stats/", "/metrics")):
+        return "internal"
+    return "/"
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def snapshot(self) -> dict:
+        """Current values, {labels: value}."""
+        return dict(self.values)
+
+    def merge(self, snapshots: list[dict]) -> dict:
+        """Values of several processes combined: summed by default."""
+        merged = {}
+        for values in snapshots:
+            for labels, value in values.items():
+                merged[labels] = merged.get(labels, 0) + value
+        return merged
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        super().__init__(name, help, labels)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self, values: dict) -> list[str]:
+        return self.header() + [f"{self.name}{_labels(self.labels, k)} {v}" for k, v in sorted(values.items())]
+
+
+class Gauge(_Metric):
+    """
+    A value read when scraped, from `read()` (returning {labels: value}) or `inc`/`dec`.
+    Across worker processes, the values of the live ones are summed, or with
+    `aggregate="max"` the largest is kept.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), read=None, aggregate: str = "sum"):
+        super().__init__(name, help, labels)
+        self.values: dict[tuple, float] = {}
+        self.read = read
+        self.aggregate = aggregate
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+    def snapshot(self) -> dict:
+        return dict(self.read() if self.read is not None else self.values)
+
+    def merge(self, snapshots: list[dict]) -> dict:
+        if self.aggregate != "max":
+            return super().merge(snapshots)
+        merged = {}
+        for values in snapshots:
+            for labels, value in values.items():
+                merged[labels] = max(merged.get(labels, value), value)
+        return merged
+
+    def render(self, values: dict) -> list[str]:
+        return self.header() + [f"{self.name}{_labels(self.labels, k)} {v}" for k, v in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # labels -> [count per bucket (last one is +Inf), sum]
+        self.values: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def snapshot(self) -> dict:
+        return {labels: [list(counts), total] for labels, (counts, total) in self.values.items()}
+
+    def merge(self, snapshots: list[dict]) -> dict:
+        merged = {}
+        for values in snapshots:
+            for labels, (counts, total) in values.items():
+                series = merged.setdefault(labels, [[0] * len(counts), 0.0])
+                series[0] = [a + b for a, b in zip(series[0], counts)]
+                series[1] += total
+        return merged
+
+    def render(self, values: dict) -> list[str]:
+        lines = self.header()
+        for labels, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels((*self.labels, 'le'), (*labels, bound))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Registry:
+    """
+    Metrics of this process, in the Prometheus text format.
+
+    Recording only updates plain dicts on the event loop (worker threads hand their
+    timings back to it), so it costs a few dictionary operations per event; the
+    exposition text is only built when /metrics is scraped.
+
+    With `share`, worker processes publish their values into a common directory
+    (every `SHARE_INTERVAL` seconds and when scraped), and a scrape answers with
+    the sum of every process: counters and histograms of processes that exited are
+    kept, so they never go down; gauges only count live processes.
+    """
+
+    def __init__(self):
+        self.metrics: list[_Metric] = []
+        self.directory = None
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def share(self, directory: str) -> None:
+        """Aggregate the metrics of every process publishing into directory."""
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def publish(self) -> None:
+        """Write this process's values into the shared directory, atomically."""
+        snapshot = {
+            metric.name: [[list(labels), value] for labels, value in metric.snapshot().items()]
+            for metric in self.metrics
+        }
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+        os.replace(path + ".tmp", path)
+
+    async def publish_periodically(self, interval: float = SHARE_INTERVAL) -> None:
+        """Publish until cancelled, then once more so the final values are kept."""
+        try:
+            while True:
+                self.publish()
+                await asyncio.sleep(interval)
+        finally:
+            self.publish()
+
+    def _collect(self) -> dict[str, dict]:
+        """Values of every process that published, merged per metric."""
+        snapshots: dict[str, list[dict]] = {metric.name: [] for metric in self.metrics}
+        for name in os.listdir(self.directory):
+            pid, _, ext = name.partition(".")
+            if ext != "json" or not pid.isdigit():
+                continue
+            try:
+                with open(os.path.join(self.directory, name), "r", encoding="utf-8") as f:
+                    published = json.load(f)
+            except (OSError, ValueError):
+                continue
+            alive = _alive(int(pid))
+            for metric in self.metrics:
+                if metric.kind == "gauge" and not alive:
+                    continue
+                values = published.get(metric.name, [])
+                snapshots[metric.name].append({tuple(labels): value for labels, value in values})
+        return {metric.name: metric.merge(snapshots[metric.name]) for metric in self.metrics}
+
+    def render(self) -> str:
+        if self.directory is not None:
+            self.publish()
+            values = self._collect()
+        else:
+            values = {metric.name: metric.snapshot() for metric in self.metrics}
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render(values[metric.name]))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+requests_total = registry.add(Counter("revcdos_requests_total", "Requests answered, by route and status", ("route", "status")))
+response_bytes = registry.add(Counter("revcdos_response_bytes_total", "Response body bytes sent, by route", ("route",)))
+inflight_requests = registry.add(Gauge("revcdos_inflight_requests", "Requests being answered, by route", ("route",)))
+request_seconds = registry.add(Histogram("revcdos_request_duration_seconds", "Time until the response body was sent, by route", ("route",)))
+cache_requests = registry.add(Counter("revcdos_cache_requests_total", "Proxied requests answered from the cache (hit), through a download into it (miss) or straight from upstream (bypass)", ("route", "result")))
+upstream_connect_seconds = registry.add(Histogram("revcdos_upstream_connect_seconds", "Time to open a new upstream connection, TLS included"))
+upstream_ttfb_seconds = registry.add(Histogram("revcdos_upstream_ttfb_seconds", "Time from sending an upstream request to its response headers"))
+upstream_hedges = registry.add(Counter("revcdos_upstream_hedges_total", "Upstream requests also sent to another mirror because the first was slow to answer"))
+upstream_seconds = registry.add(Histogram("revcdos_upstream_duration_seconds", "Time from sending an upstream request to closing its response"))
+decompress_seconds = registry.add(Histogram("revcdos_decompress_seconds", "Duration of each job of the decompression threads", buckets=JOB_BUCKETS))
+disk_write_seconds = registry.add(Histogram("revcdos_disk_write_seconds", "Duration of each job (write, hash catch-up) of the cache writer thread", buckets=JOB_BUCKETS))
+
+
+class MetricsMiddleware:
+    """Counts requests, statuses, body bytes and durations per route, as a plain ASGI middleware."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = perf_counter()
+        route = route_of(scope["path"])
+        status = 500
+        sent = 0
+
+        async def counting_send(message):
+            nonlocal status, sent
+            kind = message["type"]
+            if kind == "http.response.body":
+                sent += len(message.get("body", b""))
+            elif kind == "http.response.start":
+                status = message["status"]
+            elif kind == "http.response.zerocopysend":
+                sent += message.get("count") or 0
+            await send(message)
+
+        inflight_requests.inc(route)
+        try:
+            await self.app(scope, receive, counting_send)
+        finally:
+            inflight_requests.dec(route)
+            requests_total.inc(route, status)
+            response_bytes.inc(route, amount=sent)
+            request_seconds.observe(perf_counter() - started, route)
@@ -0,0 +1,139 @@
+import time
+
+DEFAULT_HEDGE_AFTER = 1.0
+DEFAULT_MAX_FAILURES = 3
+DEFAULT_COOLDOWN = 30.0
+
+# Weight of the newest sample in the moving averages of TTFB and error rate
+EWMA_WEIGHT = 0.3
+
+
+def parse_mirrors(value: str) -> list[str]:
+    """Split a comma-separated list of base URLs, e.g. `--vcbr_url a/,b/`."""
+    mirrors = [url.strip() for url in value.split(",") if url.strip()]
+    if not mirrors:
+        raise ValueError("expected at least one URL")
+    return mirrors
+
+
+class Mirror:
+    """One base URL of a mirror group, with its recent TTFB and error rate."""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.ttfb: float | None = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    def cooling(self, now: float) -> bool:
+        return now < self.cooldown_until
+
+    def score(self) -> tuple:
+        # Mirrors whose last request failed go last; never measured ones first, so each gets a TTFB
+        if self.ttfb is None:
+            return self.failures > 0, 0.0
+        return self.failures > 0, self.ttfb / max(0.05, 1.0 - self.error_rate)
+
+    def _observe_ttfb(self, seconds: float) -> None:
+        self.ttfb = seconds if self.ttfb is None else self.ttfb + EWMA_WEIGHT * (seconds - self.ttfb)
+
+    def succeeded(self, ttfb: float) -> None:
+        self.requests += 1
+        self._observe_ttfb(ttfb)
+        self.error_rate -= EWMA_WEIGHT * self.error_rate
+        self.failures = 0
+
+    def slower_than(self, seconds: float) -> None:
+        """Record a request given up on after `seconds` without an answer (lost a hedge)."""
+        self._observe_ttfb(max(seconds, self.ttfb or 0.0))
+
+    def failed(self, max_failures: int, cooldown: float) -> None:
+        self.requests += 1
+        self.errors += 1
+        self.error_rate += EWMA_WEIGHT * (1.0 - self.error_rate)
+        self.failures += 1
+        if self.failures >= max_failures:
+            print(f"upstream: {self.base_url} failed {self.failures} times in a row, cooling down for {cooldown:g}s")
+            self.cooldown_until = time.monotonic() + cooldown
+            self.failures = 0
+
+    def stats(self, now: float) -> dict:
+        return {
+            "url": self.base_url,
+            "ttfb": round(self.ttfb, 4) if self.ttfb is not None else None,
+            "error_rate": round(self.error_rate, 3),
+            "requests": self.requests,
+            "errors": self.errors,
+            "cooling_down": self.cooling(now),
+        }
+
+
+class MirrorGroup:
+    """
+    Base URLs serving the same files. URLs are built with the first one; requests
+    are sent to whichever mirror is currently fastest and healthy.
+    """
+
+    def __init__(self, base_urls: list[str]):
+        self.mirrors = [Mirror(url) for url in base_urls]
+
+    @property
+    def primary(self) -> str:
+        return self.mirrors[0].base_url
+
+    def ranked(self) -> list[Mirror]:
+        """Healthy mirrors fastest first, then those cooling down (soonest available first)."""
+        now = time.monotonic()
+        healthy = sorted((m for m in self.mirrors if not m.cooling(now)), key=Mirror.score)
+        cooling = sorted((m for m in self.mirrors if m.cooling(now)), key=lambda m: m.cooldown_until)
+        return healthy + cooling
+
+    def stats(self) -> list[dict]:
+        now = time.monotonic()
+        return [mirror.stats(now) for mirror in self.mirrors]
+
+
+class Mirrors:
+    """Mirror groups of the upstream CDNs and the hedging settings used with them."""
+
+    def __init__(self):
+        self.groups: list[MirrorGroup] = []
+        self.hedge_after = DEFAULT_HEDGE_AFTER
+        self.max_failures = DEFAULT_MAX_FAILURES
+        self.cooldown = DEFAULT_COOLDOWN
+
+    def configure(
+        self,
+        groups: list[list[str]],
+        hedge_after: float = DEFAULT_HEDGE_AFTER,
+        max_failures: int = DEFAULT_MAX_FAILURES,
+        cooldown: float = DEFAULT_COOLDOWN,
+    ) -> None:
+        """
+        Args:
+            groups: Base URLs of each upstream, primary first (e.g. the vcsky ones, the vcbr ones)
+            hedge_after: Seconds without response headers before the same GET is also sent
+                to the next mirror; 0 to only fail over on errors
+            max_failures: Consecutive failures that put a mirror in cooldown
+            cooldown: Seconds a failing mirror is only used when no other one is healthy
+        """
+        self.groups = [MirrorGroup(urls) for urls in groups if len(urls) > 1]
+        self.hedge_after = hedge_after
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+
+    def lookup(self, url: str) -> tuple[MirrorGroup, str] | tuple[None, None]:
+        """The group whose primary base URL starts url, and the rest of url."""
+        for group in self.groups:
+            if url.startswith(group.primary):
+                return group, url[len(group.primary):]
+        return None, None
+
+    def stats(self) -> list[list[dict]]:
+        return [group.stats() for group in self.groups]
+
+
+mirrors = Mirrors()
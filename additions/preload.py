@@ -0,0 +1,126 @@
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+# Build loaded by dist/game.js for each ?lang= value
+DEFAULT_BUILDS = {"en": "vc-sky-en-v6", "ru": "vc-sky-ru-v6"}
+DEFAULT_LANG = "en"
+
+PRELOAD_KINDS = ("wasm", "data", "scripts")
+
+# The data file is hundreds of MB, which returning players already keep in the
+# browser's cache storage: it is only preloaded when asked for
+DEFAULT_PRELOAD_KINDS = ("wasm", "scripts")
+
+# Scripts dist/game.js and dist/index.js load one after the other, in order
+_SCRIPTS = (
+    "/index.js",
+    "/modules/runtime.js",
+    "/modules/packages/{lang}.js",
+    "/modules/loader.js",
+    "/modules/fs.js",
+    "/modules/audio.js",
+    "/modules/graphics.js",
+    "/modules/events.js",
+    "/modules/fetch.js",
+    "/modules/asm_consts/{lang}.js",
+    "/modules/main.js",
+)
+
+
+def parse_builds(value: str) -> dict:
+    """Parse `en=vc-sky-en-v6,ru=vc-sky-ru-v6` into {lang: build}."""
+    builds = {}
+    for item in value.split(","):
+        lang, sep, build = item.strip().partition("=")
+        if not sep or not lang or not build:
+            raise ValueError(f"expected lang=build, got {item!r}")
+        builds[lang.strip()] = build.strip()
+    return builds
+
+
+class Preloader:
+    """
+    `Link: rel=preload` values for the assets the landing page is going to load.
+
+    dist/game.js only discovers the wasm and data of its build after the page and
+    its scripts ran; announcing them with the page (and, where the server supports
+    it, in a `103 Early Hints` response) lets the browser start those downloads a
+    round trip or more earlier.
+    """
+
+    def __init__(self):
+        self.kinds = ()
+        self.builds = dict(DEFAULT_BUILDS)
+        self.default_lang = DEFAULT_LANG
+        self.early_hints = False
+        self._links: dict[str, tuple[str, ...]] = {}
+
+    def configure(self, kinds=DEFAULT_PRELOAD_KINDS, builds: dict = None, default_lang: str = DEFAULT_LANG, early_hints: bool = False) -> None:
+        """
+        Args:
+            kinds: Which of `wasm`, `data` and `scripts` to announce; empty to disable
+            builds: Build served for each language ({lang: build})
+            default_lang: Language used when the page is requested without a known ?lang=
+            early_hints: Also send the links in a 103 response when the server supports it
+        """
+        unknown = set(kinds) - set(PRELOAD_KINDS)
+        if unknown:
+            raise ValueError(f"unknown preload kinds: {', '.join(sorted(unknown))}")
+        self.kinds = tuple(kinds)
+        self.builds = dict(builds or DEFAULT_BUILDS)
+        if default_lang not in self.builds:
+            raise ValueError(f"no build configured for default language {default_lang!r}")
+        self.default_lang = default_lang
+        self.early_hints = early_hints
+        self._links = {lang: self._build_links(lang) for lang in self.builds}
+
+    def _build_links(self, lang: str) -> tuple[str, ...]:
+        build = self.builds[lang]
+        links = []
+        # fetch() requests are CORS-mode, so the preloads need crossorigin to be reused
+        if "wasm" in self.kinds:
+            links.append(f"</vcbr/{build}.wasm.br>; rel=preload; as=fetch; crossorigin")
+        if "data" in self.kinds:
+            links.append(f"</vcbr/{build}.data.br>; rel=preload; as=fetch; crossorigin")
+        if "scripts" in self.kinds:
+            links.extend(f"<{script.format(lang=lang)}>; rel=preload; as=script" for script in _SCRIPTS)
+        return tuple(links)
+
+    def links(self, lang: str | None) -> tuple[str, ...]:
+        """Link values for a page requested with ?lang=lang."""
+        return self._links.get(lang if lang in self._links else self.default_lang, ())
+
+    def wrap(self, response: Response, links: tuple[str, ...]) -> Response:
+        """Add the links to a page response, preceded by a 103 when enabled."""
+        if links and response.status_code == 200:
+            response.headers["Link"] = ", ".join(links)
+            if self.early_hints:
+                return _EarlyHintsResponse(response, links)
+        return response
+
+
+class _EarlyHintsResponse(Response):
+    """Sends a 103 Early Hints response before the wrapped one, on servers that support it."""
+
+    def __init__(self, response: Response, links: tuple[str, ...]):
+        self.response = response
+        self.links = links
+        self.background = None
+
+    @property
+    def status_code(self) -> int:
+        return self.response.status_code
+
+    @property
+    def headers(self):
+        return self.response.headers
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if "http.response.early_hint" in scope.get("extensions", {}):
+            await send({"type": "http.response.early_hint", "links": [link.encode("latin-1") for link in self.links]})
+        await self.response(scope, receive, send)
+        if self.background is not None:
+            await self.background()
+
+
+preloader = Preloader()
@@ -0,0 +1,405 @@
+import io
+import os
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from urllib.parse import quote, unquote
+
+COPY_SIZE = 256 * 1024
+
+STORE_KINDS = ("flat", "sharded", "sqlite", "sqlite-files")
+
+SQLITE_NAME = "saves.sqlite3"
+OBJECTS_DIR = "objects"
+# Unreferenced objects younger than this are kept by collect(): an upload may be about to point at them
+COLLECT_GRACE = 3600.0
+
+
+class SaveTooLarge(Exception):
+    pass
+
+
+def _copy_to_temp(source, directory: str, max_bytes: int) -> str:
+    """Copy source chunk by chunk into a fsynced temp file of directory. Returns its path."""
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".upload-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            size = 0
+            while chunk := source.read(COPY_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise SaveTooLarge()
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp creates the file private to the server's user
+        os.chmod(tmp_path, 0o644)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return tmp_path
+
+
+def _fsync_dir(directory: str) -> None:
+    """Make a rename into directory durable."""
+    if hasattr(os, "O_DIRECTORY"):
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def _commit_file(source, path: str, max_bytes: int) -> None:
+    """Write source to path atomically: temp file next to it, fsync, rename."""
+    directory = os.path.dirname(path) or "."
+    tmp_path = _copy_to_temp(source, directory, max_bytes)
+    try:
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    _fsync_dir(directory)
+
+
+def _read_file(path: str) -> bytes | None:
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _shard(key: str) -> tuple[str, str]:
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    return digest[:2], digest[2:4]
+
+
+def _hash(source, max_bytes: int) -> tuple[str, int]:
+    """SHA-256 and size of a seekable file object, which is rewound afterwards."""
+    h = hashlib.sha256()
+    size = 0
+    while chunk := source.read(COPY_SIZE):
+        size += len(chunk)
+        if size > max_bytes:
+            raise SaveTooLarge()
+        h.update(chunk)
+    source.seek(0)
+    return h.hexdigest(), size
+
+
+def _file_digest(path: str) -> str | None:
+    try:
+        with open(path, "rb") as f:
+            return hashlib.file_digest(f, "sha256").hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+class _Objects:
+    """Save contents stored once each, named by their SHA-256: `objects/<ab>/<cd>/<digest>`."""
+
+    def __init__(self, directory: str):
+        self.directory = os.path.join(directory, OBJECTS_DIR)
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest[:2], digest[2:4], digest)
+
+    def add(self, digest: str, source, max_bytes: int) -> None:
+        path = self.path(digest)
+        try:
+            # Already stored: only refresh its mtime, so a running collect() keeps it
+            os.utime(path)
+            return
+        except FileNotFoundError:
+            pass
+        _commit_file(source, path, max_bytes)
+
+    def read(self, digest: str) -> bytes | None:
+        return _read_file(self.path(digest))
+
+    def collect(self, referenced: set[str], grace: float) -> int:
+        """Remove objects (and abandoned temp files) not in referenced and older than grace seconds."""
+        removed = 0
+        cutoff = time.time() - grace
+        for root, _dirs, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if name in referenced:
+                    continue
+                try:
+                    if os.stat(path).st_mtime < cutoff:
+                        os.unlink(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+
+class SaveStore:
+    """
+    Where the local backend keeps saves, addressed by (token, file name).
+
+    Methods are blocking and thread-safe; the routes call them from worker threads.
+    File names are already sanitized (no directory part) by the caller.
+
+    Uploads are hashed first: re-uploading the save a token already has writes
+    nothing, and stores other than flat keep each distinct content only once.
+    """
+
+    def put(self, token: str, name: str, source, max_bytes: int) -> str:
+        """
+        Store the seekable file object source as (token, name), atomically replacing
+        the previous one. Returns the SHA-256 of the content.
+        """
+        raise NotImplementedError
+
+    def digest(self, token: str, name: str) -> str | None:
+        """SHA-256 of the save's content, without reading it where the store can."""
+        raise NotImplementedError
+
+    def get(self, token: str, name: str) -> tuple[str, bytes] | None:
+        """The save's digest and content."""
+        raise NotImplementedError
+
+    def list(self, token: str) -> list[str]:
+        """File names saved for token."""
+        raise NotImplementedError
+
+    def collect(self, grace: float = COLLECT_GRACE) -> int:
+        """Remove the contents no save points at any more. Returns how many were removed."""
+        return 0
+
+    def close(self) -> None:
+        pass
+
+
+class FlatStore(SaveStore):
+    """`{token}_{name}` files in one directory: the original layout. Listing a token scans it."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, token: str, name: str) -> str:
+        return os.path.join(self.directory, f"{token}_{name}")
+
+    def put(self, token, name, source, max_bytes):
+        # One full copy per save here; only unchanged uploads are skipped
+        digest, size = _hash(source, max_bytes)
+        path = self._path(token, name)
+        try:
+            unchanged = os.path.getsize(path) == size and _file_digest(path) == digest
+        except FileNotFoundError:
+            unchanged = False
+        if not unchanged:
+            _commit_file(source, path, max_bytes)
+        return digest
+
+    def digest(self, token, name):
+        return _file_digest(self._path(token, name))
+
+    def get(self, token, name):
+        content = _read_file(self._path(token, name))
+        return None if content is None else (hashlib.sha256(content).hexdigest(), content)
+
+    def list(self, token):
+        prefix = f"{token}_"
+        with os.scandir(self.directory) as entries:
+            return sorted(e.name[len(prefix):] for e in entries if e.name.startswith(prefix) and e.is_file())
+
+    def entries(self):
+        """(token, name, path) of every save, for migrations. Tokens end at the first `_`."""
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                token, sep, name = entry.name.partition("_")
+                if sep and token and name and not entry.name.startswith(".") and entry.is_file():
+                    yield token, name, entry.path
+
+
+class ShardedStore(SaveStore):
+    """
+    One directory per token, spread over 65536 shards by a hash of the token:
+    `<ab>/<cd>/<token>/<name>`. Directories stay small whatever the player count,
+    and a token's saves are listed without a scan. Each save file holds the digest
+    of its content, stored in `objects/`.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.objects = _Objects(directory)
+        os.makedirs(directory, exist_ok=True)
+
+    def _token_dir(self, token: str) -> str:
+        return os.path.join(self.directory, *_shard(token), quote(token, safe=""))
+
+    def _pointer(self, token: str, name: str) -> str:
+        return os.path.join(self._token_dir(token), quote(name, safe=""))
+
+    def put(self, token, name, source, max_bytes):
+        digest, _size = _hash(source, max_bytes)
+        pointer = self._pointer(token, name)
+        if _read_file(pointer) == digest.encode():
+            return digest
+        self.objects.add(digest, source, max_bytes)
+        _commit_file(io.BytesIO(digest.encode()), pointer, len(digest))
+        return digest
+
+    def digest(self, token, name):
+        digest = _read_file(self._pointer(token, name))
+        return None if digest is None else digest.decode()
+
+    def get(self, token, name):
+        digest = self.digest(token, name)
+        content = None if digest is None else self.objects.read(digest)
+        return None if content is None else (digest, content)
+
+    def list(self, token):
+        try:
+            with os.scandir(self._token_dir(token)) as entries:
+                return sorted(unquote(e.name) for e in entries if not e.name.startswith(".") and e.is_file())
+        except FileNotFoundError:
+            return []
+
+    def collect(self, grace=COLLECT_GRACE):
+        referenced = set()
+        with os.scandir(self.directory) as shards:
+            for shard in shards:
+                if len(shard.name) != 2 or not shard.is_dir():
+                    continue
+                for root, _dirs, files in os.walk(shard.path):
+                    for name in files:
+                        if not name.startswith(".") and (digest := _read_file(os.path.join(root, name))):
+                            referenced.add(digest.decode())
+        return self.objects.collect(referenced, grace)
+
+
+class SqliteStore(SaveStore):
+    """
+    Saves indexed in an SQLite database in WAL mode, shared by worker processes:
+    (token, name) → digest, and the contents by digest. With side_files, contents
+    are kept in `objects/` next to the database; otherwise they are stored as BLOBs.
+    """
+
+    def __init__(self, directory: str, side_files: bool = False):
+        self.directory = directory
+        self.path = os.path.join(directory, SQLITE_NAME)
+        self.side_files = side_files
+        self.objects = _Objects(directory)
+        self._local = threading.local()
+        os.makedirs(directory, exist_ok=True)
+        db = self._db()
+        db.executescript(
+            "CREATE TABLE IF NOT EXISTS saves ("
+            " token TEXT NOT NULL, name TEXT NOT NULL, digest TEXT NOT NULL, size INTEGER NOT NULL, mtime REAL NOT NULL,"
+            " PRIMARY KEY (token, name)) WITHOUT ROWID;"
+            "CREATE INDEX IF NOT EXISTS saves_digest ON saves (digest);"
+            "CREATE TABLE IF NOT EXISTS objects (digest TEXT PRIMARY KEY, data BLOB NOT NULL);"
+        )
+        db.commit()
+
+    def _db(self) -> sqlite3.Connection:
+        # One connection per thread: WAL lets readers run alongside the writer
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            # WAL + NORMAL stays consistent after a crash; a power loss may drop the last commits
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _digest(self, db: sqlite3.Connection, token: str, name: str) -> str | None:
+        row = db.execute("SELECT digest FROM saves WHERE token = ? AND name = ?", (token, name)).fetchone()
+        return row and row[0]
+
+    def put(self, token, name, source, max_bytes):
+        digest, size = _hash(source, max_bytes)
+        db = self._db()
+        if self._digest(db, token, name) == digest:
+            return digest
+        if self.side_files:
+            self.objects.add(digest, source, max_bytes)
+        with db:
+            previous = self._digest(db, token, name)
+            if not self.side_files:
+                db.execute("INSERT OR IGNORE INTO objects (digest, data) VALUES (?, ?)", (digest, source.read()))
+            db.execute(
+                "INSERT OR REPLACE INTO saves (token, name, digest, size, mtime) VALUES (?, ?, ?, ?, ?)",
+                (token, name, digest, size, time.time()),
+            )
+            if previous is not None and previous != digest and not self.side_files:
+                db.execute(
+                    "DELETE FROM objects WHERE digest = ? AND NOT EXISTS (SELECT 1 FROM saves WHERE digest = ?)",
+                    (previous, previous),
+                )
+        return digest
+
+    def digest(self, token, name):
+        return self._digest(self._db(), token, name)
+
+    def get(self, token, name):
+        db = self._db()
+        if self.side_files:
+            digest = self._digest(db, token, name)
+            content = None if digest is None else self.objects.read(digest)
+            return None if content is None else (digest, content)
+        row = db.execute(
+            "SELECT digest, data FROM saves JOIN objects USING (digest) WHERE token = ? AND name = ?", (token, name)
+        ).fetchone()
+        return row and tuple(row)
+
+    def list(self, token):
+        rows = self._db().execute("SELECT name FROM saves WHERE token = ? ORDER BY name", (token,))
+        return [name for (name,) in rows]
+
+    def collect(self, grace=COLLECT_GRACE):
+        db = self._db()
+        if self.side_files:
+            referenced = {digest for (digest,) in db.execute("SELECT DISTINCT digest FROM saves")}
+            return self.objects.collect(referenced, grace)
+        # BLOBs are dropped along with their last save already
+        with db:
+            return db.execute("DELETE FROM objects WHERE digest NOT IN (SELECT digest FROM saves)").rowcount
+
+    def close(self):
+        db = getattr(self._local, "db", None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+
+def open_store(kind: str, directory: str) -> SaveStore:
+    """Open the save store of kind (one of STORE_KINDS) rooted at directory."""
+    if kind == "flat":
+        return FlatStore(directory)
+    if kind == "sharded":
+        return ShardedStore(directory)
+    if kind in ("sqlite", "sqlite-files"):
+        return SqliteStore(directory, side_files=kind == "sqlite-files")
+    raise ValueError(f"unknown save store {kind!r}")
+
+
+def migrate_flat(directory: str, target: SaveStore, max_bytes: int) -> tuple[int, int]:
+    """
+    Copy the `{token}_{name}` saves of a flat directory into target. The flat files
+    are left in place; remove them once the new store is in use.
+
+    Returns:
+        (saves copied, saves that failed)
+    """
+    copied = failed = 0
+    for token, name, path in FlatStore(directory).entries():
+        try:
+            with open(path, "rb") as f:
+                target.put(token, name, f, max_bytes)
+            copied += 1
+        except (OSError, SaveTooLarge, sqlite3.Error) as e:
+            failed += 1
+            print(f"saves: could not migrate {path}: {e!r}")
+        if (copied + failed) % 10000 == 0:
+            print(f"saves: {copied + failed} saves migrated", flush=True)
+    return copied, failed
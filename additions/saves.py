@@ -1,12 +1,98 @@
 import os
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException
-from fastapi.responses import FileResponse, JSONResponse
+import json
+import asyncio
+import secrets
+from fastapi import APIRouter, HTTPException, Query, Request
+from starlette.datastructures import UploadFile
+from fastapi.responses import JSONResponse, Response
+from additions.cache import _etag_matches
+from additions.save_store import SaveStore, SaveTooLarge, open_store
 
 router = APIRouter()
 
 SAVES_DIR = "saves"
-if not os.path.exists(SAVES_DIR):
-    os.makedirs(SAVES_DIR)
+
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+DEFAULT_STORE = "flat"
+# Room for the token and fileName fields and the multipart framing around the save
+FORM_OVERHEAD = 64 * 1024
+
+_max_bytes = DEFAULT_MAX_BYTES
+_store: SaveStore | None = None
+
+
+def configure(max_bytes: int = DEFAULT_MAX_BYTES, store: str = DEFAULT_STORE) -> None:
+    """
+    Args:
+        max_bytes: Largest save accepted by /saves/upload
+        store: Layout of SAVES_DIR, one of save_store.STORE_KINDS
+    """
+    global _max_bytes, _store
+    _max_bytes = max_bytes
+    if _store is not None:
+        _store.close()
+    _store = open_store(store, SAVES_DIR)
+
+
+def _get_store() -> SaveStore:
+    if _store is None:
+        configure(_max_bytes)
+    return _store
+
+
+def _etag(digest: str) -> str:
+    return f'"{digest}"'
+
+
+def _save_headers(digest: str) -> dict:
+    # Cached by the browser, but revalidated every time: unchanged saves come back as a 304
+    return {"ETag": _etag(digest), "Cache-Control": "no-cache"}
+
+
+def _read_saves(store: SaveStore, token: str, names: list[str], if_none_match: str | None) -> tuple[list, list]:
+    """
+    Look up the saves of a batch download.
+
+    Returns:
+        (index entries {name, status, etag}, (name, content) of the saves to send)
+    """
+    index, contents = [], []
+    for name in names:
+        if if_none_match and (digest := store.digest(token, name)) and _etag_matches(if_none_match, _etag(digest)):
+            index.append({"name": name, "status": 304, "etag": _etag(digest)})
+        elif save := store.get(token, name):
+            index.append({"name": name, "status": 200, "etag": _etag(save[0])})
+            contents.append((name, save[1]))
+        else:
+            index.append({"name": name, "status": 404, "etag": None})
+    return index, contents
+
+
+def _form_data(index: list, contents: list) -> tuple[bytes, str]:
+    """
+    multipart/form-data body of a batch download, which browsers parse with
+    `Response.formData()`: an `index` JSON part, then one `file` part per save.
+
+    Returns:
+        (body, content type)
+    """
+    boundary = secrets.token_hex(16)
+    parts = [
+        b'Content-Disposition: form-data; name="index"\r\nContent-Type: application/json\r\n\r\n'
+        + json.dumps({"files": index}).encode()
+    ]
+    for name, content in contents:
+        # Quoted the way browsers encode form file names
+        filename = name.replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+        parts.append(
+            f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            f"Content-Type: application/octet-stream\r\n\r\n".encode()
+            + content
+        )
+    delimiter = f"--{boundary}\r\n".encode()
+    body = b"".join(delimiter + part + b"\r\n" for part in parts) + f"--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
 
 @router.get("/token/get")
 async def get_token(id: str):
@@ -14,29 +100,86 @@ async def get_token(id: str):
     # This mimics the original SDK's expectation of a profile object
     return {"token": id, "premium": True, "email": "local@user"}
 
+def _size_limited(request: Request, limit: int) -> Request:
+    """The same request, whose body fails with a 413 as soon as it exceeds limit bytes."""
+    received = 0
+
+    async def receive():
+        nonlocal received
+        message = await request.receive()
+        if message["type"] == "http.request":
+            received += len(message.get("body", b""))
+            if received > limit:
+                raise HTTPException(status_code=413, detail="Save too large")
+        return message
+
+    return Request(request.scope, receive)
+
 @router.post("/saves/upload")
-async def upload_save(
-    token: str = Form(...),
-    fileName: str = Form(...),
-    file: UploadFile = File(...)
-):
-    # Sanitize filename to prevent directory traversal
-    safe_filename = os.path.basename(fileName)
-    # Save as {token}_{filename} to keep it flat in /saves/
-    save_path = os.path.join(SAVES_DIR, f"{token}_{safe_filename}")
-    
-    with open(save_path, "wb") as f:
-        content = await file.read()
-        f.write(content)
-    
+async def upload_save(request: Request):
+    # Refuse oversized uploads before the form parser spools them: from Content-Length
+    # when there is one, else (chunked uploads) as soon as the body grows past it
+    limit = _max_bytes + FORM_OVERHEAD
+    length = request.headers.get("content-length")
+    if length is not None and length.isdigit() and int(length) > limit:
+        raise HTTPException(status_code=413, detail="Save too large")
+
+    async with _size_limited(request, limit).form(max_files=1, max_fields=8) as form:
+        token, fileName, file = form.get("token"), form.get("fileName"), form.get("file")
+        if not isinstance(token, str) or not isinstance(fileName, str) or not isinstance(file, UploadFile):
+            raise HTTPException(status_code=422, detail="Expected token, fileName and file fields")
+
+        # Sanitize filename to prevent directory traversal
+        safe_filename = os.path.basename(fileName)
+        if not safe_filename:
+            raise HTTPException(status_code=422, detail="Expected token, fileName and file fields")
+
+        # Copy the spooled upload off the event loop, checking its size as it goes
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, _get_store().put, token, safe_filename, file.file, _max_bytes)
+        except SaveTooLarge:
+            raise HTTPException(status_code=413, detail="Save too large")
+
     return {"success": True}
 
 @router.get("/saves/download/{token}/{fileName}")
-async def download_save(token: str, fileName: str):
+async def download_save(request: Request, token: str, fileName: str):
     safe_filename = os.path.basename(fileName)
-    save_path = os.path.join(SAVES_DIR, f"{token}_{safe_filename}")
-    
-    if not os.path.exists(save_path):
+    loop = asyncio.get_running_loop()
+    store = _get_store()
+
+    # Revalidation: compare digests without reading the save
+    if if_none_match := request.headers.get("if-none-match"):
+        digest = await loop.run_in_executor(None, store.digest, token, safe_filename)
+        if digest is not None and _etag_matches(if_none_match, _etag(digest)):
+            return Response(status_code=304, headers=_save_headers(digest))
+
+    # One lookup, off the event loop; a missing save is just a failed open
+    save = await loop.run_in_executor(None, store.get, token, safe_filename)
+    if save is None:
         return JSONResponse(status_code=404, content={"error": "File not found"})
-        
-    return FileResponse(save_path)
+
+    digest, content = save
+    return Response(content, media_type="application/octet-stream", headers=_save_headers(digest))
+
+@router.get("/saves/batch/{token}")
+async def download_saves(request: Request, token: str, file: list[str] = Query(default=[])):
+    """
+    Several saves of token in one multipart/form-data response: those named by the
+    `file` query parameters, or all of them. Saves whose ETag is listed in
+    If-None-Match are only listed in the index, with status 304.
+    """
+    loop = asyncio.get_running_loop()
+    store = _get_store()
+    names = [os.path.basename(name) for name in file] or await loop.run_in_executor(None, store.list, token)
+    index, contents = await loop.run_in_executor(
+        None, _read_saves, store, token, names, request.headers.get("if-none-match")
+    )
+    body, content_type = _form_data(index, contents)
+    return Response(body, media_type=content_type, headers={"Cache-Control": "no-store"})
+
+@router.get("/saves/list/{token}")
+async def list_saves(token: str):
+    names = await asyncio.get_running_loop().run_in_executor(None, _get_store().list, token)
+    return {"files": names}
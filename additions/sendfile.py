@@ -0,0 +1,59 @@
+import os
+import asyncio
+
+try:
+    from uvicorn.protocols.http.httptools_impl import HttpToolsProtocol, RequestResponseCycle
+except ImportError:  # needs uvicorn[standard] (httptools)
+    HttpToolsProtocol = RequestResponseCycle = None
+
+# ASGI zero-copy send extension: the server copies a file to the socket itself
+ZERO_COPY_SEND = "http.response.zerocopysend"
+
+# Import string of the protocol, for uvicorn.run(http=...) in every worker
+PROTOCOL = "additions.sendfile:SendfileHttpToolsProtocol"
+
+
+def available() -> bool:
+    return HttpToolsProtocol is not None
+
+
+if HttpToolsProtocol is not None:
+
+    class _SendfileCycle(RequestResponseCycle):
+        async def send(self, message) -> None:
+            if message["type"] != ZERO_COPY_SEND:
+                await super().send(message)
+                return
+            if not self.response_started or self.response_complete:
+                raise RuntimeError(f"Unexpected ASGI message '{ZERO_COPY_SEND}'.")
+            if self.flow.write_paused and not self.disconnected:
+                await self.flow.drain()
+            if self.disconnected:
+                return
+
+            file = message["file"]
+            offset = message.get("offset")
+            if offset is None:
+                offset = file.tell()
+            count = message.get("count")
+            if count is None:
+                count = os.fstat(file.fileno()).st_size - offset
+            if self.chunked_encoding or count > self.expected_content_length:
+                raise RuntimeError("Zero-copy send needs a Content-Length covering it.")
+
+            # os.sendfile on plain sockets; asyncio falls back to copying for TLS and other transports
+            try:
+                await asyncio.get_running_loop().sendfile(self.transport, file, offset, count)
+            except ConnectionError:
+                self.disconnected = True
+                return
+            self.expected_content_length -= count
+            await super().send({"type": "http.response.body", "body": b"", "more_body": message.get("more_body", False)})
+
+    class SendfileHttpToolsProtocol(HttpToolsProtocol):
+        """uvicorn's httptools protocol, with the zero-copy send extension offered to the app."""
+
+        def _start_asgi_task(self, cycle, app) -> None:
+            cycle.__class__ = _SendfileCycle
+            cycle.scope.setdefault("extensions", {})[ZERO_COPY_SEND] = {}
+            super()._start_asgi_task(cycle, app)
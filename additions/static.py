@@ -0,0 +1,374 @@
+import os
+import re
+import time
+import gzip
+import asyncio
+import hashlib
+import mimetypes
+import brotli
+from starlette._utils import get_route_path
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.responses import FileResponse, Response
+from starlette.types import Receive, Scope, Send
+from additions.cache import _is_not_modified, _not_modified
+
+PRECOMPRESSED_DIR = ".precompressed"
+
+# Preference order when the client accepts several encodings
+ENCODING_SUFFIXES = {
+    "br": ".br",
+    "gzip": ".gz",
+}
+
+# Files smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 1024
+
+# Already compressed formats
+_INCOMPRESSIBLE = (".br", ".gz", ".zst", ".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp4", ".webm", ".woff2", ".zip")
+
+# `name.<hash>.ext` / `name-<hash>.ext`, as emitted by bundlers
+_HASHED_NAME_RE = re.compile(r"[.-][0-9a-fA-F]{8,}\.[^./]+$")
+
+# Query parameters that pin a URL to one version of a file (`game.js?v=3`)
+_VERSION_PARAMS = ("v", "ver", "version", "hash")
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+
+class _StaticFile:
+    __slots__ = ("path", "stat", "digest", "etag", "media_type", "hashed", "variants", "checked")
+
+    def __init__(self, path: str, stat: os.stat_result, digest: str, media_type: str, hashed: bool):
+        self.path = path
+        self.stat = stat
+        self.digest = digest
+        self.etag = f'"{digest}"'
+        self.media_type = media_type
+        self.hashed = hashed
+        # encoding -> (path, stat) of prebuilt variants
+        self.variants: dict[str, tuple[str, os.stat_result]] = {}
+        # When the variants were last looked for on disk
+        self.checked = time.monotonic()
+
+    @property
+    def compressible(self) -> bool:
+        return self.stat.st_size >= MIN_COMPRESS_SIZE and not self.path.lower().endswith(_INCOMPRESSIBLE)
+
+
+def _sha256_file(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=11)
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+class StaticEngine:
+    """
+    Serves a directory of static files (`dist/`) from an in-memory index.
+
+    The tree is scanned at startup: each file's stat, strong SHA-256 ETag and media
+    type are kept in memory, so serving a request needs a single stat() and no path
+    lookup. A file whose stat changed is hashed again, and a path missing from the
+    index triggers a rescan at most once per `check_interval` seconds, so edits to
+    the directory take effect without a restart. Brotli and gzip variants are built
+    into a `.precompressed/` directory (reused across restarts while their mtime
+    matches the source) and negotiated by `Accept-Encoding`; variants built by
+    another worker process are picked up within `check_interval`. Files with a hash in
+    their name, or requested with a version query parameter, are sent as immutable;
+    everything else must be revalidated, which conditional requests turn into 304s.
+    """
+
+    def __init__(self, directory: str, precompress: bool = True, check_interval: float = 1.0):
+        self.directory = directory
+        self.precompress = precompress
+        self.check_interval = check_interval
+        self.files: dict[str, _StaticFile] = {}
+        self.scanned = 0.0
+        self._building: asyncio.Future | None = None
+
+    def variant_path(self, rel_path: str, encoding: str) -> str:
+        return os.path.join(self.directory, PRECOMPRESSED_DIR, rel_path + ENCODING_SUFFIXES[encoding])
+
+    def scan(self) -> None:
+        """(Re)build the in-memory index of the directory, with the variants already on disk."""
+        self.scanned = time.monotonic()
+        files = {}
+        for root, dirs, names in os.walk(self.directory):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for name in names:
+                if name.startswith("."):
+                    continue
+                path = os.path.join(root, name)
+                rel_path = os.path.relpath(path, self.directory).replace(os.sep, "/")
+                try:
+                    files[rel_path] = self._index_file(rel_path, path)
+                except OSError:
+                    continue
+        self.files = files
+
+    def reindex(self, rel_path: str) -> _StaticFile | None:
+        """Hash one indexed file again after it changed; drops it if it is gone."""
+        entry = self.files.get(rel_path)
+        if entry is None:
+            return None
+        try:
+            entry = self.files[rel_path] = self._index_file(rel_path, entry.path)
+        except OSError:
+            self.files.pop(rel_path, None)
+            return None
+        return entry
+
+    def _index_file(self, rel_path: str, path: str) -> _StaticFile:
+        stat = os.stat(path)
+        previous = self.files.get(rel_path)
+        if previous is not None and previous.stat.st_mtime == stat.st_mtime and previous.stat.st_size == stat.st_size:
+            digest = previous.digest
+        else:
+            digest = _sha256_file(path)
+        media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        entry = _StaticFile(path, stat, digest, media_type, bool(_HASHED_NAME_RE.search(os.path.basename(path))))
+        for encoding in ENCODING_SUFFIXES:
+            variant = self.variant_path(rel_path, encoding)
+            try:
+                variant_stat = os.stat(variant)
+            except OSError:
+                continue
+            if variant_stat.st_mtime == stat.st_mtime:
+                entry.variants[encoding] = (variant, variant_stat)
+        return entry
+
+    def build_variants(self) -> int:
+        """Write the missing or stale variants of every compressible file. Returns how many were built."""
+        built = 0
+        for rel_path, entry in list(self.files.items()):
+            if not entry.compressible:
+                continue
+            missing = [e for e in ENCODING_SUFFIXES if e not in entry.variants]
+            if not missing:
+                continue
+            with open(entry.path, "rb") as f:
+                data = f.read()
+            for encoding in missing:
+                compressed = _compress(data, encoding)
+                if len(compressed) >= len(data):
+                    continue
+                target = self.variant_path(rel_path, encoding)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                tmp_path = f"{target}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(compressed)
+                os.utime(tmp_path, (entry.stat.st_atime, entry.stat.st_mtime))
+                os.replace(tmp_path, target)
+                entry.variants[encoding] = (target, os.stat(target))
+                built += 1
+        return built
+
+    async def load(self) -> None:
+        """Index the directory in a worker thread."""
+        await asyncio.get_running_loop().run_in_executor(None, self.scan)
+
+    async def lookup(self, rel_path: str) -> _StaticFile | None:
+        """Index entry of rel_path, brought up to date with the file on disk."""
+        loop = asyncio.get_running_loop()
+        entry = self.files.get(rel_path)
+        if entry is None:
+            # Pick up files added since the last scan, without rescanning on every 404
+            if time.monotonic() - self.scanned < self.check_interval:
+                return None
+            self.scanned = time.monotonic()
+            await loop.run_in_executor(None, self.scan)
+            if (entry := self.files.get(rel_path)) is not None and self.precompress:
+                self.schedule_build()
+            return entry
+
+        try:
+            stat = os.stat(entry.path)
+        except OSError:
+            self.files.pop(rel_path, None)
+            return None
+        if stat.st_mtime != entry.stat.st_mtime or stat.st_size != entry.stat.st_size:
+            entry = await loop.run_in_executor(None, self.reindex, rel_path)
+            if entry is not None and self.precompress:
+                self.schedule_build()
+        elif (
+            self.precompress and entry.compressible and len(entry.variants) < len(ENCODING_SUFFIXES)
+            and time.monotonic() - entry.checked >= self.check_interval
+        ):
+            # Unchanged, so only the variants are looked up again: the digest is reused
+            entry = self.reindex(rel_path)
+        return entry
+
+    def schedule_build(self) -> asyncio.Future:
+        """Run `build_all` in the background, unless it is already running."""
+        if self._building is None or self._building.done():
+            self._building = asyncio.ensure_future(self.build_all())
+        return self._building
+
+    async def build_all(self) -> None:
+        """Build missing variants in a worker thread; until then files are sent as they are."""
+        if not self.precompress:
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.build_variants)
+        except OSError as e:
+            # Keep serving identity responses, e.g. from a read-only directory
+            print(f"static: could not precompress {self.directory}: {e}")
+
+    def _cache_control(self, entry: _StaticFile, query_string: bytes) -> str:
+        if entry.hashed:
+            return IMMUTABLE
+        params = (p.split(b"=", 1)[0].decode("latin-1") for p in query_string.split(b"&") if p)
+        if any(p in _VERSION_PARAMS for p in params):
+            return IMMUTABLE
+        return REVALIDATE
+
+    def response(self, entry: _StaticFile, request_headers: Headers, query_string: bytes = b"") -> Response:
+        """Response for an up-to-date index entry (see `lookup`)."""
+        headers = {
+            "Cross-Origin-Opener-Policy": "same-origin",
+            "Cross-Origin-Embedder-Policy": "require-corp",
+            "Cache-Control": self._cache_control(entry, query_string),
+            "ETag": entry.etag,
+        }
+        path, stat = entry.path, entry.stat
+        if entry.variants:
+            headers["Vary"] = "Accept-Encoding"
+            accept_encoding = request_headers.get("accept-encoding", "").lower()
+            for encoding in ENCODING_SUFFIXES:
+                if encoding in entry.variants and encoding in accept_encoding:
+                    path, stat = entry.variants[encoding]
+                    headers["Content-Encoding"] = encoding
+                    # Each representation has its own strong validator
+                    headers["ETag"] = f'"{entry.digest}-{encoding}"'
+                    break
+
+        if _is_not_modified(request_headers, Headers(headers=headers)):
+            return _not_modified(headers)
+        return FileResponse(path, media_type=entry.media_type, headers=headers, stat_result=stat)
+
+    def stats(self) -> dict:
+        return {
+            "files": len(self.files),
+            "bytes": sum(e.stat.st_size for e in self.files.values()),
+            "precompressed": sum(len(e.variants) for e in self.files.values()),
+        }
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["method"] not in ("GET", "HEAD"):
+            raise HTTPException(status_code=405)
+        # Only indexed paths are served, so '..' and the like simply miss
+        entry = await self.lookup(get_route_path(scope).lstrip("/"))
+        if entry is None:
+            raise HTTPException(status_code=404)
+        await self.response(entry, Headers(scope=scope), scope.get("query_string", b""))(scope, receive, send)
+
+
+class RenderedPage:
+    """
+    A page rendered from a template file once and kept in memory with its brotli
+    and gzip encodings and a strong ETag.
+
+    The file's mtime is checked at most once per `check_interval` seconds and the
+    page is rendered again when it changed, so edits still take effect; `update`
+    does that rendering in a worker thread.
+    """
+
+    def __init__(self, path: str, render=None, check_interval: float = 1.0):
+        """
+        Args:
+            path: Template file
+            render: Function applied to the file's text, e.g. to inject configuration
+            check_interval: Seconds between two mtime checks of the file
+        """
+        self.path = path
+        self.render = render or (lambda text: text)
+        self.check_interval = check_interval
+        self.mtime = None
+        self.checked = 0.0
+        self.digest = None
+        self.bodies: dict[str, bytes] = {}
+        self.renders = 0
+        self._rendering: asyncio.Future | None = None
+
+    def _changed(self) -> float | None:
+        """The file's new mtime if it must be rendered again, checked at most once per check_interval."""
+        now = time.monotonic()
+        if self.mtime is not None and now - self.checked < self.check_interval:
+            return None
+        self.checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            self.mtime = None
+            self.bodies = {}
+            return None
+        return None if mtime == self.mtime else mtime
+
+    def _render(self, mtime: float) -> None:
+        with open(self.path, "r", encoding="utf-8") as f:
+            body = self.render(f.read()).encode("utf-8")
+        bodies = {"identity": body}
+        for encoding in ENCODING_SUFFIXES:
+            bodies[encoding] = _compress(body, encoding)
+        self.bodies = bodies
+        self.digest = hashlib.sha256(body).hexdigest()
+        self.mtime = mtime
+        self.renders += 1
+
+    def refresh(self) -> bool:
+        """Re-render if the file changed. Returns False if it does not exist."""
+        if (mtime := self._changed()) is not None:
+            self._render(mtime)
+        return bool(self.bodies)
+
+    async def update(self) -> bool:
+        """
+        `refresh` without blocking the event loop: the page is rendered and compressed
+        in a worker thread, and the previous render keeps being served meanwhile.
+        """
+        if (mtime := self._changed()) is not None and self._rendering is None:
+            self._rendering = asyncio.get_running_loop().run_in_executor(None, self._render, mtime)
+            self._rendering.add_done_callback(self._rendered)
+        if not self.bodies and self._rendering is not None:
+            # Nothing to serve until the first render completes
+            await asyncio.wait([self._rendering])
+        return bool(self.bodies)
+
+    def _rendered(self, future: asyncio.Future) -> None:
+        self._rendering = None
+        if not future.cancelled() and future.exception() is not None:
+            # Retried at the next check
+            print(f"static: could not render {self.path}: {future.exception()}")
+
+    def response(self, request_headers: Headers, headers: dict = None) -> Response | None:
+        """
+        Response negotiated by Accept-Encoding, a 304, or None if the file does not
+        exist. Call `refresh` or `update` first to pick up changes to the file.
+        """
+        if not self.bodies:
+            return None
+        headers = dict(headers or {}, **{"Cache-Control": REVALIDATE, "Vary": "Accept-Encoding", "ETag": f'"{self.digest}"'})
+        body = self.bodies["identity"]
+        accept_encoding = request_headers.get("accept-encoding", "").lower()
+        for encoding in ENCODING_SUFFIXES:
+            if encoding in accept_encoding:
+                body = self.bodies[encoding]
+                headers["Content-Encoding"] = encoding
+                headers["ETag"] = f'"{self.digest}-{encoding}"'
+                break
+
+        if _is_not_modified(request_headers, Headers(headers=headers)):
+            return _not_modified(headers)
+        return Response(body, media_type="text/html", headers=headers)
+
+    def stats(self) -> dict:
+        return {"path": self.path, "renders": self.renders, "bytes": {e: len(b) for e, b in self.bodies.items()}}
@@ -0,0 +1,305 @@
+import asyncio
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from time import perf_counter
+
+import httpx
+
+from additions import metrics
+from additions.mirrors import Mirror, MirrorGroup, mirrors
+
+DEFAULT_MAX_CONNECTIONS = 100
+DEFAULT_MAX_KEEPALIVE_CONNECTIONS = 20
+DEFAULT_KEEPALIVE_EXPIRY = 60.0
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_READ_TIMEOUT = 60.0
+DEFAULT_POOL_TIMEOUT = 30.0
+
+# Hop-by-hop headers must not be forwarded upstream (HTTP/2 rejects them outright).
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-connection",
+    "transfer-encoding",
+    "upgrade",
+    "te",
+}
+
+_client: httpx.AsyncClient | None = None
+# HTTP/1.1 client with the same settings, for requests that need a connection of their own
+_flow_client: httpx.AsyncClient | None = None
+_client_options: dict = {}
+_http2_enabled = False
+_active_streams = 0
+
+
+def _http2_available() -> bool:
+    """HTTP/2 support in httpx needs the optional `h2` package."""
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def init_client(
+    max_connections: int = DEFAULT_MAX_CONNECTIONS,
+    max_keepalive_connections: int = DEFAULT_MAX_KEEPALIVE_CONNECTIONS,
+    keepalive_expiry: float = DEFAULT_KEEPALIVE_EXPIRY,
+    connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+    read_timeout: float = DEFAULT_READ_TIMEOUT,
+    pool_timeout: float = DEFAULT_POOL_TIMEOUT,
+    http2: bool = True,
+) -> httpx.AsyncClient:
+    """
+    Create the shared upstream client. Called once at application startup.
+
+    Args:
+        max_connections: Hard cap on open upstream connections
+        max_keepalive_connections: Idle connections kept around for reuse
+        keepalive_expiry: Seconds an idle connection stays in the pool
+        connect_timeout: Seconds allowed for TCP + TLS setup
+        read_timeout: Seconds allowed between two reads of a response body
+        pool_timeout: Seconds a request may wait for a free pooled connection
+        http2: Multiplex requests over HTTP/2 when `h2` is installed
+    """
+    global _client, _client_options, _http2_enabled
+    _http2_enabled = bool(http2) and _http2_available()
+    _client_options = dict(
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        ),
+        timeout=httpx.Timeout(
+            connect=connect_timeout,
+            read=read_timeout,
+            write=read_timeout,
+            pool=pool_timeout,
+        ),
+    )
+    _client = httpx.AsyncClient(
+        http2=_http2_enabled,
+        # The client is shared by every player: never keep upstream cookies around.
+        cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
+        **_client_options,
+    )
+    return _client
+
+
+async def close_client() -> None:
+    """Close the shared upstream clients. Called once at application shutdown."""
+    global _client, _flow_client
+    for client in (_client, _flow_client):
+        if client is not None:
+            await client.aclose()
+    _client = _flow_client = None
+
+
+def get_client() -> httpx.AsyncClient:
+    """Return the shared upstream client, creating it with defaults if needed."""
+    if _client is None:
+        return init_client()
+    return _client
+
+
+def _get_flow_client() -> httpx.AsyncClient:
+    """A client whose concurrent requests never share a connection."""
+    global _flow_client
+    client = get_client()
+    if not _http2_enabled:
+        # HTTP/1.1 already gives each in-flight request its own connection
+        return client
+    if _flow_client is None:
+        _flow_client = httpx.AsyncClient(
+            http2=False,
+            cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
+            **_client_options,
+        )
+    return _flow_client
+
+
+async def _send_one(client: httpx.AsyncClient, method: str, url: str, headers: dict) -> httpx.Response:
+    connected_event = "connection.start_tls.complete" if url.startswith("https:") else "connection.connect_tcp.complete"
+    connect_started = None
+
+    async def trace(event: str, info: dict) -> None:
+        # Only called by httpcore when the request needs a new connection
+        nonlocal connect_started
+        if event == "connection.connect_tcp.started":
+            connect_started = perf_counter()
+        elif event == connected_event and connect_started is not None:
+            metrics.upstream_connect_seconds.observe(perf_counter() - connect_started)
+
+    req = client.build_request(method, url, headers=headers, extensions={"trace": trace})
+    started = perf_counter()
+    r = await client.send(req, stream=True)
+    metrics.upstream_ttfb_seconds.observe(perf_counter() - started)
+    return r
+
+
+def _discard(attempt: asyncio.Task, mirror: Mirror, started: float) -> None:
+    """Give up on an attempt that lost: cancel it, or close its response if it has one."""
+    if not attempt.done():
+        mirror.slower_than(perf_counter() - started)
+        attempt.cancel()
+
+    def close(attempt: asyncio.Task) -> None:
+        if not attempt.cancelled() and attempt.exception() is None:
+            asyncio.ensure_future(attempt.result().aclose())
+
+    attempt.add_done_callback(close)
+
+
+async def _send_mirrored(
+    client: httpx.AsyncClient, group: MirrorGroup, path: str, method: str, headers: dict, pin: str | None = None
+) -> httpx.Response:
+    """
+    Send to the best mirror of group, failing over to the next one on connection
+    errors and 5xx answers. GETs and HEADs that get no response headers within
+    `hedge_after` are also sent to the next mirror; the first answer wins. With pin,
+    only the mirror of that base URL is used.
+    """
+    candidates = group.ranked()
+    if pin is not None:
+        candidates = [m for m in candidates if m.base_url == pin] or candidates
+    hedge_after = mirrors.hedge_after if method in ("GET", "HEAD") else 0
+    attempts: dict[asyncio.Task, tuple[Mirror, float]] = {}
+    launched = 0
+    error = None
+
+    def launch() -> None:
+        nonlocal launched
+        mirror = candidates[launched]
+        launched += 1
+        attempt = asyncio.ensure_future(_send_one(client, method, mirror.base_url + path, headers))
+        attempts[attempt] = (mirror, perf_counter())
+
+    launch()
+    try:
+        while attempts:
+            can_hedge = hedge_after and launched < len(candidates)
+            done, _ = await asyncio.wait(attempts, timeout=hedge_after if can_hedge else None, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                metrics.upstream_hedges.inc()
+                launch()
+                continue
+            for attempt in done:
+                mirror, started = attempts.pop(attempt)
+                try:
+                    r = attempt.result()
+                except httpx.TransportError as e:
+                    mirror.failed(mirrors.max_failures, mirrors.cooldown)
+                    error = e
+                    continue
+                has_fallback = attempts or launched < len(candidates)
+                if r.status_code >= 500 and has_fallback:
+                    mirror.failed(mirrors.max_failures, mirrors.cooldown)
+                    await r.aclose()
+                    continue
+                if r.status_code >= 500:
+                    mirror.failed(mirrors.max_failures, mirrors.cooldown)
+                else:
+                    mirror.succeeded(perf_counter() - started)
+                return r
+            # Every attempt that completed failed: replace them with the next mirror
+            if launched < len(candidates):
+                launch()
+        raise error
+    finally:
+        for attempt, (mirror, started) in attempts.items():
+            _discard(attempt, mirror, started)
+
+
+async def send(method: str, url: str, headers: dict, multiplex: bool = True, mirror: str | None = None) -> httpx.Response:
+    """
+    Send a streamed request upstream. The response must be given back to `release`.
+
+    URLs of an upstream with mirrors (see additions/mirrors.py) are sent to the
+    fastest healthy mirror, with failover and hedging.
+
+    Args:
+        multiplex: False to give the request a TCP connection of its own even over
+            HTTP/2, e.g. for the parallel segments of one download
+        mirror: Base URL of the mirror to send to (see `mirror_of`), e.g. so that every
+            Range request of one download gets the same version of the asset
+    """
+    global _active_streams
+    headers = {k: v for k, v in headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+    client = get_client() if multiplex else _get_flow_client()
+    group, path = mirrors.lookup(url)
+    if group is None:
+        r = await _send_one(client, method, url, headers)
+    else:
+        r = await _send_mirrored(client, group, path, method, headers, pin=mirror)
+    _active_streams += 1
+    return r
+
+
+def mirror_of(r: httpx.Response) -> str | None:
+    """Base URL of the mirror that answered r, or None if its upstream has no mirrors."""
+    url = str(r.request.url)
+    for group in mirrors.groups:
+        for mirror in group.mirrors:
+            if url.startswith(mirror.base_url):
+                return mirror.base_url
+    return None
+
+
+async def release(r: httpx.Response) -> None:
+    """Close a streamed upstream response, returning its connection to the pool."""
+    global _active_streams
+    _active_streams -= 1
+    await r.aclose()
+    # Set by httpx on close: from sending the request to closing the response
+    metrics.upstream_seconds.observe(r.elapsed.total_seconds())
+
+
+def pool_stats() -> dict:
+    """Report upstream pool occupancy, to help sizing the connection limits."""
+    stats = {
+        "http2": _http2_enabled,
+        "active_streams": _active_streams,
+        "connections": 0,
+        "idle": 0,
+        "available": 0,
+        "queued_requests": 0,
+    }
+    if _client is None:
+        return stats
+
+    # httpx does not expose pool state publicly; read it from httpcore defensively.
+    pool = getattr(_client._transport, "_pool", None)
+    if pool is None:
+        return stats
+    connections = list(getattr(pool, "connections", []))
+    stats["connections"] = len(connections)
+    stats["idle"] = sum(1 for c in connections if c.is_idle())
+    stats["available"] = sum(1 for c in connections if c.is_available())
+    stats["queued_requests"] = sum(
+        1 for req in getattr(pool, "_requests", []) if req.is_queued()
+    )
+    limits = getattr(pool, "_max_connections", None)
+    if limits is not None:
+        stats["max_connections"] = limits
+    if mirrors.groups:
+        stats["mirrors"] = mirrors.stats()
+    return stats
+
+
+def _connection_counts() -> dict:
+    stats = pool_stats()
+    return {("idle",): stats["idle"], ("active",): stats["connections"] - stats["idle"]}
+
+
+metrics.registry.add(metrics.Gauge(
+    "revcdos_upstream_active_streams", "Upstream responses being streamed", read=lambda: {(): _active_streams}
+))
+metrics.registry.add(metrics.Gauge(
+    "revcdos_upstream_mirror_ttfb_seconds", "Moving average of each mirror's time to response headers", ("mirror",),
+    read=lambda: {(m.base_url,): m.ttfb for g in mirrors.groups for m in g.mirrors if m.ttfb is not None},
+    aggregate="max",
+))
+metrics.registry.add(metrics.Gauge(
+    "revcdos_upstream_connections", "Open upstream connections, by state (idle or active)", ("state",),
+    read=_connection_counts,
+))
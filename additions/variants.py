@@ -0,0 +1,172 @@
+import os
+import gzip
+import asyncio
+import brotli
+
+try:
+    import zstandard
+except ImportError:  # zstd variants are optional
+    zstandard = None
+
+VARIANTS_DIR = ".variants"
+
+# Preference order when the client accepts several encodings
+ENCODING_SUFFIXES = {
+    "zstd": ".zst",
+    "gzip": ".gz",
+    "identity": "",
+}
+
+
+class VariantStore:
+    """
+    Decompressed (and optionally gzip/zstd) copies of cached `.br` assets.
+
+    Clients that do not accept brotli get a plain file response from a variant
+    instead of decompressing hundreds of MB on every request. Variants live in a
+    `.variants/` directory next to the asset and carry the source's mtime, so a
+    changed source is detected without any extra metadata. They are built once, in
+    the background, on first demand (or up front with `build_all`).
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.encodings = ("identity",)
+        self._building: dict[str, asyncio.Future] = {}
+
+    def configure(self, enabled: bool, encodings=()) -> None:
+        self.enabled = enabled
+        requested = {"identity", *encodings}
+        if zstandard is None:
+            requested.discard("zstd")
+        self.encodings = tuple(e for e in ENCODING_SUFFIXES if e in requested)
+
+    def variant_path(self, local_path: str, encoding: str) -> str:
+        head, name = os.path.split(local_path)
+        return os.path.join(head, VARIANTS_DIR, name.removesuffix(".br") + ENCODING_SUFFIXES[encoding])
+
+    def lookup(self, local_path: str, accept_encoding: str, source: os.stat_result) -> tuple[str, str] | None:
+        """
+        Pick the best up-to-date variant the client accepts.
+
+        Returns:
+            (variant path, encoding), or None if nothing usable is built yet; a build
+            is then scheduled in the background.
+        """
+        if not self.enabled:
+            return None
+        accept_encoding = accept_encoding.lower()
+        for encoding in self.encodings:
+            if encoding != "identity" and encoding not in accept_encoding:
+                continue
+            path = self.variant_path(local_path, encoding)
+            try:
+                if os.stat(path).st_mtime == source.st_mtime:
+                    return path, encoding
+            except OSError:
+                pass
+            self.schedule(local_path)
+            return None
+        return None
+
+    def schedule(self, local_path: str) -> None:
+        """Build the variants of local_path in a worker thread, once."""
+        if not self.enabled or local_path in self._building:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        future = loop.run_in_executor(None, self.build, local_path)
+        self._building[local_path] = future
+        future.add_done_callback(lambda f: self._built(local_path, f))
+
+    def _built(self, local_path: str, future: asyncio.Future) -> None:
+        self._building.pop(local_path, None)
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            # Keep serving on the fly; the build is retried on the next demand
+            print(f"variants: could not build {local_path}: {future.exception()}")
+            return
+        self._account(local_path)
+
+    def _account(self, local_path: str) -> None:
+        """Charge the variants of a cached asset to its cache directory's budget."""
+        # Imported here: cache_index imports this module
+        from additions.cache_index import index_for
+        if index := index_for(local_path):
+            index.add_variants(local_path)
+
+    def build(self, local_path: str) -> None:
+        """Decompress local_path once, writing every configured variant in the same pass."""
+        source = os.stat(local_path)
+        targets = {e: self.variant_path(local_path, e) for e in self.encodings}
+        os.makedirs(os.path.dirname(targets["identity"]), exist_ok=True)
+        temp_paths = {e: f"{path}.{os.getpid()}.tmp" for e, path in targets.items()}
+
+        files = []
+        writers = []
+        try:
+            for encoding, temp_path in temp_paths.items():
+                f = open(temp_path, "wb")
+                files.append(f)
+                if encoding == "gzip":
+                    writer = gzip.GzipFile(fileobj=f, mode="wb", compresslevel=6, mtime=0)
+                    files.append(writer)
+                elif encoding == "zstd":
+                    writer = zstandard.ZstdCompressor().stream_writer(f, closefd=False)
+                    files.append(writer)
+                else:
+                    writer = f
+                writers.append(writer)
+
+            decompressor = brotli.Decompressor()
+            with open(local_path, "rb") as src:
+                while chunk := src.read(1024 * 1024):
+                    data = decompressor.process(chunk)
+                    for writer in writers:
+                        writer.write(data)
+            if not decompressor.is_finished():
+                raise ValueError(f"{local_path} is not a complete brotli stream")
+        except BaseException:
+            for f in reversed(files):
+                f.close()
+            for temp_path in temp_paths.values():
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            raise
+
+        # Close compressors before their underlying files
+        for f in reversed(files):
+            f.close()
+        for encoding, temp_path in temp_paths.items():
+            os.utime(temp_path, (source.st_atime, source.st_mtime))
+            os.replace(temp_path, targets[encoding])
+
+    async def build_all(self, directory: str) -> None:
+        """Build missing or stale variants for every `.br` asset under directory."""
+        if not self.enabled or not os.path.isdir(directory):
+            return
+        loop = asyncio.get_running_loop()
+        for root, dirs, names in os.walk(directory):
+            dirs[:] = [d for d in dirs if d != VARIANTS_DIR]
+            for name in names:
+                if not name.endswith(".br"):
+                    continue
+                local_path = os.path.join(root, name)
+                source = os.stat(local_path)
+                try:
+                    if all(os.stat(self.variant_path(local_path, e)).st_mtime == source.st_mtime for e in self.encodings):
+                        continue
+                except OSError:
+                    pass
+                try:
+                    await loop.run_in_executor(None, self.build, local_path)
+                except (OSError, ValueError, brotli.error):
+                    # Left to the on-the-fly path; retried on first demand
+                    continue
+                self._account(local_path)
+
+
+variant_store = VariantStore()
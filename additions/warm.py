@@ -0,0 +1,131 @@
+import os
+import time
+import asyncio
+import hashlib
+from additions import upstream
+from additions.cache import prefetch, fill_progress
+from additions.integrity import manifest, quarantine
+
+# Files of a game build, as requested by dist/game.js through /vcbr/
+BUILD_FILES = ("{build}.wasm.br", "{build}.data.br")
+
+DEFAULT_CONCURRENCY = 4
+
+
+def _sha256_file(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _format_bytes(n: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:.1f} {unit}"
+        n /= 1024
+
+
+class _Progress:
+    def __init__(self, jobs: list):
+        self.jobs = jobs
+        self.started = time.monotonic()
+        self.done = 0
+        self.failed = 0
+        self.skipped = 0
+        self.downloaded = 0  # bytes of finished jobs
+        self.initial = {}  # bytes present when a running job started
+
+    def resumed(self, local_path: str, present: int) -> None:
+        # Bytes resumed from an earlier partial download do not count as downloaded
+        self.initial[local_path] = present
+
+    def current_bytes(self) -> int:
+        total = self.downloaded
+        for _, local_path in self.jobs:
+            if progress := fill_progress(local_path):
+                total += progress[0] - self.initial.get(local_path, 0)
+        return total
+
+    def report(self, final: bool = False) -> None:
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        n = self.current_bytes()
+        print(
+            f"warm: {self.done + self.failed + self.skipped}/{len(self.jobs)} files"
+            f" ({self.skipped} already cached, {self.failed} failed),"
+            f" {_format_bytes(n)} downloaded, {_format_bytes(n / elapsed)}/s"
+            + (f" in {elapsed:.1f}s" if final else ""),
+            flush=True,
+        )
+
+
+async def _warm_one(url: str, local_path: str, progress: _Progress, semaphore: asyncio.Semaphore) -> None:
+    async with semaphore:
+        loop = asyncio.get_running_loop()
+        if os.path.isfile(local_path):
+            expected = manifest.expected(local_path)
+            if expected is None or await loop.run_in_executor(None, _sha256_file, local_path) == expected:
+                progress.skipped += 1
+                return
+            print(f"warm: {local_path} does not match sha256sums.txt, moved to {quarantine(local_path, local_path)}")
+
+        try:
+            await prefetch(url, local_path, on_resume=lambda present: progress.resumed(local_path, present))
+        except Exception as e:
+            progress.failed += 1
+            print(f"warm: {url}: {e}", flush=True)
+            return
+        progress.done += 1
+        progress.downloaded += os.path.getsize(local_path) - progress.initial.pop(local_path, 0)
+
+
+async def warm(
+    builds: list[str] | None,
+    vcsky_url: str,
+    vcbr_url: str,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    interval: float = 1.0,
+) -> bool:
+    """
+    Download assets into the vcsky/ and vcbr/ caches before serving any player.
+
+    Args:
+        builds: Game builds such as `vc-sky-en-v6`, fetched into vcbr/; None to fetch
+            every file listed in the upstream sha256sums.txt into vcsky/
+        vcsky_url: Upstream base URL of vcsky
+        vcbr_url: Upstream base URL of vcbr
+        concurrency: Files downloaded at the same time
+        interval: Seconds between progress reports
+
+    Returns:
+        True if every file is cached and verified.
+    """
+    manifest.configure(True, url=f"{vcsky_url}sha256sums.txt", local_path=os.path.join("vcsky", "sha256sums.txt"))
+    if not await manifest.refresh():
+        print("warm: sha256sums.txt unavailable, files will not be verified")
+
+    if builds:
+        jobs = [
+            (f"{vcbr_url}{name}", os.path.join("vcbr", name))
+            for build in builds
+            for name in (pattern.format(build=build) for pattern in BUILD_FILES)
+        ]
+    else:
+        jobs = [(f"{vcsky_url}{name}", os.path.join("vcsky", *name.split("/"))) for name in manifest.names]
+    if not jobs:
+        print("warm: nothing to download")
+        return False
+
+    progress = _Progress(jobs)
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = asyncio.gather(*(_warm_one(url, local_path, progress, semaphore) for url, local_path in jobs))
+    try:
+        while not tasks.done():
+            await asyncio.wait([tasks], timeout=interval)
+            if not tasks.done():
+                progress.report()
+    finally:
+        await upstream.close_client()
+    progress.report(final=True)
+    return progress.failed == 0
@@ -0,0 +1,118 @@
+import os
+import asyncio
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+from additions import metrics
+
+DEFAULT_DECOMPRESS_WORKERS = min(4, os.cpu_count() or 1)
+DEFAULT_WRITE_QUEUE_SIZE = 64
+
+_decompress_workers = DEFAULT_DECOMPRESS_WORKERS
+_write_queue_size = DEFAULT_WRITE_QUEUE_SIZE
+_decompress_pool: ThreadPoolExecutor | None = None
+_writer: ThreadPoolExecutor | None = None
+_write_slots: asyncio.Semaphore | None = None
+_pending_writes = 0
+
+
+def configure(
+    decompress_workers: int = DEFAULT_DECOMPRESS_WORKERS,
+    write_queue_size: int = DEFAULT_WRITE_QUEUE_SIZE,
+) -> None:
+    """
+    Size the worker threads that keep CPU and disk work off the event loop.
+
+    Args:
+        decompress_workers: Threads shared by every brotli decompression
+        write_queue_size: Cache writes that may be queued for the writer thread
+            before downloads are made to wait
+    """
+    global _decompress_workers, _write_queue_size, _write_slots
+    shutdown()
+    _decompress_workers = decompress_workers
+    _write_queue_size = write_queue_size
+    _write_slots = None
+
+
+def shutdown() -> None:
+    global _decompress_pool, _writer
+    for pool in (_decompress_pool, _writer):
+        if pool is not None:
+            pool.shutdown(wait=False)
+    _decompress_pool = _writer = None
+
+
+def _get_decompress_pool() -> ThreadPoolExecutor:
+    global _decompress_pool
+    if _decompress_pool is None:
+        _decompress_pool = ThreadPoolExecutor(_decompress_workers, thread_name_prefix="decompress")
+    return _decompress_pool
+
+
+def _timed(fn, *args):
+    """Run fn(*args) on a worker thread, returning its result and how long it ran."""
+    started = perf_counter()
+    result = fn(*args)
+    return result, perf_counter() - started
+
+
+async def decompress(fn, *args) -> bytes:
+    """Run a decompression step (e.g. `decompressor.process`) in the bounded worker pool."""
+    result, seconds = await asyncio.get_running_loop().run_in_executor(_get_decompress_pool(), _timed, fn, *args)
+    metrics.decompress_seconds.observe(seconds)
+    return result
+
+
+async def submit_write(fn, *args) -> asyncio.Future:
+    """
+    Queue fn(*args) on the dedicated cache writer thread.
+
+    Writes run one at a time in submission order. Once `write_queue_size` writes are
+    pending this waits for one to finish, so a slow disk slows the upstream download
+    down instead of buffering it in memory.
+
+    Returns:
+        A future resolved (on the event loop) when the write is done.
+    """
+    global _writer, _write_slots, _pending_writes
+    if _writer is None:
+        _writer = ThreadPoolExecutor(1, thread_name_prefix="cache-writer")
+    if _write_slots is None:
+        _write_slots = asyncio.Semaphore(_write_queue_size)
+    slots = _write_slots
+    await slots.acquire()
+    _pending_writes += 1
+    loop = asyncio.get_running_loop()
+    timed = loop.run_in_executor(_writer, _timed, fn, *args)
+    future = loop.create_future()
+
+    def _done(timed):
+        global _pending_writes
+        _pending_writes -= 1
+        slots.release()
+        if future.cancelled():
+            return
+        if timed.cancelled():
+            future.cancel()
+        elif timed.exception() is not None:
+            future.set_exception(timed.exception())
+        else:
+            result, seconds = timed.result()
+            metrics.disk_write_seconds.observe(seconds)
+            future.set_result(result)
+
+    timed.add_done_callback(_done)
+    return future
+
+
+def stats() -> dict:
+    return {
+        "decompress_workers": _decompress_workers,
+        "write_queue_size": _write_queue_size,
+        "pending_writes": _pending_writes,
+    }
+
+
+metrics.registry.add(metrics.Gauge(
+    "revcdos_pending_disk_writes", "Cache writes queued for or running on the writer thread", read=lambda: {(): _pending_writes}
+))
@@ -1,11 +1,32 @@
 import json
 import os
 import re
-import cgi
+import hashlib
+import secrets
+import tempfile
+from email.message import Message
 from http.server import BaseHTTPRequestHandler
 from urllib import request as urllib_request
 from urllib.error import HTTPError
-from urllib.parse import parse_qs, unquote, urlparse
+from urllib.parse import parse_qs, unquote, urlencode, urlparse
+
+
+# Taille max d'une sauvegarde (les sauvegardes LZ4 font quelques centaines de Ko).
+MAX_SAVE_BYTES = int(os.environ.get("SAVE_MAX_BYTES") or 16 * 1024 * 1024)
+# Champs token/fileName et en-têtes de partie: petits.
+MAX_FIELD_BYTES = 64 * 1024
+# Place pour les champs et le découpage multipart autour de la sauvegarde.
+FORM_OVERHEAD = 64 * 1024
+READ_SIZE = 64 * 1024
+# Au-delà, la sauvegarde en cours de réception passe de la mémoire à un fichier temporaire.
+SPOOL_SIZE = 1024 * 1024
+
+
+class _FormError(Exception):
+    def __init__(self, status: int, error: str):
+        super().__init__(error)
+        self.status = status
+        self.error = error
 
 
 def _json_response(handler: BaseHTTPRequestHandler, *, status: int, data: dict) -> None:
@@ -62,6 +83,18 @@ def _blob_object_path(token: str, file_name: str) -> str:
     return f"revc-saves/{safe_token}/{safe_name}"
 
 
+def _blob_ref_path(token: str, file_name: str) -> str:
+    # Une sauvegarde ne contient que le SHA-256 de son contenu, stocké une seule fois
+    # dans objects/: ré-uploader une sauvegarde inchangée ne fait aucun PUT.
+    safe_token = _sanitize_token(token) or "anon"
+    safe_name = _sanitize_filename(file_name)
+    return f"revc-saves/refs/{safe_token}/{safe_name}"
+
+
+def _blob_content_path(digest: str) -> str:
+    return f"revc-saves/objects/{digest}"
+
+
 def _blob_url(pathname: str) -> str:
     # API “raw” Vercel Blob (auth via Bearer token).
     return f"https://blob.vercel-storage.com/{pathname.lstrip('/')}"
@@ -75,12 +108,251 @@ def _blob_request(method: str, pathname: str, *, token: str, data: bytes | None
     return req
 
 
+def _blob_read(pathname: str, *, token: str) -> bytes | None:
+    # Pour les petits objets (références); None si absent.
+    try:
+        with urllib_request.urlopen(_blob_request("GET", pathname, token=token), timeout=30) as resp:
+            return resp.read()
+    except HTTPError as e:
+        if e.code == 404:
+            return None
+        raise
+
+
+def _blob_exists(pathname: str, *, token: str) -> bool:
+    try:
+        with urllib_request.urlopen(_blob_request("HEAD", pathname, token=token), timeout=30):
+            return True
+    except HTTPError as e:
+        if e.code == 404:
+            return False
+        raise
+
+
+def _blob_put(pathname: str, data, *, token: str, length: int | None = None) -> int:
+    # data: bytes, ou un fichier envoyé par blocs (avec sa taille `length`).
+    req = _blob_request("PUT", pathname, token=token, data=data)
+    if length is not None:
+        req.add_header("Content-Length", str(length))
+    with urllib_request.urlopen(req, timeout=30) as resp:
+        # Some responses are JSON, but we don't strictly need it.
+        _ = resp.read()
+        return resp.status
+
+
+def _blob_list(prefix: str, *, token: str) -> list[str]:
+    # API “list” Vercel Blob, paginée par cursor.
+    pathnames, cursor = [], None
+    while True:
+        params = {"prefix": prefix, "limit": "1000"}
+        if cursor:
+            params["cursor"] = cursor
+        req = urllib_request.Request(f"{_blob_url('')}?{urlencode(params)}", method="GET")
+        req.add_header("Authorization", f"Bearer {token}")
+        with urllib_request.urlopen(req, timeout=30) as resp:
+            data = json.loads(resp.read())
+        pathnames += [blob["pathname"] for blob in data.get("blobs") or []]
+        cursor = data.get("cursor")
+        if not data.get("hasMore") or not cursor:
+            return pathnames
+
+
+def _list_saves(token: str) -> list[str]:
+    # Références, plus les sauvegardes écrites avant l'adressage par contenu.
+    safe_token = _sanitize_token(token) or "anon"
+    names = set()
+    for prefix in (f"revc-saves/refs/{safe_token}/", f"revc-saves/{safe_token}/"):
+        for pathname in _blob_list(prefix, token=_blob_read_token()):
+            name = pathname[len(prefix):]
+            if name and "/" not in name:
+                names.add(name)
+    return sorted(names)
+
+
+def _etag(digest: str) -> str:
+    return f'"{digest}"'
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+def _read_save(token: str, file_name: str, if_none_match: str | None) -> tuple[int, str | None, bytes | None]:
+    # (status, etag, contenu) d'une sauvegarde: 200, 304 (sans contenu) ou 404.
+    digest = _blob_read(_blob_ref_path(token, file_name), token=_blob_read_token())
+    if digest:
+        etag = _etag(digest.decode("ascii"))
+        if if_none_match and _etag_matches(if_none_match, etag):
+            return 304, etag, None
+        content = _blob_read(_blob_content_path(digest.decode("ascii")), token=_blob_read_token())
+    else:
+        content = _blob_read(_blob_object_path(token, file_name), token=_blob_read_token())
+        etag = _etag(hashlib.sha256(content).hexdigest()) if content is not None else None
+        if etag and if_none_match and _etag_matches(if_none_match, etag):
+            return 304, etag, None
+    if content is None:
+        return 404, None, None
+    return 200, etag, content
+
+
+def _header_param(value: str, param: str) -> str | None:
+    # Paramètre d'un en-tête, ex. boundary de Content-Type ou name de Content-Disposition.
+    message = Message()
+    message["Content-Type"] = value
+    found = message.get_param(param)
+    return found if isinstance(found, str) else None
+
+
+class _MultipartReader:
+    """
+    Parseur multipart/form-data incrémental: lit le corps par blocs de READ_SIZE,
+    sans jamais dépasser Content-Length ni le garder entier en mémoire.
+    """
+
+    def __init__(self, rfile, boundary: str, length: int):
+        self._rfile = rfile
+        self._remaining = length
+        # Le premier délimiteur n'est pas précédé de CRLF: on l'ajoute
+        self._buffer = b"\r\n"
+        self._delimiter = b"\r\n--" + boundary.encode("latin-1")
+
+    def _fill(self) -> None:
+        if self._remaining <= 0:
+            raise _FormError(400, "truncated multipart body")
+        chunk = self._rfile.read(min(READ_SIZE, self._remaining))
+        if not chunk:
+            raise _FormError(400, "truncated multipart body")
+        self._remaining -= len(chunk)
+        self._buffer += chunk
+
+    def _skip_to_delimiter(self) -> None:
+        while (i := self._buffer.find(self._delimiter)) < 0:
+            # Garde de quoi reconnaître un délimiteur coupé entre deux blocs
+            self._buffer = self._buffer[-len(self._delimiter):]
+            self._fill()
+        self._buffer = self._buffer[i + len(self._delimiter):]
+
+    def _part_headers(self) -> dict:
+        while (end := self._buffer.find(b"\r\n\r\n")) < 0:
+            if len(self._buffer) > MAX_FIELD_BYTES:
+                raise _FormError(400, "multipart headers too large")
+            self._fill()
+        headers = {}
+        for line in self._buffer[:end].decode("utf-8", "replace").split("\r\n"):
+            name, sep, value = line.partition(":")
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        self._buffer = self._buffer[end + 4:]
+        return headers
+
+    def _part_body(self):
+        while (i := self._buffer.find(self._delimiter)) < 0:
+            keep = len(self._delimiter) - 1
+            if len(self._buffer) > keep:
+                yield self._buffer[:-keep]
+                self._buffer = self._buffer[-keep:]
+            self._fill()
+        if i:
+            yield self._buffer[:i]
+        self._buffer = self._buffer[i + len(self._delimiter):]
+
+    def parts(self):
+        """Yield (name, chunks) per part; whatever a part's chunks are not read is skipped."""
+        self._skip_to_delimiter()
+        while True:
+            while len(self._buffer) < 2:
+                self._fill()
+            if self._buffer.startswith(b"--"):
+                return
+            self._buffer = self._buffer.lstrip(b" \t")
+            while len(self._buffer) < 2:
+                self._fill()
+            if not self._buffer.startswith(b"\r\n"):
+                raise _FormError(400, "malformed multipart body")
+            self._buffer = self._buffer[2:]
+            headers = self._part_headers()
+            name = _header_param(headers.get("content-disposition", ""), "name") or ""
+            chunks = self._part_body()
+            yield name, chunks
+            for _ in chunks:
+                pass
+
+
+def _read_upload(handler: BaseHTTPRequestHandler):
+    """
+    Lit le formulaire d'upload (token, fileName, file) au fil de l'eau. Le fichier est
+    haché en même temps et gardé dans un fichier temporaire en mémoire jusqu'à SPOOL_SIZE.
+
+    Returns:
+        (champs, fichier rembobiné, sha256, taille)
+    """
+    content_type = handler.headers.get("Content-Type") or ""
+    boundary = _header_param(content_type, "boundary") if "multipart/form-data" in content_type.lower() else None
+    if not boundary:
+        raise _FormError(400, "expected multipart/form-data")
+    length = handler.headers.get("Content-Length")
+    if length is None or not length.isdigit():
+        raise _FormError(411, "Content-Length required")
+    if int(length) > MAX_SAVE_BYTES + FORM_OVERHEAD:
+        raise _FormError(413, "save too large")
+
+    fields, spool, digest, size = {}, None, None, 0
+    try:
+        for name, chunks in _MultipartReader(handler.rfile, boundary, int(length)).parts():
+            if name == "file" and spool is None:
+                spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+                h = hashlib.sha256()
+                for chunk in chunks:
+                    size += len(chunk)
+                    if size > MAX_SAVE_BYTES:
+                        raise _FormError(413, "save too large")
+                    h.update(chunk)
+                    spool.write(chunk)
+                digest = h.hexdigest()
+            elif name in ("token", "fileName"):
+                value = b""
+                for chunk in chunks:
+                    value += chunk
+                    if len(value) > MAX_FIELD_BYTES:
+                        raise _FormError(400, "field too large")
+                fields[name] = value.decode("utf-8", "replace")
+    except BaseException:
+        if spool is not None:
+            spool.close()
+        raise
+    if spool is not None:
+        spool.seek(0)
+    return fields, spool, digest, size
+
+
+def _form_data(index: list, contents: list) -> tuple[bytes, str]:
+    # Corps multipart/form-data (lisible par `Response.formData()` côté navigateur):
+    # une partie JSON `index`, puis une partie `file` par sauvegarde.
+    boundary = secrets.token_hex(16)
+    parts = [
+        b'Content-Disposition: form-data; name="index"\r\nContent-Type: application/json\r\n\r\n'
+        + json.dumps({"files": index}).encode("utf-8")
+    ]
+    for name, content in contents:
+        filename = name.replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+        parts.append(
+            f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            f"Content-Type: application/octet-stream\r\n\r\n".encode("utf-8")
+            + content
+        )
+    delimiter = f"--{boundary}\r\n".encode("ascii")
+    body = b"".join(delimiter + part + b"\r\n" for part in parts) + f"--{boundary}--\r\n".encode("ascii")
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
 class handler(BaseHTTPRequestHandler):
     def do_OPTIONS(self):
         self.send_response(200)
         self.send_header("Access-Control-Allow-Origin", "*")
         self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
-        self.send_header("Access-Control-Allow-Headers", "Content-Type, Range")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type, Range, If-None-Match")
         self.end_headers()
 
     def do_GET(self):
@@ -121,14 +393,34 @@ class handler(BaseHTTPRequestHandler):
                         },
                     )
 
-                blob_path = _blob_object_path(save_token, file_name)
-                req = _blob_request("GET", blob_path, token=_blob_read_token())
-
                 try:
+                    digest = _blob_read(_blob_ref_path(save_token, file_name), token=_blob_read_token())
+                    # Sans référence: sauvegarde écrite avant l'adressage par contenu
+                    if digest:
+                        blob_path = _blob_content_path(digest.decode("ascii"))
+                        etag = _etag(digest.decode("ascii"))
+                        if_none_match = self.headers.get("If-None-Match")
+                        # Revalidation: le navigateur garde la sauvegarde, seule la référence est lue
+                        if if_none_match and _etag_matches(if_none_match, etag):
+                            self.send_response(304)
+                            self.send_header("Access-Control-Allow-Origin", "*")
+                            self.send_header("Cache-Control", "no-cache")
+                            self.send_header("ETag", etag)
+                            self.end_headers()
+                            return
+                    else:
+                        blob_path = _blob_object_path(save_token, file_name)
+                        etag = None
+                    req = _blob_request("GET", blob_path, token=_blob_read_token())
                     with urllib_request.urlopen(req, timeout=30) as resp:
                         self.send_response(resp.status)
                         self.send_header("Access-Control-Allow-Origin", "*")
-                        self.send_header("Cache-Control", "no-store")
+                        if etag:
+                            self.send_header("Cache-Control", "no-cache")
+                            self.send_header("ETag", etag)
+                            self.send_header("Access-Control-Expose-Headers", "ETag")
+                        else:
+                            self.send_header("Cache-Control", "no-store")
                         self.send_header("Content-Type", "application/octet-stream")
                         self.end_headers()
 
@@ -143,6 +435,50 @@ class handler(BaseHTTPRequestHandler):
                         return _json_response(self, status=404, data={"error": "File not found"})
                     return _json_response(self, status=502, data={"error": "Blob upstream error", "status": e.code})
 
+            # Support /saves/batch/{token}?file=a&file=b (+ variante /api/saves/...): plusieurs
+            # sauvegardes (ou toutes) en une réponse multipart/form-data
+            if "/saves/batch/" in path:
+                parts = [p for p in path.split("/") if p]
+                try:
+                    i = parts.index("saves")
+                    if parts[i + 1] != "batch" or len(parts) != i + 3:
+                        raise ValueError()
+                    save_token = parts[i + 2]
+                except Exception:
+                    return _json_response(self, status=400, data={"error": "invalid batch path"})
+
+                if not _is_blob_configured_for_read():
+                    return _json_response(
+                        self,
+                        status=501,
+                        data={
+                            "error": "Vercel Blob not configured",
+                            "hint": "Set BLOB_READ_WRITE_TOKEN (or BLOB_READ_ONLY_TOKEN) in Vercel Environment Variables.",
+                        },
+                    )
+
+                if_none_match = self.headers.get("If-None-Match")
+                try:
+                    names = [_sanitize_filename(name) for name in qs.get("file") or []] or _list_saves(save_token)
+                    index, contents = [], []
+                    for name in names:
+                        status, etag, content = _read_save(save_token, name, if_none_match)
+                        index.append({"name": name, "status": status, "etag": etag})
+                        if content is not None:
+                            contents.append((name, content))
+                except HTTPError as e:
+                    return _json_response(self, status=502, data={"error": "Blob upstream error", "status": e.code})
+
+                body, content_type = _form_data(index, contents)
+                self.send_response(200)
+                self.send_header("Access-Control-Allow-Origin", "*")
+                self.send_header("Cache-Control", "no-store")
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+
             return _json_response(self, status=404, data={"error": "not found"})
 
         except Exception as e:
@@ -164,42 +500,46 @@ class handler(BaseHTTPRequestHandler):
                         },
                     )
 
-                content_type = self.headers.get("content-type") or self.headers.get("Content-Type") or ""
-                if "multipart/form-data" not in content_type.lower():
-                    return _json_response(self, status=400, data={"error": "expected multipart/form-data"})
-
-                environ = {
-                    "REQUEST_METHOD": "POST",
-                    "CONTENT_TYPE": content_type,
-                    "CONTENT_LENGTH": self.headers.get("content-length") or "0",
-                }
-                form = cgi.FieldStorage(fp=self.rfile, headers=self.headers, environ=environ, keep_blank_values=True)
-
-                save_token = str(form.getvalue("token") or "")
-                file_name = str(form.getvalue("fileName") or "")
-                if not save_token or not file_name or "file" not in form:
+                try:
+                    fields, spool, digest, size = _read_upload(self)
+                except _FormError as e:
+                    # Le reste du corps n'a pas été lu: la connexion ne peut pas resservir
+                    self.close_connection = True
+                    return _json_response(self, status=e.status, data={"error": e.error})
+
+                save_token = fields.get("token") or ""
+                file_name = fields.get("fileName") or ""
+                if not save_token or not file_name or spool is None:
+                    if spool is not None:
+                        spool.close()
                     return _json_response(self, status=400, data={"error": "missing fields"})
 
-                file_item = form["file"]
-                raw = file_item.file.read() if getattr(file_item, "file", None) else b""
-                if not raw:
-                    return _json_response(self, status=400, data={"error": "empty file"})
-
-                blob_path = _blob_object_path(save_token, file_name)
-                put_req = _blob_request("PUT", blob_path, token=_blob_write_token(), data=raw)
-
-                try:
-                    with urllib_request.urlopen(put_req, timeout=30) as resp:
-                        # Some responses are JSON, but we don't strictly need it.
-                        _ = resp.read()
-                        if resp.status not in (200, 201):
-                            return _json_response(self, status=502, data={"error": "blob upload failed", "status": resp.status})
+                with spool:
+                    if not size:
+                        return _json_response(self, status=400, data={"error": "empty file"})
+
+                    ref_path = _blob_ref_path(save_token, file_name)
+                    write_token = _blob_write_token()
+
+                    try:
+                        # Inchangée: rien à écrire
+                        if _blob_read(ref_path, token=write_token) == digest.encode("ascii"):
+                            return _json_response(self, status=200, data={"success": True})
+
+                        content_path = _blob_content_path(digest)
+                        if not _blob_exists(content_path, token=write_token):
+                            # Envoyée par blocs depuis le fichier temporaire, jamais lue en entier
+                            status = _blob_put(content_path, spool, token=write_token, length=size)
+                            if status not in (200, 201):
+                                return _json_response(self, status=502, data={"error": "blob upload failed", "status": status})
+                        status = _blob_put(ref_path, digest.encode("ascii"), token=write_token)
+                        if status not in (200, 201):
+                            return _json_response(self, status=502, data={"error": "blob upload failed", "status": status})
                         return _json_response(self, status=200, data={"success": True})
-                except HTTPError as e:
-                    return _json_response(self, status=502, data={"error": "blob upload error", "status": e.code})
+                    except HTTPError as e:
+                        return _json_response(self, status=502, data={"error": "blob upload error", "status": e.code})
 
             return _json_response(self, status=404, data={"error": "not found"})
 
         except Exception as e:
             return _json_response(self, status=500, data={"error": str(e)})
-
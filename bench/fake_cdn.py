@@ -0,0 +1,163 @@
+"""
+Local stand-in for the vcsky/vcbr CDNs, serving synthetic game assets.
+
+Files of a directory are served under both /vcsky/ and /vcbr/, with ETag and
+Last-Modified validators, single byte ranges and an optional latency (before the
+response headers) and per-response bandwidth limit:
+
+    python bench/fake_cdn.py --root /tmp/assets --make_assets --latency 0.05 --bandwidth 20e6
+"""
+import os
+import random
+import asyncio
+import hashlib
+import argparse
+from email.utils import formatdate
+
+import brotli
+
+CHUNK_SIZE = 64 * 1024
+
+# Uncompressed sizes in MiB, roughly those of the real builds
+DEFAULT_DATA_MB = 48
+DEFAULT_WASM_MB = 8
+DEFAULT_BUILDS = ("vc-sky-en-v6",)
+
+
+def _synthetic(size: int, rng: random.Random) -> bytes:
+    """Bytes that compress about as well as game data: random runs mixed with repeated ones."""
+    out = bytearray()
+    dictionary = rng.randbytes(4096)
+    while len(out) < size:
+        if rng.random() < 0.4:
+            out += rng.randbytes(rng.randint(64, 1024))
+        else:
+            start = rng.randint(0, len(dictionary) - 256)
+            out += dictionary[start:start + rng.randint(64, 256)]
+    return bytes(out[:size])
+
+
+def make_assets(root: str, builds=DEFAULT_BUILDS, data_mb: float = DEFAULT_DATA_MB, wasm_mb: float = DEFAULT_WASM_MB, seed: int = 0) -> dict:
+    """
+    Write `<build>.data.br` and `<build>.wasm.br` brotli files and their
+    sha256sums.txt into root. The same arguments always give the same files; files
+    already there are reused.
+
+    Returns:
+        {file name: size in bytes}
+    """
+    os.makedirs(root, exist_ok=True)
+    sizes = {}
+    for build in builds:
+        for kind, mb in (("data", data_mb), ("wasm", wasm_mb)):
+            name = f"{build}.{kind}.br"
+            path = os.path.join(root, name)
+            if not os.path.isfile(path):
+                rng = random.Random(f"{seed}:{name}:{mb}")
+                body = brotli.compress(_synthetic(int(mb * 1024 * 1024), rng), quality=5)
+                with open(path + ".tmp", "wb") as f:
+                    f.write(body)
+                os.replace(path + ".tmp", path)
+            sizes[name] = os.path.getsize(path)
+
+    with open(os.path.join(root, "sha256sums.txt"), "w") as f:
+        for name in sorted(sizes):
+            with open(os.path.join(root, name), "rb") as asset:
+                f.write(f"{hashlib.file_digest(asset, 'sha256').hexdigest()}  {name}\n")
+    return sizes
+
+
+class FakeCDN:
+    """ASGI app serving root under /vcsky/ and /vcbr/."""
+
+    def __init__(self, root: str, latency: float = 0.0, bandwidth: float = 0.0):
+        self.root = root
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await receive()
+            await send({"type": "lifespan.startup.complete"})
+            await receive()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+        headers = {name.decode("latin-1"): value.decode("latin-1") for name, value in scope["headers"]}
+        prefix, _, name = scope["path"][1:].partition("/")
+        path = os.path.join(self.root, os.path.basename(name))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if prefix not in ("vcsky", "vcbr") or not os.path.isfile(path):
+            await self._send(send, 404, [], b"not found")
+            return
+
+        stat = os.stat(path)
+        etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+        response_headers = [
+            (b"etag", etag.encode()),
+            (b"last-modified", formatdate(stat.st_mtime, usegmt=True).encode()),
+            (b"accept-ranges", b"bytes"),
+            (b"content-type", b"application/octet-stream"),
+        ]
+        if headers.get("if-none-match") == etag:
+            await self._send(send, 304, response_headers, b"")
+            return
+
+        start, end, status = 0, stat.st_size - 1, 200
+        byte_range = headers.get("range", "")
+        if byte_range.startswith("bytes="):
+            first, _, last = byte_range[6:].partition("-")
+            if first:
+                start, end = int(first), min(int(last), end) if last else end
+            else:
+                start = max(0, stat.st_size - int(last))
+            if start > end:
+                await self._send(send, 416, [(b"content-range", f"bytes */{stat.st_size}".encode())], b"")
+                return
+            status = 206
+            response_headers.append((b"content-range", f"bytes {start}-{end}/{stat.st_size}".encode()))
+        response_headers.append((b"content-length", str(end - start + 1).encode()))
+
+        await send({"type": "http.response.start", "status": status, "headers": response_headers})
+        if scope["method"] == "HEAD":
+            await send({"type": "http.response.body", "body": b""})
+            return
+        loop = asyncio.get_running_loop()
+        with open(path, "rb") as f:
+            pos = start
+            while pos <= end:
+                chunk = os.pread(f.fileno(), min(CHUNK_SIZE, end + 1 - pos), pos)
+                pos += len(chunk)
+                sent_at = loop.time()
+                await send({"type": "http.response.body", "body": chunk, "more_body": pos <= end})
+                if self.bandwidth:
+                    await asyncio.sleep(max(0.0, len(chunk) / self.bandwidth - (loop.time() - sent_at)))
+
+    async def _send(self, send, status: int, headers: list, body: bytes):
+        await send({"type": "http.response.start", "status": status, "headers": [*headers, (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--root", required=True, help="Directory of the served files")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before each response's headers")
+    parser.add_argument("--bandwidth", type=float, default=0.0, help="Bytes/sec of each response body (default: 0, unlimited)")
+    parser.add_argument("--make_assets", action="store_true", help="Generate the synthetic assets first")
+    parser.add_argument("--data_mb", type=float, default=DEFAULT_DATA_MB, help="Uncompressed size of each .data.br")
+    parser.add_argument("--wasm_mb", type=float, default=DEFAULT_WASM_MB, help="Uncompressed size of each .wasm.br")
+    parser.add_argument("--builds", type=str, default=",".join(DEFAULT_BUILDS), help="Comma-separated builds to generate")
+    options = parser.parse_args()
+
+    if options.make_assets:
+        builds = [b.strip() for b in options.builds.split(",") if b.strip()]
+        make_assets(options.root, builds, options.data_mb, options.wasm_mb)
+
+    import uvicorn
+    uvicorn.run(FakeCDN(options.root, options.latency, options.bandwidth), host="127.0.0.1", port=options.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""
+Load benchmark of server.py against a local stand-in CDN (bench/fake_cdn.py).
+
+Each scenario starts server.py in a scratch directory, in one of these modes:
+
+    proxy   --vcbr_url pointing at the fake CDN, nothing cached
+    cache   --vcbr_cache, measured twice: cold (empty cache, every client asking
+            for the same files at once) then warm (served from the cache)
+    local   --vcbr_local, the assets copied into vcbr/
+
+and downloads the synthetic .data.br/.wasm.br assets from many concurrent clients,
+asking for brotli or not (the server then decompresses). Throughput, p50/p99
+latency, server CPU and peak RSS are printed and stored as JSON, so runs can be
+compared:
+
+    python bench/run.py --clients 16 --requests 64 --latency 0.02 --bandwidth 50e6
+    python bench/run.py --compare bench/results/<earlier run>.json
+
+Linux only (process accounting comes from /proc).
+"""
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timezone
+
+import httpx
+
+from common import ROOT, cpu_seconds, rss_bytes, free_port, wait_for_port
+from fake_cdn import DEFAULT_BUILDS, DEFAULT_DATA_MB, DEFAULT_WASM_MB, make_assets
+
+MODES = ("proxy", "cache", "local")
+ENCODINGS = {"br": "br", "identity": "gzip, deflate"}
+RESULTS_DIR = os.path.join(ROOT, "bench", "results")
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class _Sampler:
+    """Peak RSS of a process, sampled from a thread while a scenario runs."""
+
+    def __init__(self, pid: int, interval: float = 0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.peak = max(self.peak, rss_bytes(self.pid))
+            except OSError:
+                return
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+async def _load(port: int, paths: list, accept_encoding: str, clients: int, requests: int) -> dict:
+    """Download paths round-robin, `requests` times in all from `clients` connections."""
+    latencies, ttfbs, errors = [], [], 0
+    received = 0
+    queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(paths[i % len(paths)])
+
+    async def client(http: httpx.AsyncClient):
+        nonlocal received, errors
+        while not queue.empty():
+            path = queue.get_nowait()
+            started = time.perf_counter()
+            try:
+                async with http.stream("GET", path, headers={"Accept-Encoding": accept_encoding}) as r:
+                    ttfbs.append(time.perf_counter() - started)
+                    async for chunk in r.aiter_raw():
+                        received += len(chunk)
+                    if r.status_code != 200:
+                        errors += 1
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+    timeout = httpx.Timeout(300.0)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=timeout) as http:
+        started = time.perf_counter()
+        await asyncio.gather(*[client(http) for _ in range(clients)])
+        elapsed = time.perf_counter() - started
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "bytes": received,
+        "seconds": round(elapsed, 3),
+        "throughput_bytes_per_second": round(received / elapsed) if elapsed else None,
+        "latency_p50": round(percentile(latencies, 0.50), 4) if latencies else None,
+        "latency_p99": round(percentile(latencies, 0.99), 4) if latencies else None,
+        "ttfb_p50": round(percentile(ttfbs, 0.50), 4) if ttfbs else None,
+        "ttfb_p99": round(percentile(ttfbs, 0.99), 4) if ttfbs else None,
+    }
+
+
+def _measure(server: subprocess.Popen, port: int, paths: list, encoding: str, options) -> dict:
+    cpu_before = cpu_seconds(server.pid)
+    with _Sampler(server.pid) as sampler:
+        result = asyncio.run(_load(port, paths, ENCODINGS[encoding], options.clients, options.requests))
+    result["server_cpu_seconds"] = round(cpu_seconds(server.pid) - cpu_before, 3)
+    result["server_peak_rss_bytes"] = sampler.peak
+    return result
+
+
+def run_mode(mode: str, encoding: str, assets_dir: str, cdn_port: int, paths: list, options) -> list:
+    """Start a server in mode and measure it. Returns one result per measurement."""
+    workdir = tempfile.mkdtemp(prefix=f"bench-{mode}-")
+    try:
+        os.symlink(os.path.join(ROOT, "dist"), os.path.join(workdir, "dist"))
+        port = free_port()
+        cdn = f"http://127.0.0.1:{cdn_port}"
+        command = [
+            sys.executable, os.path.join(ROOT, "server.py"), "--port", str(port),
+            "--vcsky_url", f"{cdn}/vcsky/", "--vcbr_url", f"{cdn}/vcbr/",
+        ]
+        if mode == "cache":
+            command.append("--vcbr_cache")
+        elif mode == "local":
+            shutil.copytree(assets_dir, os.path.join(workdir, "vcbr"))
+            command.append("--vcbr_local")
+        command += shlex.split(options.server_args)
+
+        server = subprocess.Popen(command, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(port)
+            phases = ("cold", "warm") if mode == "cache" else (None,)
+            results = []
+            for phase in phases:
+                result = {"mode": mode if phase is None else f"{mode}_{phase}", "encoding": encoding}
+                result.update(_measure(server, port, paths, encoding, options))
+                results.append(result)
+            return results
+        finally:
+            server.terminate()
+            server.wait()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _key(result: dict) -> tuple:
+    return result["mode"], result["encoding"]
+
+
+def _print(result: dict, previous: dict | None = None) -> None:
+    def delta(field, lower_is_better=False):
+        if previous is None or not previous.get(field) or result.get(field) is None:
+            return ""
+        change = (result[field] - previous[field]) / previous[field] * 100
+        return f" ({change:+.0f}%{'' if (change <= 0) == lower_is_better else ' !'})"
+
+    print(
+        f"{result['mode']:<11} {result['encoding']:<9}"
+        f"{(result['throughput_bytes_per_second'] or 0) / 2**20:9.1f} MiB/s{delta('throughput_bytes_per_second')}"
+        f"  p50 {result['latency_p50']}s p99 {result['latency_p99']}s{delta('latency_p99', lower_is_better=True)}"
+        f"  cpu {result['server_cpu_seconds']}s{delta('server_cpu_seconds', lower_is_better=True)}"
+        f"  rss {result['server_peak_rss_bytes'] / 2**20:.0f} MiB{delta('server_peak_rss_bytes', lower_is_better=True)}"
+        + (f"  errors {result['errors']}" if result["errors"] else "")
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", type=str, default=",".join(MODES), help="Comma-separated modes to run: proxy,cache,local")
+    parser.add_argument("--encodings", type=str, default=",".join(ENCODINGS), help="Comma-separated client kinds: br (brotli accepted), identity (server decompresses)")
+    parser.add_argument("--clients", type=int, default=8, help="Concurrent client connections")
+    parser.add_argument("--requests", type=int, default=32, help="Downloads per measurement, shared by the clients")
+    parser.add_argument("--latency", type=float, default=0.0, help="Fake CDN latency in seconds before response headers")
+    parser.add_argument("--bandwidth", type=float, default=0.0, help="Fake CDN bytes/sec per response (default: 0, unlimited)")
+    parser.add_argument("--data_mb", type=float, default=DEFAULT_DATA_MB, help="Uncompressed size of the synthetic .data.br")
+    parser.add_argument("--wasm_mb", type=float, default=DEFAULT_WASM_MB, help="Uncompressed size of the synthetic .wasm.br")
+    parser.add_argument("--server_args", type=str, default="", help="Extra server.py arguments, e.g. \"--sendfile --workers 2\"")
+    parser.add_argument("--assets", type=str, default=os.path.join(tempfile.gettempdir(), "revcdos-bench-assets"), help="Where the synthetic assets are generated (kept between runs)")
+    parser.add_argument("--out", type=str, default=None, help="Results file (default: bench/results/<time>-<commit>.json)")
+    parser.add_argument("--compare", type=str, default=None, help="Earlier results file to compare with")
+    options = parser.parse_args()
+
+    modes = [m.strip() for m in options.modes.split(",") if m.strip()]
+    encodings = [e.strip() for e in options.encodings.split(",") if e.strip()]
+    for value, allowed in ((modes, MODES), (encodings, ENCODINGS)):
+        if unknown := set(value) - set(allowed):
+            parser.error(f"unknown: {', '.join(sorted(unknown))}")
+
+    assets_dir = os.path.join(options.assets, f"{options.data_mb:g}-{options.wasm_mb:g}")
+    sizes = make_assets(assets_dir, DEFAULT_BUILDS, options.data_mb, options.wasm_mb)
+    paths = [f"/vcbr/{name}" for name in sorted(sizes)]
+
+    previous = {}
+    if options.compare:
+        with open(options.compare) as f:
+            previous = {_key(r): r for r in json.load(f)["results"]}
+
+    cdn_port = free_port()
+    cdn = subprocess.Popen([
+        sys.executable, os.path.join(ROOT, "bench", "fake_cdn.py"), "--root", assets_dir, "--port", str(cdn_port),
+        "--latency", str(options.latency), "--bandwidth", str(options.bandwidth),
+    ])
+    results = []
+    try:
+        wait_for_port(cdn_port)
+        for mode in modes:
+            for encoding in encodings:
+                for result in run_mode(mode, encoding, assets_dir, cdn_port, paths, options):
+                    _print(result, previous.get(_key(result)))
+                    results.append(result)
+    finally:
+        cdn.terminate()
+        cdn.wait()
+
+    commit = _git_commit()
+    report = {
+        "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "options": vars(options),
+        "assets": sizes,
+        "results": results,
+    }
+    out = options.out
+    if out is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        out = os.path.join(RESULTS_DIR, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{commit or 'unknown'}.json")
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"results: {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Upload/download rate of the save stores (additions/save_store.py) at large save counts.
+
+Each store is filled with --files saves (--per_token per player token) in a scratch
+directory, then measured from --threads threads, the way the routes use it:
+
+    unchanged  upload a random save again, with the content it already has
+    upload     overwrite a random save with new content
+    download   read a random existing save
+    miss       look up a save that does not exist
+    list       list the saves of a random token
+
+    python bench/saves_bench.py --files 100000 --threads 8
+    python bench/saves_bench.py --stores flat,sqlite --dir /var/tmp
+"""
+import io
+import os
+import sys
+import time
+import random
+import string
+import shutil
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from additions.save_store import STORE_KINDS, open_store  # noqa: E402
+
+OPERATIONS = ("unchanged", "download", "miss", "list", "upload")
+
+
+def _tokens(count: int, rng: random.Random) -> list[str]:
+    alphabet = string.ascii_letters + string.digits
+    tokens = set()
+    while len(tokens) < count:
+        tokens.add("".join(rng.choices(alphabet, k=5)))
+    return sorted(tokens)
+
+
+def _content(payload: bytes, version: int) -> io.BytesIO:
+    """payload made unique by version, so that the stores cannot share contents."""
+    return io.BytesIO(version.to_bytes(8, "little") + payload[8:])
+
+
+def _rate(threads: int, ops: int, work) -> float:
+    """Run work(i) for i in range(ops) on threads. Returns operations per second."""
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        for _ in pool.map(work, range(ops)):
+            pass
+    return ops / (time.perf_counter() - started)
+
+
+def bench_store(kind: str, options, payload: bytes) -> dict:
+    rng = random.Random(0)
+    tokens = _tokens(max(1, options.files // options.per_token), rng)
+    names = [f"GTAVCsf{i + 1}.b" for i in range(options.per_token)]
+    keys = [(token, name) for token in tokens for name in names]
+    directory = tempfile.mkdtemp(prefix=f"saves-bench-{kind}-", dir=options.dir)
+    try:
+        store = open_store(kind, directory)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(options.threads) as pool:
+            for _ in pool.map(lambda i: store.put(*keys[i], _content(payload, i), len(payload)), range(len(keys))):
+                pass
+        result = {"store": kind, "saves": len(keys), "fill": len(keys) / (time.perf_counter() - started)}
+
+        picks = [rng.randrange(len(keys)) for _ in range(options.ops)]
+        ops = options.ops
+        result["unchanged"] = _rate(options.threads, ops, lambda i: store.put(*keys[picks[i]], _content(payload, picks[i]), len(payload)))
+        result["download"] = _rate(options.threads, ops, lambda i: store.get(*keys[picks[i]]))
+        result["miss"] = _rate(options.threads, ops, lambda i: store.get(keys[picks[i]][0], "missing.b"))
+        result["list"] = _rate(options.threads, ops, lambda i: store.list(keys[picks[i]][0]))
+        key = keys[picks[0]]
+        assert store.get(*key)[1] == _content(payload, picks[0]).getvalue() and store.list(key[0]) == names
+        result["upload"] = _rate(options.threads, ops, lambda i: store.put(*keys[picks[i]], _content(payload, len(keys) + i), len(payload)))
+        store.close()
+        return result
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stores", type=str, default=",".join(STORE_KINDS), help="Comma-separated stores: " + ",".join(STORE_KINDS))
+    parser.add_argument("--files", type=int, default=50000, help="Saves in each store before measuring")
+    parser.add_argument("--per_token", type=int, default=4, help="Saves per player token")
+    parser.add_argument("--size", type=int, default=32 * 1024, help="Bytes per save")
+    parser.add_argument("--ops", type=int, default=5000, help="Operations per measurement")
+    parser.add_argument("--threads", type=int, default=8, help="Threads running the operations (the routes' executor)")
+    parser.add_argument("--dir", type=str, default=None, help="Where the scratch stores are created (default: the temp directory); use the disk saves/ lives on")
+    options = parser.parse_args()
+
+    stores = [s.strip() for s in options.stores.split(",") if s.strip()]
+    if unknown := set(stores) - set(STORE_KINDS):
+        parser.error(f"unknown: {', '.join(sorted(unknown))}")
+
+    payload = os.urandom(options.size)
+    print(f"{'store':<13}{'saves':>8}  " + "".join(f"{name + '/s':>12}" for name in ("fill",) + OPERATIONS))
+    for kind in stores:
+        result = bench_store(kind, options, payload)
+        print(f"{kind:<13}{result['saves']:>8}  " + "".join(f"{result[name]:>12.0f}" for name in ("fill",) + OPERATIONS))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Throughput of server.py serving a large local vcsky file, with and without --sendfile.
+
+Starts the server in a scratch directory holding a random `vcsky/` file, downloads it
+from several clients at once (whole and ranged requests) and reports bytes/sec and
+bytes per CPU-second of the server process (read from /proc, so Linux only).
+
+    python bench/sendfile_bench.py --size_mb 256 --clients 4 --seconds 10
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+from common import ROOT, cpu_seconds, wait_for_port
+
+FILE_NAME = "bench.data.br"
+
+
+async def client(port: int, size: int, ranged: bool, deadline: float) -> int:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    received = 0
+    try:
+        while time.monotonic() < deadline:
+            range_header = f"Range: bytes={size // 4}-{size - 1}\r\n" if ranged else ""
+            writer.write(f"GET /vcsky/{FILE_NAME} HTTP/1.1\r\nHost: bench\r\nAccept-Encoding: br\r\n{range_header}\r\n".encode())
+            head = await reader.readuntil(b"\r\n\r\n")
+            length = next(
+                int(line.split(b":", 1)[1])
+                for line in head.split(b"\r\n")
+                if line.lower().startswith(b"content-length:")
+            )
+            while length:
+                chunk = await reader.read(min(length, 1 << 20))
+                if not chunk:
+                    raise ConnectionError("server closed the connection")
+                length -= len(chunk)
+                received += len(chunk)
+    finally:
+        writer.close()
+    return received
+
+
+def run(sendfile: bool, workdir: str, port: int, size: int, clients: int, seconds: float, ranged: bool) -> dict:
+    command = [sys.executable, os.path.join(ROOT, "server.py"), "--port", str(port), "--vcsky_local"]
+    if sendfile:
+        command.append("--sendfile")
+    server = subprocess.Popen(command, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        cpu_before = cpu_seconds(server.pid)
+        started = time.monotonic()
+
+        async def drive():
+            deadline = time.monotonic() + seconds
+            return await asyncio.gather(*[client(port, size, ranged, deadline) for _ in range(clients)])
+
+        received = sum(asyncio.run(drive()))
+        elapsed = time.monotonic() - started
+        cpu = cpu_seconds(server.pid) - cpu_before
+    finally:
+        server.terminate()
+        server.wait()
+    return {
+        "sendfile": sendfile,
+        "ranged": ranged,
+        "bytes": received,
+        "seconds": round(elapsed, 3),
+        "server_cpu_seconds": round(cpu, 3),
+        "bytes_per_second": round(received / elapsed),
+        "bytes_per_cpu_second": round(received / cpu) if cpu else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size_mb", type=int, default=256, help="Size of the served file")
+    parser.add_argument("--clients", type=int, default=4, help="Concurrent keep-alive connections")
+    parser.add_argument("--seconds", type=float, default=10, help="Duration of each run")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--json", type=str, default=None, help="Also write the results to this file")
+    options = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="sendfile-bench-") as workdir:
+        os.symlink(os.path.join(ROOT, "dist"), os.path.join(workdir, "dist"))
+        os.makedirs(os.path.join(workdir, "vcsky"))
+        size = options.size_mb * 1024 * 1024
+        with open(os.path.join(workdir, "vcsky", FILE_NAME), "wb") as f:
+            for _ in range(options.size_mb):
+                f.write(os.urandom(1024 * 1024))
+
+        for ranged in (False, True):
+            for sendfile in (False, True):
+                result = run(sendfile, workdir, options.port, size, options.clients, options.seconds, ranged)
+                results.append(result)
+                per_cpu = result["bytes_per_cpu_second"]
+                print(
+                    f"{'range ' if ranged else 'whole '} sendfile={'on ' if sendfile else 'off'}  "
+                    f"{result['bytes_per_second'] / 2**20:8.1f} MiB/s  "
+                    f"{per_cpu / 2**20 if per_cpu else float('nan'):8.1f} MiB per server CPU-second"
+                )
+
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,32 @@
 import os
+import sys
+import shlex
+import shutil
+import atexit
+import tempfile
+import asyncio
 import argparse
-from fastapi import FastAPI, Request, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import APIRouter, FastAPI, Request, HTTPException
 from fastapi.responses import Response
-from fastapi.staticfiles import StaticFiles
 import additions.saves as saves
+from additions import save_store
 from additions.auth import BasicAuthMiddleware
-from additions.cache import proxy_and_cache, get_local_file
+from additions import metrics, upstream, workers
+from additions import cache
+from additions.cache import proxy_and_cache, get_local_file, hot_cache
+from additions.variants import variant_store
+from additions.static import StaticEngine, RenderedPage
+from additions import preload
+from additions.integrity import manifest
+from additions import cache_index
+from additions import locks
+from additions import mirrors
+from additions import sendfile
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--port", type=int, default=8000)
+parser.add_argument("--workers", type=int, default=1, help="Worker processes serving the app; they share the cache directories")
 parser.add_argument(
     "--custom_saves",
     action="store_true",
@@ -20,30 +38,117 @@ parser.add_argument(
     action="store_true",
     help="Disable local backend for saves (overrides --custom_saves).",
 )
+parser.add_argument("--save_max_bytes", type=int, default=saves.DEFAULT_MAX_BYTES, help="Largest save accepted by the local saves backend, in bytes")
+parser.add_argument("--save_store", choices=save_store.STORE_KINDS, default=saves.DEFAULT_STORE, help="Layout of saves/: flat {token}_{name} files, sharded per-token directories, or an SQLite index holding the saves (sqlite) or pointing at side files (sqlite-files)")
+parser.add_argument("--migrate_saves", action="store_true", help="Copy the flat {token}_{name} files of saves/ into the --save_store layout and exit")
+parser.add_argument("--collect_saves", action="store_true", help="Remove the save contents of the --save_store no save points at any more and exit; safe while the server runs")
 parser.add_argument("--login", type=str)
 parser.add_argument("--password", type=str)
 parser.add_argument("--vcsky_local", action="store_true", help="Serve vcsky from local directory instead of proxy")
 parser.add_argument("--vcbr_local", action="store_true", help="Serve vcbr from local directory instead of proxy")
-parser.add_argument("--vcsky_url", type=str, default="https://cdn.dos.zone/vcsky/", help="Custom vcsky proxy URL")
-parser.add_argument("--vcbr_url", type=str, default="https://br.cdn.dos.zone/vcsky/", help="Custom vcbr proxy URL")
+parser.add_argument("--vcsky_url", type=str, default="https://cdn.dos.zone/vcsky/", help="Custom vcsky proxy URL, or comma-separated mirrors of it")
+parser.add_argument("--vcbr_url", type=str, default="https://br.cdn.dos.zone/vcsky/", help="Custom vcbr proxy URL, or comma-separated mirrors of it")
 parser.add_argument("--vcsky_cache", action="store_true", help="Cache vcsky files locally. If files are not found in the local directory, they will be downloaded from the specified URL and saved to the local directory.")
 parser.add_argument("--vcbr_cache", action="store_true", help="Cache vcbr files locally. If files are not found in the local directory, they will be downloaded from the specified URL and saved to the local directory.")
-args = parser.parse_args()
+parser.add_argument("--upstream_max_connections", type=int, default=upstream.DEFAULT_MAX_CONNECTIONS, help="Maximum number of pooled connections to the upstream CDNs")
+parser.add_argument("--upstream_max_keepalive", type=int, default=upstream.DEFAULT_MAX_KEEPALIVE_CONNECTIONS, help="Maximum number of idle upstream connections kept alive")
+parser.add_argument("--upstream_keepalive_expiry", type=float, default=upstream.DEFAULT_KEEPALIVE_EXPIRY, help="Seconds an idle upstream connection is kept alive")
+parser.add_argument("--upstream_connect_timeout", type=float, default=upstream.DEFAULT_CONNECT_TIMEOUT, help="Upstream connect timeout in seconds")
+parser.add_argument("--upstream_read_timeout", type=float, default=upstream.DEFAULT_READ_TIMEOUT, help="Upstream read timeout in seconds (between two received chunks)")
+parser.add_argument("--upstream_pool_timeout", type=float, default=upstream.DEFAULT_POOL_TIMEOUT, help="Seconds to wait for a free upstream connection")
+parser.add_argument("--upstream_hedge_after", type=float, default=mirrors.DEFAULT_HEDGE_AFTER, help="With mirrors, seconds without response headers before a GET is also sent to the next mirror (0: only fail over on errors)")
+parser.add_argument("--upstream_mirror_failures", type=int, default=mirrors.DEFAULT_MAX_FAILURES, help="Consecutive failures after which a mirror cools down")
+parser.add_argument("--upstream_mirror_cooldown", type=float, default=mirrors.DEFAULT_COOLDOWN, help="Seconds a failing mirror is only used when no other one is healthy")
+parser.add_argument("--no_upstream_http2", action="store_true", help="Disable HTTP/2 to the upstream CDNs")
+parser.add_argument("--hot_cache_bytes", type=int, default=0, help="Memory budget in bytes of the in-memory tier for small hot files (default: 0, disabled)")
+parser.add_argument("--hot_cache_max_object", type=int, default=4 * 1024 * 1024, help="Largest file in bytes kept in the in-memory tier")
+parser.add_argument("--variants", action="store_true", help="Keep decompressed copies of cached/local .br files for clients without brotli support, built in the background")
+parser.add_argument("--variant_encodings", type=str, default="gzip", help="Extra compressed variants to keep next to the decompressed one: comma-separated gzip,zstd (zstd needs the zstandard package)")
+parser.add_argument("--verify_cache", action="store_true", help="Verify files downloaded into the vcsky/vcbr caches against the upstream sha256sums.txt; mismatches are quarantined instead of cached")
+parser.add_argument("--cache_max_bytes", type=int, default=0, help="Byte budget of each of the vcsky/vcbr cache directories (default: 0, unlimited)")
+parser.add_argument("--cache_eviction", choices=cache_index.EVICTION_POLICIES, default="lru", help="What to evict first once a cache directory is over budget: least recently (lru) or least frequently (lfu) used")
+parser.add_argument("--cache_revalidate_after", type=float, default=0, help="Seconds after which a cached file is revalidated with upstream in the background while the cached copy keeps being served (default: 0, never)")
+parser.add_argument("--cache_segment_threshold", type=int, default=0, help="Download assets of at least this many bytes into the caches as parallel Range requests (default: 0, never)")
+parser.add_argument("--cache_segments", type=int, default=cache.DEFAULT_SEGMENTS, help="Range requests running at once for one segmented download")
+parser.add_argument("--cache_segment_size", type=int, default=cache.DEFAULT_SEGMENT_SIZE, help="Bytes per Range request of a segmented download (rounded up to whole MiB)")
+parser.add_argument("--no_static_precompress", action="store_true", help="Do not build brotli/gzip copies of dist/ files (served from dist/.precompressed/)")
+parser.add_argument("--preload", type=str, default=",".join(preload.DEFAULT_PRELOAD_KINDS), help="Assets announced with Link: rel=preload on the index page: comma-separated wasm,data,scripts (default: wasm,scripts), or empty to disable")
+parser.add_argument("--early_hints", action="store_true", help="Also announce them in a 103 Early Hints response, when the HTTP server supports it")
+parser.add_argument("--builds", type=preload.parse_builds, default=preload.DEFAULT_BUILDS, help="Game build loaded for each ?lang= value, e.g. en=vc-sky-en-v6,ru=vc-sky-ru-v6")
+parser.add_argument("--default_lang", type=str, default=preload.DEFAULT_LANG, help="Language whose build is preloaded when the page is opened without a known ?lang=")
+parser.add_argument("--auth_session", action="store_true", help="With --login/--password, hand out a signed session cookie so later requests skip Basic auth parsing")
+parser.add_argument("--decompress_workers", type=int, default=workers.DEFAULT_DECOMPRESS_WORKERS, help="Threads decompressing brotli for clients without brotli support, shared by all streams")
+parser.add_argument("--cache_write_queue", type=int, default=workers.DEFAULT_WRITE_QUEUE_SIZE, help="Chunks a cache download may queue for the disk writer thread before it waits for the disk")
+parser.add_argument("--sendfile", action="store_true", help="Send cached and local vcsky/vcbr files with sendfile(2) instead of copying them through Python (needs httptools)")
+parser.add_argument("--warm", nargs="?", const="", default=None, metavar="BUILDS", help="Download assets into the caches and exit: the builds given as a comma-separated list (e.g. vc-sky-en-v6,vc-sky-ru-v6) into vcbr/, or without a value every file of the upstream sha256sums.txt into vcsky/")
+parser.add_argument("--warm_concurrency", type=int, default=4, help="Files downloaded at the same time by --warm")
 
-app = FastAPI()
+# Command line the app factory reads when it is not given one (e.g. in --workers processes)
+ARGS_ENV = "REVCDOS_ARGS"
 
-if args.login and args.password:
-    app.add_middleware(BasicAuthMiddleware, username=args.login, password=args.password)
+# Held by the worker process that runs the startup builds (see lifespan)
+STARTUP_LOCK = ".startup"
 
-custom_saves_enabled = bool(args.custom_saves) and not bool(args.no_custom_saves)
-if custom_saves_enabled:
-    # Root paths used by dist/jsdos-cloud-sdk-local.js
-    app.include_router(saves.router)
-    # Vercel-style /api/* compatibility
-    app.include_router(saves.router, prefix="/api")
+# Set by create_app()
+args = None
 
-VCSKY_BASE_URL = args.vcsky_url
-VCBR_BASE_URL = args.vcbr_url
+def init_upstream():
+    upstream.init_client(
+        max_connections=args.upstream_max_connections,
+        max_keepalive_connections=args.upstream_max_keepalive,
+        keepalive_expiry=args.upstream_keepalive_expiry,
+        connect_timeout=args.upstream_connect_timeout,
+        read_timeout=args.upstream_read_timeout,
+        pool_timeout=args.upstream_pool_timeout,
+        http2=not args.no_upstream_http2,
+    )
+    mirrors.mirrors.configure(
+        [mirrors.parse_mirrors(args.vcsky_url), mirrors.parse_mirrors(args.vcbr_url)],
+        hedge_after=args.upstream_hedge_after,
+        max_failures=args.upstream_mirror_failures,
+        cooldown=args.upstream_mirror_cooldown,
+    )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    init_upstream()
+    # With --workers, the first worker to start reconciles the caches and builds the
+    # variants for every worker; it holds the lock until it exits
+    startup = locks.FileLock(STARTUP_LOCK)
+    primary = startup.acquire()
+    for enabled, root in ((args.vcsky_cache, "vcsky"), (args.vcbr_cache, "vcbr")):
+        if enabled:
+            cache_index.open_index(
+                root,
+                max_bytes=args.cache_max_bytes,
+                policy=args.cache_eviction,
+                revalidate_after=args.cache_revalidate_after,
+                rebuild=primary,
+            )
+    await manifest.load()
+    await static_files.load()
+    # Render the landing page before the first visitor asks for it
+    await asyncio.get_running_loop().run_in_executor(None, index_page.refresh)
+    builds = []
+    if primary:
+        builds.append(static_files.schedule_build())
+        if variant_store.enabled:
+            # Prebuild variants of whatever is already on disk, without delaying startup
+            builds.append(asyncio.gather(variant_store.build_all("vcsky"), variant_store.build_all("vcbr")))
+    if metrics.registry.directory is not None:
+        publish = asyncio.ensure_future(metrics.registry.publish_periodically())
+    yield
+    for build in builds:
+        build.cancel()
+    if metrics.registry.directory is not None:
+        publish.cancel()
+        await asyncio.wait([publish])
+    cache_index.close_indexes()
+    await upstream.close_client()
+    workers.shutdown()
+    startup.release()
+
+router = APIRouter()
 
 def request_to_url(request: Request, path: str, base_url: str):
     query_string = str(request.url.query) if request.url.query else ""
@@ -53,7 +158,7 @@ def request_to_url(request: Request, path: str, base_url: str):
     return url
 
 # vcsky routes - either local or proxy
-@app.api_route("/vcsky/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"])
+@router.api_route("/vcsky/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"])
 async def vc_sky_proxy(request: Request, path: str):
     local_path = os.path.join("vcsky", path)
     if args.vcsky_local:
@@ -66,12 +171,12 @@ async def vc_sky_proxy(request: Request, path: str):
     return await proxy_and_cache(request, url, disable_cache=True)
 
 # Vercel-style /api/* compatibility
-@app.api_route("/api/vcsky/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"])
+@router.api_route("/api/vcsky/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"])
 async def vc_sky_proxy_api(request: Request, path: str):
     return await vc_sky_proxy(request, path)
 
 # vcbr routes - either local or proxy
-@app.api_route("/vcbr/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"])
+@router.api_route("/vcbr/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"])
 async def vc_br_proxy(request: Request, path: str):
     local_path = os.path.join("vcbr", path)
     if args.vcbr_local:
@@ -84,38 +189,151 @@ async def vc_br_proxy(request: Request, path: str):
     return await proxy_and_cache(request, url, disable_cache=True)
 
 # Vercel-style /api/* compatibility
-@app.api_route("/api/vcbr/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"])
+@router.api_route("/api/vcbr/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"])
 async def vc_br_proxy_api(request: Request, path: str):
     return await vc_br_proxy(request, path)
 
-@app.get("/")
-async def read_index():
-    if os.path.exists("dist/index.html"):
-        with open("dist/index.html", "r", encoding="utf-8") as f:
-            content = f.read()
-        
-        # Inject custom_saves status
-        custom_saves_val = "1" if custom_saves_enabled else "0"
-        content = content.replace(
-            'new URLSearchParams(window.location.search).get("custom_saves") === "1"',
-            f'"{custom_saves_val}" === "1"'
-        )
-        
-        return Response(content, media_type="text/html", headers={
-            "Cross-Origin-Opener-Policy": "same-origin",
-            "Cross-Origin-Embedder-Policy": "require-corp"
-        })
-    return Response("index.html not found", status_code=404)
-
-app.mount("/", StaticFiles(directory="dist"), name="root")
-
-def start_server(app=app, host="0.0.0.0", port=args.port):
+@router.get("/_stats/upstream")
+async def upstream_stats():
+    return upstream.pool_stats()
+
+@router.get("/_stats/cache")
+async def cache_stats():
+    return cache_index.stats()
+
+@router.get("/_stats/workers")
+async def workers_stats():
+    return workers.stats()
+
+@router.get("/_stats/static")
+async def static_stats():
+    return dict(static_files.stats(), index=index_page.stats())
+
+@router.get("/_stats/hot_cache")
+async def hot_cache_stats():
+    return hot_cache.stats()
+
+@router.get("/metrics")
+async def prometheus_metrics():
+    return Response(metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
+def render_index(content: str) -> str:
+    # Inject custom_saves status
+    custom_saves_val = "1" if custom_saves_enabled else "0"
+    return content.replace(
+        'new URLSearchParams(window.location.search).get("custom_saves") === "1"',
+        f'"{custom_saves_val}" === "1"'
+    )
+
+@router.get("/")
+async def read_index(request: Request):
+    await index_page.update()
+    response = index_page.response(request.headers, headers={
+        "Cross-Origin-Opener-Policy": "same-origin",
+        "Cross-Origin-Embedder-Policy": "require-corp"
+    })
+    if response is None:
+        return Response("index.html not found", status_code=404)
+    return preload.preloader.wrap(response, preload.preloader.links(request.query_params.get("lang")))
+
+def create_app(config: argparse.Namespace = None) -> FastAPI:
+    """
+    Build the app from parsed command-line arguments.
+
+    Without arguments, the command line is read from the REVCDOS_ARGS environment
+    variable, so servers can import the factory by name:
+    `REVCDOS_ARGS="--vcbr_cache" uvicorn --factory server:create_app`.
+    """
+    global args, static_files, index_page, custom_saves_enabled, VCSKY_BASE_URL, VCBR_BASE_URL
+    args = config if config is not None else parser.parse_args(shlex.split(os.environ.get(ARGS_ENV, "")))
+
+    app = FastAPI(lifespan=lifespan)
+
+    if directory := os.environ.get(metrics.METRICS_DIR_ENV):
+        # Set by start_server() for --workers: /metrics reports every worker
+        metrics.registry.share(directory)
+
+    workers.configure(decompress_workers=args.decompress_workers, write_queue_size=args.cache_write_queue)
+    static_files = StaticEngine("dist", precompress=not args.no_static_precompress)
+    index_page = RenderedPage("dist/index.html", render_index)
+    preload.preloader.configure(
+        kinds=[k.strip() for k in args.preload.split(",") if k.strip()],
+        builds=args.builds,
+        default_lang=args.default_lang,
+        early_hints=args.early_hints,
+    )
+    hot_cache.configure(max_bytes=args.hot_cache_bytes, max_object_size=args.hot_cache_max_object)
+    cache.configure_segments(args.cache_segment_threshold, segments=args.cache_segments, segment_size=args.cache_segment_size)
+    manifest.configure(
+        args.verify_cache and (args.vcsky_cache or args.vcbr_cache),
+        url=f"{mirrors.parse_mirrors(args.vcsky_url)[0]}sha256sums.txt",
+        local_path=os.path.join("vcsky", "sha256sums.txt"),
+    )
+    variant_store.configure(args.variants, [e.strip() for e in args.variant_encodings.split(",") if e.strip()])
+
+    if args.login and args.password:
+        app.add_middleware(BasicAuthMiddleware, username=args.login, password=args.password, session_cookie=args.auth_session)
+    # Outermost, so rejected requests are counted too
+    app.add_middleware(metrics.MetricsMiddleware)
+
+    custom_saves_enabled = bool(args.custom_saves) and not bool(args.no_custom_saves)
+    if custom_saves_enabled:
+        saves.configure(max_bytes=args.save_max_bytes, store=args.save_store)
+        # Root paths used by dist/jsdos-cloud-sdk-local.js
+        app.include_router(saves.router)
+        # Vercel-style /api/* compatibility
+        app.include_router(saves.router, prefix="/api")
+
+    # Upstream URLs are built with the first mirror; upstream.send() picks the one to use
+    VCSKY_BASE_URL = mirrors.parse_mirrors(args.vcsky_url)[0]
+    VCBR_BASE_URL = mirrors.parse_mirrors(args.vcbr_url)[0]
+
+    app.include_router(router)
+    app.mount("/", static_files, name="root")
+    return app
+
+def start_server(config: argparse.Namespace, host="0.0.0.0"):
     import uvicorn
-    uvicorn.run(app, host=host, port=port)
+    http = sendfile.PROTOCOL if config.sendfile else "auto"
+    if config.workers > 1:
+        # Each worker imports the factory by name and rebuilds the app from this command line
+        os.environ[ARGS_ENV] = shlex.join(sys.argv[1:])
+        if metrics.METRICS_DIR_ENV not in os.environ:
+            metrics_dir = os.environ[metrics.METRICS_DIR_ENV] = tempfile.mkdtemp(prefix="revcdos-metrics-")
+            atexit.register(shutil.rmtree, metrics_dir, ignore_errors=True)
+        uvicorn.run("server:create_app", factory=True, host=host, port=config.port, workers=config.workers, http=http)
+    else:
+        uvicorn.run(create_app(config), host=host, port=config.port, http=http)
 
 if __name__ == "__main__":
-    print(f"Starting server on http://localhost:{args.port}")
-    print(f"vcsky: {'local' if args.vcsky_local else 'proxy'} ({VCSKY_BASE_URL if not args.vcsky_local else 'vcsky/'})")
-    print(f"vcbr: {'local' if args.vcbr_local else 'proxy'} ({VCBR_BASE_URL if not args.vcbr_local else 'vcbr/'})")
-    print(f"custom_saves: {'enabled' if custom_saves_enabled else 'disabled'}")
-    start_server()
\ No newline at end of file
+    args = parser.parse_args()
+    if args.workers > 1 and locks.fcntl is None:
+        parser.error("--workers needs file locking (fcntl), which this platform does not have")
+    if args.sendfile and not sendfile.available():
+        parser.error("--sendfile needs uvicorn's httptools protocol: pip install httptools")
+    if args.migrate_saves:
+        if args.save_store == "flat":
+            parser.error("--migrate_saves needs a --save_store other than flat")
+        target = save_store.open_store(args.save_store, saves.SAVES_DIR)
+        copied, failed = save_store.migrate_flat(saves.SAVES_DIR, target, args.save_max_bytes)
+        target.close()
+        print(f"saves: {copied} saves copied into the {args.save_store} store" + (f", {failed} failed" if failed else ""))
+        raise SystemExit(1 if failed else 0)
+    if args.collect_saves:
+        store = save_store.open_store(args.save_store, saves.SAVES_DIR)
+        print(f"saves: {store.collect()} unused save contents removed")
+        store.close()
+        raise SystemExit(0)
+    if args.warm is not None:
+        from additions.warm import warm
+        builds = [b.strip() for b in args.warm.split(",") if b.strip()]
+        init_upstream()
+        cache.configure_segments(args.cache_segment_threshold, segments=args.cache_segments, segment_size=args.cache_segment_size)
+        vcsky_url, vcbr_url = mirrors.parse_mirrors(args.vcsky_url)[0], mirrors.parse_mirrors(args.vcbr_url)[0]
+        ok = asyncio.run(warm(builds or None, vcsky_url, vcbr_url, concurrency=args.warm_concurrency))
+        raise SystemExit(0 if ok else 1)
+    print(f"Starting server on http://localhost:{args.port}" + (f" with {args.workers} workers" if args.workers > 1 else ""))
+    print(f"vcsky: {'local' if args.vcsky_local else 'proxy'} ({args.vcsky_url if not args.vcsky_local else 'vcsky/'})")
+    print(f"vcbr: {'local' if args.vcbr_local else 'proxy'} ({args.vcbr_url if not args.vcbr_local else 'vcbr/'})")
+    print(f"custom_saves: {'enabled' if bool(args.custom_saves) and not bool(args.no_custom_saves) else 'disabled'}")
+    start_server(args)